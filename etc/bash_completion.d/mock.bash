@@ -27,7 +27,7 @@ _mock()
 
     case "$prev" in
         -h|--help|--copyin|--copyout|--arch|-D|--define|--with|--without|\
-        --uniqueext|--rpmbuild_timeout|--sources|--cwd|--scm-option)
+        --uniqueext|--jobs|--rpmbuild_timeout|--sources|--cwd|--scm-option|--pool-fill|--daemon-socket)
             return 0
             ;;
         -r|--root)
@@ -35,7 +35,7 @@ _mock()
                 sed -ne 's/\.cfg$//p' )" -X site-defaults -- "$cur" ) )
             return 0
             ;;
-        --configdir|--resultdir)
+        --configdir|--resultdir|--profile)
             COMPREPLY=( $( compgen -d -- "$cur" ) )
             return 0
             ;;
@@ -82,11 +82,13 @@ _mock()
     if [[ "$cur" == -* ]] ; then
         COMPREPLY=( $( compgen -W "--version --help --rebuild --buildsrpm
             --shell --chroot --clean --scrub --init --installdeps --install
-            --update --remove --orphanskill --copyin --copyout --root --offline
+            --update --remove --orphanskill --copyin --copyout --root-cache-bench --pool-fill --yum-cache-gc
+            --daemon --client --daemon-socket
+            --root --offline
             --no-clean --cleanup-after --no-cleanup-after --arch --target
-            --define --with --without --resultdir --uniqueext --configdir
+            --define --with --without --resultdir --uniqueext --jobs --configdir
             --rpmbuild_timeout --unpriv --cwd --spec --sources --verbose
-            --quiet --trace --enable-plugin --disable-plugin
+            --quiet --trace --profile --enable-plugin --disable-plugin
             --print-root-path --scm-enable --scm-option" -- "$cur" ) )
         return 0
     fi
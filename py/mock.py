@@ -28,17 +28,23 @@
            mock [options] --install PACKAGE
            mock [options] --copyin path [..path] destination
            mock [options] --copyout path [..path] destination
+           mock [options] --root-cache-bench
+           mock [options] --pool-fill N
+           mock [options] --yum-cache-gc
            mock [options] --scm-enable [--scm-option key=value]
 """
 
 # library imports
 import ConfigParser
+import copy
+import errno
 import grp
 import logging
 import logging.config
 import os
 import os.path
 import pwd
+import signal
 import sys
 import time
 from optparse import OptionParser
@@ -52,6 +58,12 @@ PKGPYTHONDIR = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), "moc
 MOCKCONFDIR = os.path.join(SYSCONFDIR, "mock")
 # end build system subs
 
+# where mock --daemon listens for mock --client
+DAEMON_SOCKET = "/var/lib/mock/mock.sock"
+
+# set in the process of a mock --client request
+daemon_request_uid = None
+
 # import all mockbuild.* modules after this.
 sys.path.insert(0, PYTHONDIR)
 
@@ -61,9 +73,18 @@ logging.basicConfig(format=FORMAT, level=logging.WARNING)
 log = logging.getLogger()
 
 # our imports
+import mockbuild.trace_decorator
+# without --trace (or an abbreviation optparse would take for it), everything
+# decorated with traceLog() from here on is left undecorated
+mockbuild.trace_decorator.setTracing(
+    len([a for a in sys.argv[1:] if len(a) > 3 and "--trace".startswith(a)]) > 0)
 import mockbuild.exception
 from mockbuild.trace_decorator import traceLog, decorate
 import mockbuild.backend
+import mockbuild.cgroup
+import mockbuild.daemon
+import mockbuild.events
+import mockbuild.profiler
 import mockbuild.scm
 import mockbuild.uid
 import mockbuild.util
@@ -72,7 +93,11 @@ def scrub_callback(option, opt, value, parser):
     parser.values.scrub.append(value)
     parser.values.mode = "clean"
 
-def command_parse(config_opts):
+def pool_fill_callback(option, opt, value, parser):
+    parser.values.pool_fill = value
+    parser.values.mode = "pool-fill"
+
+def command_parse(config_opts, argv=None):
     """return options and args from parsing the command line"""
     parser = OptionParser(usage=__doc__, version=__VERSION__)
 
@@ -125,6 +150,26 @@ def command_parse(config_opts):
                       dest="mode",
                       help="Copy file(s) from the specified chroot")
 
+    parser.add_option("--daemon", action="store_const", const="daemon",
+                      dest="mode",
+                      help="serve mock --client requests on a local socket. keeps"
+                           " python and the plugins loaded between runs; configs,"
+                           " chroots and mounts are set up for each run")
+    parser.add_option("--client", action="store_true", default=False,
+                      help="have a running mock --daemon run this command")
+    parser.add_option("--daemon-socket", action="store", dest="daemon_socket",
+                      default=DAEMON_SOCKET, metavar="PATH",
+                      help="socket of mock --daemon (default: %s)" % DAEMON_SOCKET)
+    parser.add_option("--pool-fill", action="callback", type="int", metavar="N",
+                      callback=pool_fill_callback, dest="pool_fill",
+                      help="keep N initialized chroots of this config ready for builds to claim")
+    parser.add_option("--yum-cache-gc", action="store_const", const="yum-cache-gc",
+                      dest="mode",
+                      help="remove what is too old from the yum cache of this config, as init does")
+    parser.add_option("--root-cache-bench", action="store_const", const="root-cache-bench",
+                      dest="mode",
+                      help="Pack and unpack the chroot with each root cache compressor and report timings")
+
     # options
     parser.add_option("-r", "--root", action="store", type="string", dest="chroot",
                       help="chroot name/config file name default: %default",
@@ -163,6 +208,10 @@ def command_parse(config_opts):
                       default=None,
                       help="Arbitrary, unique extension to append to buildroot"
                            " directory name")
+    parser.add_option("--jobs", action="store", type="int", dest="jobs",
+                      default=1, metavar="N",
+                      help="rebuild up to N of the specified SRPMs at once, each"
+                           " in its own buildroot and resultdir subdirectory")
     parser.add_option("--configdir", action="store", dest="configdir",
                       default=None,
                       help="Change where config files are found")
@@ -190,6 +239,11 @@ def command_parse(config_opts):
                       dest="verbose", help="quiet build")
     parser.add_option("--trace", action="store_true", default=False,
                       dest="trace", help="Enable internal mock tracing output.")
+    parser.add_option("--profile", action="store", dest="profile",
+                      metavar="DIR", default=None,
+                      help="profile mock: write a cProfile dump to DIR and a summary"
+                           " of the time spent in each state, hook and command to"
+                           " profile.json in the result dir")
 
     # plugins
     parser.add_option("--enable-plugin", action="append",
@@ -217,7 +271,7 @@ def command_parse(config_opts):
                       default=[], type="string",
                       help="define an SCM option (may be used more than once)")
 
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv)
     if len(args) and args[0] in ('chroot', 'shell',
             'rebuild', 'install', 'installdeps', 'remove', 'init', 'clean'):
         options.mode = args[0]
@@ -258,12 +312,18 @@ def setup_default_config_opts(config_opts, unprivUid):
 
     config_opts['internal_dev_setup'] = True
     config_opts['internal_setarch'] = True
+    config_opts['chroot_server'] = False
+    config_opts['persistent_mounts'] = False
+    config_opts['cgroups'] = True
 
     # cleanup_on_* only take effect for separate --resultdir
     # config_opts provides fine-grained control. cmdline only has big hammer
     config_opts['cleanup_on_success'] = True
     config_opts['cleanup_on_failure'] = True
 
+    # pooled chroots (see --pool-fill) older than this are not used
+    config_opts['pool_max_age_hours'] = 24
+
     config_opts['createrepo_on_rpms'] = False
     config_opts['createrepo_command'] = '/usr/bin/createrepo -d -q -x *.src.rpm' # default command
     # (global) plugins and plugin configs.
@@ -271,8 +331,10 @@ def setup_default_config_opts(config_opts, unprivUid):
     #    root_cache next.
     #    after that, any plugins that must create dirs (yum_cache)
     #    any plugins without preinit hooks should be last.
-    config_opts['plugins'] = ['tmpfs', 'root_cache', 'yum_cache', 'bind_mount', 'ccache', 'selinux']
+    config_opts['plugins'] = ['tmpfs', 'root_cache', 'yum_cache', 'bind_mount', 'ccache', 'selinux',
+                              'builddep_cache', 'prefetch']
     config_opts['plugin_dir'] = os.path.join(PKGPYTHONDIR, "plugins")
+    config_opts['yum_plugin_dir'] = os.path.join(PKGPYTHONDIR, "yumplugins")
     config_opts['plugin_conf'] = {
             'ccache_enable': True,
             'ccache_opts': {
@@ -284,14 +346,36 @@ def setup_default_config_opts(config_opts, unprivUid):
                 'max_age_days': 30,
                 'max_metadata_age_days': 30,
                 'dir': "%(cache_topdir)s/%(root)s/yum_cache/",
+                'shared_locking': True,
+                'prune_on_init': True,
+                'prune_superseded': True,
+                'max_size': None,
+                'package_store': "%(cache_topdir)s/package_store/",
                 'online': True,},
             'root_cache_enable': True,
             'root_cache_opts': {
                 'max_age_days': 15,
                 'dir': "%(cache_topdir)s/%(root)s/root_cache/",
                 'compress_program': 'pigz',
+                'compress_level': None,
+                'compress_threads': None,
+                'backend': 'tar',
+                'async': True,
+                'refresh': True,
+                'refresh_max_delta': 0.3,
                 'exclude_dirs': ["./proc", "./sys", "./dev", "./tmp/ccache", "./var/cache/yum" ],
-                'extension': '.gz'},
+                'extension': None},
+            'builddep_cache_enable': False,
+            'builddep_cache_opts': {
+                'max_age_days': 2,
+                'max_size_mb': 10240,
+                'dir': "%(cache_topdir)s/%(root)s/builddep_cache/",
+                'compress_program': 'zstd',
+                'exclude_dirs': ["./proc", "./sys", "./dev", "./tmp/ccache", "./var/cache/yum" ]},
+            'prefetch_enable': False,
+            'prefetch_opts': {
+                'threads': 8,
+                'timeout': 60},
             'bind_mount_enable': True,
             'bind_mount_opts': {
             	'dirs': [
@@ -405,6 +489,9 @@ def set_config_opts_per_cmdline(config_opts, options, args):
         config_opts['resultdir'] = os.path.expanduser(options.resultdir)
     if options.uniqueext:
         config_opts['unique-ext'] = options.uniqueext
+    if options.jobs < 1:
+        raise mockbuild.exception.BadCmdline(
+            "Bad option for '--jobs' (%d). Must be at least 1." % options.jobs)
     if options.rpmbuild_timeout is not None:
         config_opts['rpmbuild_timeout'] = options.rpmbuild_timeout
 
@@ -465,6 +552,20 @@ def set_config_opts_per_cmdline(config_opts, options, args):
                 "Bad option for '--scm-option' (%s).  Use --scm-option 'key=value'"
                 % option)
 
+decorate(traceLog())
+def read_config(config_opts, config_path, chroot):
+    """read site-defaults.cfg and the config of the chroot into config_opts.
+       returns False if one of them does not exist."""
+    paths = (os.path.join(config_path, 'site-defaults.cfg'), '%s/%s.cfg' % (config_path, chroot))
+    for cfg in paths:
+        if not os.path.exists(cfg):
+            log.error("Could not find required config file: %s" % cfg)
+            return False
+    for cfg in paths:
+        config_opts['config_paths'].append(cfg)
+        execfile(cfg)
+    return True
+
 legal_arches = {
     'i386'   : ('i386', 'i586', 'i686'),
     'i686'   : ('i386', 'i586', 'i686'),
@@ -506,6 +607,7 @@ def do_rebuild(config_opts, chroot, srpms):
             if config_opts['clean'] and chroot.state() != "clean" \
                     and not config_opts['scm']:
                 chroot.clean()
+                chroot.pool.claim(chroot)
             chroot.init()
             chroot.build(srpm, timeout=config_opts['rpmbuild_timeout'])
             elapsed = time.time() - start
@@ -535,6 +637,121 @@ def do_rebuild(config_opts, chroot, srpms):
             chroot.clean()
         raise
 
+decorate(traceLog())
+def do_rebuild_jobs(config_opts, uidManager, srpms, jobs):
+    """rebuilds srpms in up to 'jobs' buildroots at once. each job runs in
+       its own process with its own Root, so the cache plugins lock against
+       each other as they would for separate mock runs."""
+    # check that everything is kosher. Raises exception on error
+    for hdr in mockbuild.util.yieldSrpmHeaders(srpms):
+        pass
+
+    # the jobs' roots get a -jobN suffix; the results of all of them go
+    # where the results of this root go
+    resultdir = config_opts['resultdir'] % config_opts
+    start = time.time()
+    slots = range(jobs)
+    pending = list(srpms)
+    running = {}
+    failed = []
+    try:
+        while pending or running:
+            while pending and slots:
+                srpm = pending.pop(0)
+                slot = slots.pop(0)
+                pid = os.fork()
+                if pid == 0:
+                    _rebuild_job(config_opts, uidManager, srpm, slot, resultdir)
+                running[pid] = (srpm, slot)
+            try:
+                (pid, status) = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not running.has_key(pid):
+                continue
+            (srpm, slot) = running.pop(pid)
+            slots.append(slot)
+            if status:
+                failed.append((srpm, status))
+    except (Exception, KeyboardInterrupt):
+        for pid in running.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        raise
+
+    elapsed = time.time() - start
+    log.info("Done(%d srpms, %d jobs) Config(%s) %d minutes %d seconds"
+        % (len(srpms), jobs, config_opts['chroot_name'], elapsed//60, elapsed%60))
+
+    if config_opts["createrepo_on_rpms"]:
+        log.info("Running createrepo on binary rpms in resultdir")
+        uidManager.dropPrivsTemp()
+        cmd = config_opts["createrepo_command"].split()
+        cmd.append(resultdir)
+        mockbuild.util.do(cmd)
+        uidManager.restorePrivs()
+
+    if failed:
+        msg = ["%d of %d builds failed:" % (len(failed), len(srpms))]
+        for (srpm, status) in failed:
+            if os.WIFSIGNALED(status):
+                why = "killed by signal %d" % os.WTERMSIG(status)
+            else:
+                why = "exit status %d" % os.WEXITSTATUS(status)
+            msg.append("  %s (%s), see %s" % (srpm, why, _job_resultdir(resultdir, srpm)))
+        raise mockbuild.exception.BuildError, "\n".join(msg)
+
+decorate(traceLog())
+def _job_resultdir(resultdir, srpm):
+    name = os.path.basename(srpm)
+    if name.endswith(".src.rpm"):
+        name = name[:-len(".src.rpm")]
+    return os.path.join(resultdir, name)
+
+def _rebuild_job(base_config, uidManager, srpm, slot, resultdir):
+    """child side of do_rebuild_jobs. never returns."""
+    status = 1
+    chroot = None
+    try:
+        try:
+            # profile and log the events of this build on its own
+            mockbuild.profiler.restart()
+            mockbuild.events.reset()
+            config_opts = copy.deepcopy(base_config)
+            ext = "job%d" % slot
+            if config_opts.has_key('unique-ext'):
+                ext = "%s-%s" % (config_opts['unique-ext'], ext)
+            config_opts['unique-ext'] = ext
+            # Root expands it once more
+            config_opts['resultdir'] = _job_resultdir(resultdir, srpm).replace("%", "%%")
+            # once, over all of them, when every job is done
+            config_opts['createrepo_on_rpms'] = False
+            chroot = mockbuild.backend.Root(config_opts, uidManager)
+            chroot.start("run")
+            try:
+                do_rebuild(config_opts, chroot, [srpm])
+            finally:
+                mockbuild.util.orphansKill(chroot.makeChrootPath())
+            chroot.finish("run")
+            chroot.alldone()
+            status = 0
+        except mockbuild.exception.Error, exc:
+            status = exc.resultcode
+            log.error(str(exc))
+        except:
+            log.exception("job for %s failed" % srpm)
+    finally:
+        if mockbuild.profiler.active():
+            finish_profile(chroot)
+        mockbuild.cgroup.release()
+        logging.shutdown()
+        os._exit(status)
+
 def do_buildsrpm(config_opts, chroot, options, args):
     # verify the input command line arguments actually exist
     if not os.path.isfile(options.spec):
@@ -572,6 +789,46 @@ def do_buildsrpm(config_opts, chroot, options, args):
             chroot.clean()
         raise
 
+decorate(traceLog())
+def run_daemon(config_opts, options):
+    """mock --daemon: import and probe once what every run would, then
+       serve mock --client requests. that is all the daemon keeps: config
+       files are only ever read in the process of a request, and every
+       request sets up and mounts its chroot like a mock run of its own."""
+    for modname in config_opts['plugins']:
+        mockbuild.backend.loadPlugin(config_opts['plugin_dir'], modname)
+    mockbuild.util.selinuxEnabled()
+    daemon = mockbuild.daemon.Daemon(options.daemon_socket, grp.getgrnam('mock').gr_gid)
+    log.info("mock daemon listening on %s" % options.daemon_socket)
+    daemon.serve(daemon_request)
+
+def daemon_request(argv, uid):
+    """one mock --client run, in a process forked from mock --daemon"""
+    global daemon_request_uid
+    daemon_request_uid = uid
+    pw = pwd.getpwuid(uid)
+    # the daemon vouches for the caller the way sudo would
+    if os.environ.has_key('USERHELPER_UID'):
+        del os.environ['USERHELPER_UID']
+    os.environ['SUDO_UID'] = str(uid)
+    os.environ['SUDO_GID'] = str(pw.pw_gid)
+    os.environ['SUDO_USER'] = pw.pw_name
+    sys.argv = [sys.argv[0]] + argv
+    return run()
+
+decorate(traceLog())
+def client_main(socketPath, argv):
+    """mock --client: pass the command line to mock --daemon, which
+       ignores --client and --daemon-socket"""
+    try:
+        return mockbuild.daemon.client(socketPath, argv)
+    except mockbuild.exception.Error, exc:
+        log.error(str(exc))
+        return exc.resultcode
+    except KeyboardInterrupt:
+        # the daemon interrupts the run when we go away
+        return 7
+
 def rootcheck():
     "verify mock was started correctly (either by sudo or consolehelper)"
     # if we're root due to sudo or consolehelper, we're ok
@@ -640,6 +897,9 @@ def main(ret):
     setup_default_config_opts(config_opts, unprivUid)
     (options, args) = command_parse(config_opts)
 
+    if options.profile:
+        mockbuild.profiler.start(os.path.abspath(options.profile))
+
     if options.printrootpath:
         options.verbose = 0
 
@@ -651,21 +911,29 @@ def main(ret):
     # array to save config paths
     config_opts['config_paths'] = []
 
+    # the daemon runs the request as root; a config outside of the config
+    # dir would be code of the caller's choosing
+    if daemon_request_uid is not None:
+        if options.configdir:
+            raise mockbuild.exception.BadCmdline, "--configdir can not be used through --client"
+        if "/" in options.chroot:
+            raise mockbuild.exception.BadCmdline, "-r takes the name of a config in %s through --client" % config_path
+
     # Read in the config files: default, and then user specified
-    for cfg in ( os.path.join(config_path, 'site-defaults.cfg'), '%s/%s.cfg' % (config_path, options.chroot)):
-        if os.path.exists(cfg):
-            config_opts['config_paths'].append(cfg)
-            execfile(cfg)
-        else:
-            log.error("Could not find required config file: %s" % cfg)
-            if options.chroot == "default": log.error("  Did you forget to specify the chroot to use with '-r'?")
-            sys.exit(1)
+    if not read_config(config_opts, config_path, options.chroot):
+        if options.chroot == "default": log.error("  Did you forget to specify the chroot to use with '-r'?")
+        sys.exit(1)
 
     # verify that our unprivileged uid is in the mock group
     groupcheck(unprivGid, config_opts['chrootgid'])
 
     # Read user specific config file
-    cfg = '%s/%s' % (os.path.expanduser('~' + os.getlogin()), '.mock/user.cfg')
+    try:
+        login = os.getlogin()
+    except OSError:
+        # no controlling terminal, eg. when run for mock --client
+        login = pwd.getpwuid(unprivUid)[0]
+    cfg = '%s/%s' % (os.path.expanduser('~' + login), '.mock/user.cfg')
     if os.path.exists(cfg):
         config_opts['config_paths'].append(cfg)
         uidManager.dropPrivsTemp()
@@ -711,6 +979,7 @@ def main(ret):
     logging.getLogger("trace").propagate=0
     if options.trace:
         logging.getLogger("trace").propagate=1
+    mockbuild.trace_decorator.setTracing(options.trace)
 
     # cmdline options override config options
     set_config_opts_per_cmdline(config_opts, options, args)
@@ -738,8 +1007,18 @@ def main(ret):
     # elevate privs
     uidManager._becomeUser(0, 0)
 
+    if options.mode == 'daemon':
+        if daemon_request_uid is not None:
+            raise mockbuild.exception.BadCmdline, "--daemon can not be run through --client"
+        run_daemon(config_opts, options)
+        return
+
     # do whatever we're here to do
     log.info("mock.py version %s starting..." % __VERSION__)
+    # every --jobs worker makes its own Root; Root changes the config it gets
+    jobConfig = None
+    if options.jobs > 1:
+        jobConfig = copy.deepcopy(config_opts)
     chroot = mockbuild.backend.Root(config_opts, uidManager)
 
     chroot.start("run")
@@ -760,7 +1039,9 @@ def main(ret):
 
     # New namespace starting from here
     try:
-        mockbuild.util.unshare(mockbuild.util.CLONE_NEWNS|mockbuild.util.CLONE_NEWUTS)
+        if not mockbuild.util.unshare(mockbuild.util.CLONE_NEWNS|mockbuild.util.CLONE_NEWUTS):
+            # mounts kept around would outlive us in the host namespace
+            chroot.persistent_mounts = False
     except mockbuild.exception.UnshareFailed, e:
         log.error("Namespace unshare failed.")
         sys.exit(e.resultcode)
@@ -774,8 +1055,12 @@ def main(ret):
     if options.mode == 'init':
         if config_opts['clean']:
             chroot.clean()
+            chroot.pool.claim(chroot)
         chroot.init()
 
+    elif options.mode == 'pool-fill':
+        chroot.pool.fill(options.pool_fill)
+
     elif options.mode == 'clean':
         if len(options.scrub) == 0:
             chroot.clean()
@@ -848,7 +1133,10 @@ def main(ret):
             if srpm:
                 args.append(srpm)
             scmWorker.clean()
-        do_rebuild(config_opts, chroot, args)
+        if options.jobs > 1 and len(args) > 1:
+            do_rebuild_jobs(jobConfig, uidManager, args, min(options.jobs, len(args)))
+        else:
+            do_rebuild(config_opts, chroot, args)
 
     elif options.mode == 'buildsrpm':
         do_buildsrpm(config_opts, chroot, options, args)
@@ -858,6 +1146,7 @@ def main(ret):
     elif options.mode == 'copyin':
         chroot.tryLockBuildRoot()
         chroot._resetLogging()
+        chroot.mounts.mountroot()
         #uidManager.dropPrivsForever()
         if len(args) < 2:
             log.critical("Must have source and destinations for copyin")
@@ -879,6 +1168,7 @@ def main(ret):
     elif options.mode == 'copyout':
         chroot.tryLockBuildRoot()
         chroot._resetLogging()
+        chroot.mounts.mountroot()
         uidManager.dropPrivsForever()
         if len(args) < 2:
             log.critical("Must have source and destinations for copyout")
@@ -898,10 +1188,58 @@ def main(ret):
                 shutil.copy(src, dest)
         chroot.unlockBuildRoot()
 
+    elif options.mode == 'root-cache-bench':
+        if not hasattr(chroot, 'rootCacheObj'):
+            log.critical("The root_cache plugin must be enabled for --root-cache-bench")
+            sys.exit(50)
+        chroot.tryLockBuildRoot()
+        chroot._resetLogging()
+        chroot.mounts.mountroot()
+        if not os.path.exists(chroot.makeChrootPath('etc')):
+            raise mockbuild.exception.ChrootNotInitialized, \
+                "chroot %s not initialized!" % chroot.makeChrootPath()
+        results = chroot.rootCacheObj.benchmark()
+        backends = chroot.rootCacheObj.benchmarkBackends()
+        chroot.unlockBuildRoot()
+        print "%-6s %10s %10s %10s %10s %10s" % ("codec", "size (MB)", "pack wall", "pack cpu",
+                                                "unpk wall", "unpk cpu")
+        for (name, size, packWall, packCpu, unpackWall, unpackCpu) in results:
+            print "%-6s %10.1f %9.1fs %9.1fs %9.1fs %9.1fs" % (name, size / 1048576.0, packWall,
+                                                            packCpu, unpackWall, unpackCpu)
+        print
+        print "%-10s %10s %10s" % ("backend", "create", "remove")
+        for (name, create, remove) in backends:
+            print "%-10s %9.2fs %9.2fs" % (name, create, remove)
+
+    elif options.mode == 'yum-cache-gc':
+        if not hasattr(chroot, 'yum_cacheObj'):
+            log.critical("The yum_cache plugin must be enabled for --yum-cache-gc")
+            sys.exit(50)
+        (files, size) = chroot.yum_cacheObj.gc()
+        log.info("removed %d files, %.1f MB from the yum cache" % (files, size / 1048576.0))
+
     chroot.finish("run")
     chroot.alldone()
 
-if __name__ == '__main__':
+def finish_profile(chroot):
+    """write out what --profile collected, as the user who asked for it"""
+    try:
+        if chroot is None:
+            mockbuild.profiler.stop()
+            return
+        resultdir = None
+        if os.path.isdir(chroot.resultdir):
+            resultdir = chroot.resultdir
+        chroot.uidManager.dropPrivsTemp()
+        try:
+            mockbuild.profiler.stop(resultdir)
+        finally:
+            chroot.uidManager.restorePrivs()
+    except (IOError, OSError), e:
+        log.error("Could not write profile: %s" % e)
+
+def run():
+    """run mock for sys.argv, returns the exit status"""
     # fix for python 2.4 logging module bug:
     logging.raiseExceptions = 0
 
@@ -951,11 +1289,21 @@ if __name__ == '__main__':
         exitStatus = 1
         log.exception(exc)
 
+    if mockbuild.profiler.active():
+        finish_profile(retParams.get("chroot"))
+
     if killOrphans and retParams:
         mockbuild.util.orphansKill(retParams["chroot"].makeChrootPath())
+    mockbuild.cgroup.release()
 
     logging.shutdown()
-    sys.exit(exitStatus)
-
-
+    return exitStatus
 
+if __name__ == '__main__':
+    # mock --client only forwards the command line to mock --daemon
+    client_opts = {}
+    setup_default_config_opts(client_opts, os.getuid())
+    (options, args) = command_parse(client_opts)
+    if options.client:
+        sys.exit(client_main(options.daemon_socket, sys.argv[1:]))
+    sys.exit(run())
@@ -6,9 +6,11 @@
 # Copyright (C) 2007 Michael E Brown <mebrown@michaels-house.net>
 
 # python library imports
+import copy
 import fcntl
 import glob
 import imp
+import json
 import logging
 import os
 import shutil
@@ -24,7 +26,13 @@ except:
 
 # our imports
 import mockbuild.util
+import mockbuild.cgroup
+import mockbuild.chrootserver
 import mockbuild.mounts
+import mockbuild.events
+import mockbuild.pool
+import mockbuild.profiler
+import mockbuild.reaper
 import mockbuild.exception
 from mockbuild.trace_decorator import traceLog, decorate, getLog
 
@@ -38,16 +46,25 @@ class Root(object):
         self._hooks = {}
         self.chrootWasCached = False
         self.chrootWasCleaned = False
+        # claimed from the pool with the build user and dirs in place
+        self.chrootWasPooled = False
+        self.depsWereCached = False
+        self.depsSrpms = ()
         self.preExistingDeps = []
         self.logging_initialized = False
         self.buildrootLock = None
         self.version = config['version']
 
+        # pool of ready chroots for this config. takes its own copy of the
+        # config before we start changing it below.
+        self.pool = mockbuild.pool.ChrootPool(config, uidManager)
+
         self.sharedRootName = config['root']
         if config.has_key('unique-ext'):
             config['root'] = "%s-%s" % (config['root'], config['unique-ext'])
 
         self.basedir = os.path.join(config['basedir'], config['root'])
+        self.target_arch = config['target_arch']
         self.rpmbuild_arch = config['rpmbuild_arch']
         self._rootdir = os.path.join(self.basedir, 'root')
         self.homedir = config['chroothome']
@@ -90,6 +107,7 @@ class Root(object):
         self.yum_path = '/usr/bin/yum'
         self.yum_builddep_path = '/usr/bin/yum-builddep'
         self.yum_builddep_opts = config['yum_builddep_opts']
+        self.yumCmd = None
         self.macros = config['macros']
         self.more_buildreqs = config['more_buildreqs']
         self.cache_topdir = config['cache_topdir']
@@ -97,10 +115,24 @@ class Root(object):
         self.useradd = config['useradd']
         self.online = config['online']
         self.internal_dev_setup = config['internal_dev_setup']
+        # keep the chroot mounted from the first _mountall until it is
+        # cleaned or mock exits; the mounts live in our private namespace.
+        # tmpfs takes the whole chroot away after each build.
+        self.persistent_mounts = config['persistent_mounts'] and \
+            not config['plugin_conf'].get('tmpfs_enable')
+        self.mountsActive = False
+        self.chrootServer = None
+        if config['chroot_server']:
+            self.chrootServer = mockbuild.chrootserver.ChrootServer(self.makeChrootPath())
+        # what this mock process runs goes into a cgroup of its own. made
+        # here, while we are root.
+        mockbuild.cgroup.setEnabled(config['cgroups'])
+        mockbuild.cgroup.current()
 
         self.plugins = config['plugins']
         self.pluginConf = config['plugin_conf']
         self.pluginDir = config['plugin_dir']
+        self.yumPluginDir = config['yum_plugin_dir']
         for key in self.pluginConf.keys():
             if not key.endswith('_opts'): continue
             self.pluginConf[key]['basedir'] = self.basedir
@@ -108,6 +140,9 @@ class Root(object):
             self.pluginConf[key]['cachedir'] = self.cachedir
             self.pluginConf[key]['root'] = self.sharedRootName
 
+        # remember what the chroot is made of before plugins get to change it
+        self._configInputs = self._collectConfigInputs()
+
         # mount/umount
         self.mounts = mockbuild.mounts.Mounts(self)
 
@@ -141,6 +176,17 @@ class Root(object):
             hooks.append(function)
             self._hooks[stage] = hooks
 
+    decorate(traceLog())
+    def chrootConfigInputs(self):
+        """the settings that shape the contents of a freshly initialized chroot"""
+        return copy.deepcopy(self._configInputs)
+
+    decorate(traceLog())
+    def buildUserInputs(self):
+        """the settings that shape the build user and its home in the chroot"""
+        return {'uid': self.chrootuid, 'gid': self.chrootgid, 'user': self.chrootuser,
+                'group': self.chrootgroup, 'home': self.homedir, 'useradd': self.useradd}
+
     decorate(traceLog())
     def state(self):
         if not len(self._state):
@@ -152,6 +198,8 @@ class Root(object):
             raise mockbuild.exception.StateError, "start called with None State"
         self._state.append(state)
         self._state_log.info("Start: %s" % state)
+        mockbuild.profiler.stateStarted(state)
+        mockbuild.events.stateStarted(state)
         
     def finish(self, state):
         if len(self._state) == 0:
@@ -160,6 +208,8 @@ class Root(object):
         if state != current:
             raise mockbuild.exception.StateError, "state finish mismatch: current: %s, state: %s" % (current, state)
         self._state_log.info("Finish: %s" % state)
+        mockbuild.profiler.stateFinished(state)
+        mockbuild.events.stateFinished(state)
 
     def alldone(self):
         if len(self._state) != 0:
@@ -172,8 +222,9 @@ class Root(object):
         self.tryLockBuildRoot()
         self.start("clean chroot")
         self._callHooks('clean')
+        self.stopChrootServer()
         mockbuild.util.orphansKill(self.makeChrootPath())
-        self._umountall(nowarn=True)
+        self._umountall(nowarn=True, force=True)
         self._unlock_and_rm_chroot()
         self.chrootWasCleaned = True
         self.finish("clean chroot")
@@ -183,20 +234,32 @@ class Root(object):
     def _unlock_and_rm_chroot(self):
         if not os.path.exists(self.basedir):
             return
-        t = self.basedir + ".tmp"
-        if os.path.exists(t):
-            mockbuild.util.rmtree(t, selinux=self.selinux)
-        os.rename(self.basedir, t)
+        self.stopChrootServer()
+        if self.mountsActive:
+            self._umountall(nowarn=True, force=True)
+        self.mounts.umountroot()
+        t = mockbuild.reaper.trash(self.basedir)
         self.buildrootLock.close()
-        try:
-            mockbuild.util.rmtree(t, selinux=self.selinux)
-        except OSError, e:
-            self.root_log.error(e)
-            self.root_log.error("contents of /proc/mounts:\n%s" % open('/proc/mounts').read())
-            self.root_log.error("looking for users of %s" % t)
-            self._show_path_user(t)
-            raise
-        self.root_log.info("chroot (%s) unlocked and deleted" % self.basedir)
+        self.root_log.info("chroot (%s) unlocked and moved to %s for deletion" % (self.basedir, t))
+        self._reapTrashed()
+
+    decorate(traceLog())
+    def _reapTrashed(self):
+        """have the removed chroots of basedir deleted in the background;
+           the deleting takes as long as it takes, nobody needs to wait for
+           it. unless too many of them pile up."""
+        pending = mockbuild.reaper.trashed(self.basedir)
+        if not pending:
+            return
+        if len(pending) > mockbuild.reaper.MAX_PENDING:
+            self.root_log.info("%d removed chroots are waiting for deletion, deleting them now" % len(pending))
+            mockbuild.reaper.reap(self.basedir, selinux=self.selinux)
+            pending = mockbuild.reaper.trashed(self.basedir)
+            if not pending:
+                return
+        mockbuild.reaper.reapAsync(self.basedir, selinux=self.selinux)
+        self.root_log.info("%d removed chroots are being deleted in the background, see %s"
+                           % (len(pending), mockbuild.reaper.logPath(self.basedir)))
 
     decorate(traceLog())
     def scrub(self, scrub_opts):
@@ -299,13 +362,19 @@ class Root(object):
         # create our log files. (if they havent already)
         self._resetLogging()
 
+        # pick up what an earlier clean left behind if its reaper died
+        self._reapTrashed()
+
         # write out config details
         self.root_log.debug('rootdir = %s' % self.makeChrootPath())
         self.root_log.debug('resultdir = %s' % self.resultdir)
 
         # set up plugins:
         getLog().info("calling preinit hooks")
+        cleaned = self.chrootWasCleaned
         self._callHooks('preinit')
+        if cleaned and self.pluginConf.get('root_cache_enable'):
+            mockbuild.events.emit("cache", cache="root", hit=self.chrootWasCached)
 
         # create skeleton dirs
         self._setupDirs()
@@ -385,7 +454,9 @@ class Root(object):
                 fo.write(self.chroot_file_contents[key])
                 fo.close()
 
-        if self.internal_dev_setup:
+        # /dev/pts and /dev/shm are still mounted from an earlier step,
+        # so /dev is already set up
+        if self.internal_dev_setup and not self.mountsActive:
             self._setupDev()
 
         # yum stuff
@@ -395,14 +466,18 @@ class Root(object):
             if self.chrootWasCleaned:
                 self.yum_init_install_output = self._yum(self.chroot_setup_cmd, returnOutput=1)
             if self.chrootWasCached:
-                self._yum(('update',), returnOutput=1)
+                self.yum_update_output = self._yum(('update',), returnOutput=1)
 
             self.finish("yum update")
-            # create user
-            self._makeBuildUser()
+            if self.chrootWasPooled:
+                getLog().info("build user and dirs set up by the chroot pool")
+                self.chrootWasPooled = False
+            else:
+                # create user
+                self._makeBuildUser()
 
-            # create rpmbuild dir
-            self._buildDirSetup()
+                # create rpmbuild dir
+                self._buildDirSetup()
 
             # set up timezone to match host
             localtimedir = self.makeChrootPath('etc')
@@ -504,6 +579,10 @@ class Root(object):
     #decorate(traceLog())
     def doChroot(self, command, shell=True, returnOutput=False, printOutput=False, raiseExc=True, *args, **kargs):
         """execute given command in root"""
+        if self.chrootServer is not None and os.path.isdir(self.makeChrootPath()):
+            return self.chrootServer.do(command, env=self.env, raiseExc=raiseExc,
+                                        returnOutput=returnOutput, shell=shell,
+                                        printOutput=printOutput, *args, **kargs)
         return mockbuild.util.do(command, chrootPath=self.makeChrootPath(),
                                  env=self.env, raiseExc=raiseExc,
                                  returnOutput=returnOutput, shell=shell,
@@ -547,6 +626,15 @@ class Root(object):
         try:
             self.uidManager.becomeUser(0, 0)
 
+            # give caching a chance to restore the deps instead
+            self.depsSrpms = srpms
+            self.depsWereCached = False
+            self._callHooks('preinstalldeps')
+            if self.pluginConf.get('builddep_cache_enable'):
+                mockbuild.events.emit("cache", cache="builddep", hit=self.depsWereCached)
+            if self.depsWereCached:
+                return
+
             def _yum_and_check(cmd):
                 output = self._yum(cmd, returnOutput=1)
                 for line in output.split('\n'):
@@ -569,6 +657,7 @@ class Root(object):
 
             # install actual build dependencies
             _yum_and_check(['builddep'] + list(srpms))
+            self._callHooks('postinstalldeps')
         finally:
             self.uidManager.restorePrivs()
 
@@ -601,8 +690,13 @@ class Root(object):
 
         buildstate = "build phase for %s" % baserpm
         self.start(buildstate)
+        measurement = None
+        cgroup = mockbuild.cgroup.current(create=False)
+        if cgroup is not None:
+            measurement = cgroup.measure()
         try:
-            self._setupDev()
+            if not self.mountsActive:
+                self._setupDev()
             self._mountall()
 
             # remove rpm db files to prevent version mismatch problems
@@ -685,6 +779,7 @@ class Root(object):
 
             # tell caching we are done building
             self._callHooks('postbuild')
+            self._writeResources(baserpm, measurement)
         self.finish(buildstate)
 
 
@@ -817,11 +912,39 @@ class Root(object):
     # =============
     # 'Private' API
     # =============
+    decorate(traceLog())
+    def _collectConfigInputs(self):
+        plugin_conf = {}
+        for key, value in self.pluginConf.items():
+            if key.endswith('_opts'):
+                # drop the path settings injected in __init__
+                value = dict([(k, v) for (k, v) in value.items()
+                              if k not in ('basedir', 'cache_topdir', 'cachedir', 'root')])
+            plugin_conf[key] = value
+        return copy.deepcopy({
+            'yum.conf': self.yum_conf_content,
+            'priorities.conf': self.yum_priorities_conf_content,
+            'rhnplugin.conf': self.yum_rhnplugin_conf_content,
+            'chroot_setup_cmd': list(self.chroot_setup_cmd),
+            'files': self.chroot_file_contents,
+            'macros': self.macros,
+            'target_arch': self.target_arch,
+            'plugin_conf': plugin_conf,
+            })
+
     decorate(traceLog())
     def _callHooks(self, stage):
         hooks = self._hooks.get(stage, [])
         for hook in hooks:
-            hook()
+            started = mockbuild.events.monotonic()
+            ok = False
+            try:
+                hook()
+                ok = True
+            finally:
+                mockbuild.profiler.hookDone(stage, hook, started)
+                mockbuild.events.emit("hook", stage=stage, hook=mockbuild.events.hookName(hook),
+                                      seconds=round(mockbuild.events.monotonic() - started, 6), ok=ok)
 
     decorate(traceLog())
     def _initPlugins(self):
@@ -829,11 +952,7 @@ class Root(object):
         #  features later when we prove we need them.
         for modname, modulefile in [ (p, os.path.join(self.pluginDir, "%s.py" % p)) for p in self.plugins ]:
             if not self.pluginConf.get("%s_enable"%modname): continue
-            fp, pathname, description = imp.find_module(modname, [self.pluginDir])
-            try:
-                module = imp.load_module(modname, fp, pathname, description)
-            finally:
-                fp.close()
+            module = loadPlugin(self.pluginDir, modname)
 
             if not hasattr(module, 'requires_api_version'):
                 raise mockbuild.exception.Error('Plugin "%s" doesn\'t specify required API version' % modname)
@@ -843,34 +962,40 @@ class Root(object):
     decorate(traceLog())
     def _mountall(self):
         """mount everything that is queued up for mounting in the chroot"""
+        if self.mountsActive:
+            return
         self.mounts.mountall()
+        self.mountsActive = True
 
     decorate(traceLog())
-    def _umountall(self, nowarn=False):
-        """umount all mounted chroot fs."""
+    def _umountall(self, nowarn=False, force=False):
+        """umount all mounted chroot fs. with persistent_mounts this only
+           happens if forced."""
+        if self.persistent_mounts and not force:
+            return
+        # the server would keep a mount on the chroot itself busy
+        self.stopChrootServer()
 
         # first try removing all expected mountpoints.
         self.mounts.umountall(nowarn=nowarn)
 
         # then remove anything that might be left around.
-        mountpoints = open("/proc/mounts").read().strip().split("\n")
+        table = mockbuild.mounts.MountTable()
 
         # umount in reverse mount order to prevent nested mount issues that
         # may prevent clean unmount.
-        for mountline in reversed(mountpoints):
-            mountpoint = mountline.split()[1]
-            if os.path.realpath(mountpoint).startswith(os.path.realpath(self.makeChrootPath()) + "/"):
-                cmd = "umount -n -l %s" % mountpoint
-                self.root_log.warning("Forcibly unmounting '%s' from chroot." % mountpoint)
-                mockbuild.util.do(cmd, raiseExc=0, shell=True, env=self.env)
+        for mountpoint in reversed(table.under(self.makeChrootPath())):
+            self.root_log.warning("Forcibly unmounting '%s' from chroot." % mountpoint)
+            try:
+                mockbuild.util.umount(mountpoint, mockbuild.util.MNT_DETACH)
+            except OSError:
+                mockbuild.util.do(["umount", "-n", "-l", mountpoint], raiseExc=0, shell=False, env=self.env)
+        self.mountsActive = False
 
     decorate(traceLog())
-    def _show_path_user(self, path):
-        cmd = ['/sbin/fuser', '-a', '-v', path]
-        self.root_log.debug("using 'fuser' to find users of %s" % path)
-        out = mockbuild.util.do(cmd, returnOutput=1, raiseExc=False, env=self.env)
-        self.root_log.debug(out)
-        return out
+    def stopChrootServer(self):
+        if self.chrootServer is not None:
+            self.chrootServer.stop()
 
     decorate(traceLog())
     def _yum(self, cmd, returnOutput=0):
@@ -891,9 +1016,12 @@ class Root(object):
         yumcmd.extend(cmd[cmdix:])
         self.root_log.debug(yumcmd)
         output = ""
+        # for the preyum hooks that want to know what yum is about to do
+        self.yumCmd = list(cmd)
         try:
             self._callHooks("preyum")
-            output = mockbuild.util.do(yumcmd, returnOutput=returnOutput, env=self.env)
+            # the tail of yum's output goes into the error if it fails
+            output = mockbuild.util.do(yumcmd, returnOutput=returnOutput, env=self.env, tailSize=4096)
             self._callHooks("postyum")
             return output
         except mockbuild.exception.Error, e:
@@ -934,6 +1062,33 @@ class Root(object):
                 f.write(l+'\n')
             f.close()
 
+    decorate(traceLog())
+    def _writeResources(self, baserpm, measurement):
+        """add what the build of baserpm used to resources.json"""
+        if measurement is None:
+            return
+        usage = measurement.finish()
+        mockbuild.events.emit("resources", package=baserpm, **usage)
+        path = os.path.join(self.resultdir, "resources.json")
+        self.uidManager.dropPrivsTemp()
+        try:
+            try:
+                resources = {}
+                if os.path.exists(path):
+                    resources = json.load(open(path))
+                resources[baserpm] = usage
+                f = open(path + ".tmp", "w")
+                try:
+                    json.dump(resources, f, indent=1, sort_keys=True)
+                    f.write("\n")
+                finally:
+                    f.close()
+                os.rename(path + ".tmp", path)
+            except (IOError, OSError, ValueError), e:
+                getLog().warning("Could not write %s: %s" % (path, e))
+        finally:
+            self.uidManager.restorePrivs()
+
     decorate(traceLog())
     def _resetLogging(self):
         # ensure we dont attach the handlers multiple times.
@@ -958,6 +1113,7 @@ class Root(object):
                 fh.setLevel(logging.NOTSET)
                 log.addHandler(fh)
                 log.info("Mock Version: %s" % self.version)
+            mockbuild.events.attach(os.path.join(self.resultdir, "events.jsonl"))
         finally:
             self.uidManager.restorePrivs()
 
@@ -1002,3 +1158,18 @@ class Root(object):
         shutil.copy2(srpm, dest)
         return os.path.join(self.builddir, 'originals', srpmFilename)
 
+# functions
+# plugin modules by path, so that a process that makes several Roots
+# (--jobs, --daemon) imports each of them only once
+_pluginModules = {}
+
+decorate(traceLog())
+def loadPlugin(pluginDir, modname):
+    key = os.path.join(pluginDir, modname)
+    if not _pluginModules.has_key(key):
+        fp, pathname, description = imp.find_module(modname, [pluginDir])
+        try:
+            _pluginModules[key] = imp.load_module(modname, fp, pathname, description)
+        finally:
+            fp.close()
+    return _pluginModules[key]
@@ -0,0 +1,307 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import errno
+import os
+import sqlite3
+import stat
+import time
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+import mockbuild.exception
+import mockbuild.util
+
+# the index lives in the directory it indexes, under this name
+INDEX_NAME = "cache-index.sqlite"
+
+# a directory changed less than this many seconds before we listed it may
+# change again within the same mtime without us noticing; it is listed
+# again on the next update.
+RACY_SECONDS = 2
+
+# an index of another version is thrown away and built again
+SCHEMA_VERSION = 1
+SCHEMA = """
+create table if not exists dirs (
+    path text primary key,
+    parent text,
+    mtime real
+);
+create table if not exists files (
+    path text primary key,
+    dir text,
+    size integer,
+    ctime real,
+    atime real,
+    name text,
+    epoch integer,
+    version text,
+    release text,
+    arch text
+);
+create index if not exists files_dir on files (dir);
+create index if not exists files_atime on files (atime);
+create index if not exists dirs_parent on dirs (parent);
+"""
+
+# classes
+class CacheIndex(object):
+    """the files under a cache directory with their size and ctime, in a
+       sqlite database next to them. update() only lists the directories
+       whose mtime changed since it last looked, and stats no file it
+       already knows, so that looking for what to prune is a query and not
+       a walk of the whole tree. a file replaced under the same name keeps
+       the size and ctime of the first one, which at worst has it expire
+       early.
+       the last use of a file (atime) is set by mock's yum plugin
+       (yumplugins/mock_cache.py) when yum installs it; without the plugin
+       it stays the time the file was first indexed, and max_size evicts
+       the packages first seen longest ago. rpm packages get their NEVRA
+       read the first time it is asked for."""
+    decorate(traceLog())
+    def __init__(self, topdir):
+        self.topdir = os.path.normpath(topdir)
+        self.path = os.path.join(self.topdir, INDEX_NAME)
+        self.db = None
+
+    # =============
+    # 'Public' API
+    # =============
+    decorate(traceLog())
+    def update(self):
+        """bring the index up to date with the tree. returns the number of
+           directories that had to be listed."""
+        db = self._connect()
+        listed = 0
+        try:
+            pending = [self.topdir]
+            while pending:
+                directory = pending.pop()
+                (changed, subdirs) = self._updateDir(db, directory)
+                listed += changed
+                pending.extend(subdirs)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        return listed
+
+    decorate(traceLog())
+    def older(self, seconds, suffixes=None):
+        """(path, size) of the files with a ctime more than seconds ago,
+           of those ending in one of suffixes if given"""
+        query = "select path, size from files where ctime < ?"
+        params = [time.time() - seconds]
+        if suffixes:
+            query += " and (" + " or ".join(["path like ?"] * len(suffixes)) + ")"
+            params.extend(["%" + s for s in suffixes])
+        return self._connect().execute(query, params).fetchall()
+
+    decorate(traceLog())
+    def totalSize(self, suffix=None):
+        query = "select coalesce(sum(size), 0) from files"
+        params = []
+        if suffix:
+            query += " where path like ?"
+            params.append("%" + suffix)
+        return self._connect().execute(query, params).fetchone()[0]
+
+    decorate(traceLog())
+    def leastRecentlyUsed(self, maxSize, suffix=None):
+        """paths of the files to remove, least recently used first, so that
+           those ending in suffix take maxSize bytes at most"""
+        excess = self.totalSize(suffix) - maxSize
+        paths = []
+        if excess <= 0:
+            return paths
+        query = "select path, size from files"
+        params = []
+        if suffix:
+            query += " where path like ?"
+            params.append("%" + suffix)
+        query += " order by atime"
+        for (path, size) in self._connect().execute(query, params):
+            if excess <= 0:
+                break
+            paths.append(path)
+            excess -= size
+        return paths
+
+    decorate(traceLog())
+    def superseded(self):
+        """paths of the rpm packages with a newer version of the same name
+           and arch in the same directory"""
+        self._readPackages()
+        newest = {}
+        paths = []
+        rows = self._connect().execute("select path, dir, name, epoch, version, release, arch"
+                                       " from files where path like '%.rpm' and name is not null")
+        for (path, directory, name, epoch, version, release, arch) in rows:
+            key = (directory, name, arch)
+            evr = (str(epoch), version, release)
+            if not newest.has_key(key):
+                newest[key] = (evr, path)
+                continue
+            diff = mockbuild.util.compareEVR(evr, newest[key][0])
+            if diff > 0:
+                paths.append(newest[key][1])
+                newest[key] = (evr, path)
+            elif diff < 0:
+                paths.append(path)
+        return paths
+
+    decorate(traceLog())
+    def remove(self, paths):
+        """delete paths from the disk and from the index. returns the bytes
+           freed, by what the index knew of their size."""
+        db = self._connect()
+        freed = 0
+        try:
+            for path in paths:
+                row = db.execute("select size from files where path = ?", (path,)).fetchone()
+                try:
+                    os.unlink(path)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        getLog().warning("could not remove %s: %s" % (path, e))
+                        continue
+                db.execute("delete from files where path = ?", (path,))
+                if row is not None:
+                    freed += row[0]
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        return freed
+
+    decorate(traceLog())
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    # =============
+    # 'Private' API
+    # =============
+    decorate(traceLog())
+    def _connect(self):
+        if self.db is None:
+            # several mock processes update the index after their yum runs;
+            # sqlite serialises them
+            self.db = sqlite3.connect(self.path, timeout=60)
+            self.db.text_factory = str
+            if self.db.execute("pragma user_version").fetchone()[0] != SCHEMA_VERSION:
+                self.db.executescript("drop table if exists files; drop table if exists dirs;")
+                self.db.execute("pragma user_version = %d" % SCHEMA_VERSION)
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    decorate(traceLog())
+    def _readPackages(self):
+        """read the NEVRA of the packages that do not have it yet"""
+        db = self._connect()
+        paths = [r[0] for r in db.execute("select path from files where path like '%.rpm' and name is null")]
+        try:
+            for path in paths:
+                try:
+                    for hdr in mockbuild.util.yieldSrpmHeaders([path], plainRpmOk=1):
+                        db.execute("update files set name = ?, epoch = ?, version = ?, release = ?, arch = ?"
+                                   " where path = ?", mockbuild.util.getNEVRA(hdr) + (path,))
+                except mockbuild.exception.Error, e:
+                    # not a package (yet), try again next time
+                    getLog().debug("could not read %s: %s" % (path, e))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+    def _updateDir(self, db, directory):
+        """returns (1 if directory was listed else 0, its subdirectories)"""
+        try:
+            st = os.lstat(directory)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._forgetDir(db, directory)
+            return (0, [])
+        row = db.execute("select mtime from dirs where path = ?", (directory,)).fetchone()
+        if row is not None and row[0] == st.st_mtime:
+            subdirs = [r[0] for r in db.execute("select path from dirs where parent = ?", (directory,))]
+            return (0, subdirs)
+
+        mtime = st.st_mtime
+        if time.time() - mtime < RACY_SECONDS:
+            mtime = 0
+        known = set([r[0] for r in db.execute("select path from files where dir = ?", (directory,))])
+        knownDirs = set([r[0] for r in db.execute("select path from dirs where parent = ?", (directory,))])
+        subdirs = []
+        seen = set()
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            # the index and the locks of the cache are not part of it
+            if directory == self.topdir and (name.startswith(INDEX_NAME) or name.endswith(".lock")):
+                continue
+            if path in known:
+                seen.add(path)
+                continue
+            try:
+                entry = os.lstat(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            if stat.S_ISDIR(entry.st_mode):
+                subdirs.append(path)
+            elif stat.S_ISREG(entry.st_mode):
+                seen.add(path)
+                db.execute("insert or replace into files (path, dir, size, ctime, atime) values (?, ?, ?, ?, ?)",
+                           (path, directory, entry.st_size, entry.st_ctime, entry.st_ctime))
+        for path in known - seen:
+            db.execute("delete from files where path = ?", (path,))
+        for path in knownDirs - set(subdirs):
+            self._forgetDir(db, path)
+        db.execute("insert or replace into dirs (path, parent, mtime) values (?, ?, ?)",
+                   (directory, os.path.dirname(directory), mtime))
+        return (1, subdirs)
+
+    def _forgetDir(self, db, directory):
+        for (path,) in db.execute("select path from dirs where parent = ?", (directory,)).fetchall():
+            self._forgetDir(db, path)
+        db.execute("delete from files where dir = ?", (directory,))
+        db.execute("delete from dirs where path = ?", (directory,))
+
+# functions
+decorate(traceLog())
+def parseSize(size):
+    """bytes in size, a number optionally followed by K, M, G or T"""
+    size = str(size).strip().upper()
+    for (suffix, factor) in (("K", 1 << 10), ("M", 1 << 20), ("G", 1 << 30), ("T", 1 << 40)):
+        if size.endswith(suffix):
+            return int(float(size[:-1]) * factor)
+    return int(size)
+
+decorate(traceLog())
+def removeUnlinked(directory, minAge=60 * 60):
+    """remove the files under directory that no other hardlink refers to
+       any more and did not change for minAge seconds (a file's ctime is
+       that of its last link or unlink). returns (files, bytes) removed."""
+    removed = 0
+    freed = 0
+    now = time.time()
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.lstat(path)
+                if st.st_nlink > 1 or now - st.st_ctime < minAge:
+                    continue
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    getLog().warning("could not remove %s: %s" % (path, e))
+                continue
+            removed += 1
+            freed += st.st_size
+    return (removed, freed)
@@ -0,0 +1,457 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import errno
+import fcntl
+import os
+import signal
+import time
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+
+# every mock process gets <its own cgroup>/mock/<pid>, below the cgroup it
+# was started in (the session or service of the caller), so that the limits
+# and accounting of whoever runs mock apply to the build too. what mock runs
+# joins it (util.ChildPreExec, the chroot server), mock itself stays
+# outside, so the cgroup holds exactly the processes of this mock run. the
+# cgroups above ours are never changed; with cgroup v2, accounting is only
+# there for the controllers our own cgroup hands down to its children.
+PARENT = "mock"
+# the cgroup v1 hierarchies we use, if there is no usable cgroup v2
+V1_CONTROLLERS = ("freezer", "cpuacct", "memory", "blkio")
+# how long to wait for a freeze or for the processes of a killed cgroup
+FREEZE_TIMEOUT = 2
+KILL_TIMEOUT = 10
+
+_enabled = False
+_current = None
+# set once creating a cgroup failed, so we do not try for every command
+_unavailable = False
+
+# classes
+class BuildCgroup(object):
+    """the cgroup of one mock process"""
+    decorate(traceLog())
+    def __init__(self, version, paths):
+        self.version = version
+        # controller (or "unified" for v2) -> directory of our cgroup
+        self.paths = paths
+        self.pid = os.getpid()
+
+    # =============
+    #  'Public' API
+    # =============
+    def join(self):
+        """move the calling process into the cgroup. meant to be run in a
+           forked child before exec, so it does not log or raise."""
+        euid = os.geteuid()
+        try:
+            try:
+                if euid != 0:
+                    # our saved uid is root, see uidManager._becomeUser
+                    os.seteuid(0)
+                for path in self.paths.values():
+                    _write(os.path.join(path, "cgroup.procs"), str(os.getpid()))
+            except (IOError, OSError):
+                pass
+        finally:
+            if os.geteuid() != euid:
+                os.seteuid(euid)
+
+    decorate(traceLog())
+    def pids(self):
+        pids = set()
+        for path in self.paths.values():
+            try:
+                for line in open(os.path.join(path, "cgroup.procs")):
+                    pids.add(int(line))
+            except (IOError, OSError, ValueError):
+                pass
+        return sorted(pids)
+
+    decorate(traceLog())
+    def freeze(self):
+        """stop everything in the cgroup, so that nothing forks while we
+           look. returns False if that is not possible."""
+        if self.version == 2:
+            if not _writable(os.path.join(self.paths["unified"], "cgroup.freeze"), "1"):
+                return False
+            return self._waitFor(lambda: "frozen 1" in _read(os.path.join(self.paths["unified"], "cgroup.events")))
+        if "freezer" not in self.paths:
+            return False
+        state = os.path.join(self.paths["freezer"], "freezer.state")
+        if not _writable(state, "FROZEN"):
+            return False
+        return self._waitFor(lambda: _read(state).strip() == "FROZEN")
+
+    decorate(traceLog())
+    def thaw(self):
+        if self.version == 2:
+            _writable(os.path.join(self.paths["unified"], "cgroup.freeze"), "0")
+        elif "freezer" in self.paths:
+            _writable(os.path.join(self.paths["freezer"], "freezer.state"), "THAWED")
+
+    decorate(traceLog())
+    def killAll(self):
+        """SIGKILL everything in the cgroup and wait for it to be gone"""
+        if not self.pids():
+            return
+        if self.version == 2 and _writable(os.path.join(self.paths["unified"], "cgroup.kill"), "1"):
+            pass
+        else:
+            frozen = self.freeze()
+            try:
+                for pid in self.pids():
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+            finally:
+                if frozen:
+                    self.thaw()
+        if not self._waitFor(lambda: not self.pids(), KILL_TIMEOUT):
+            getLog().warning("processes %s of %s did not go away" % (self.pids(), self.paths.values()[0]))
+
+    decorate(traceLog())
+    def remove(self):
+        self.killAll()
+        for path in self.paths.values():
+            try:
+                os.rmdir(path)
+            except OSError, e:
+                getLog().debug("could not remove cgroup %s: %s" % (path, e))
+
+    decorate(traceLog())
+    def usage(self):
+        """what the processes of the cgroup used so far: cpu seconds, peak
+           memory and bytes of block I/O. None for what is not accounted."""
+        result = {'cgroup': self.paths.values()[0], 'cgroup_version': self.version,
+                  'cpu_seconds': None, 'cpu_user_seconds': None, 'cpu_system_seconds': None,
+                  'memory_peak_bytes': None, 'io_read_bytes': None, 'io_write_bytes': None}
+        if self.version == 2:
+            path = self.paths["unified"]
+            stat = _keyValues(os.path.join(path, "cpu.stat"))
+            if stat.has_key("usage_usec"):
+                result['cpu_seconds'] = stat["usage_usec"] / 1e6
+                result['cpu_user_seconds'] = stat.get("user_usec", 0) / 1e6
+                result['cpu_system_seconds'] = stat.get("system_usec", 0) / 1e6
+            result['memory_peak_bytes'] = _number(os.path.join(path, "memory.peak"))
+            io = _ioStat(os.path.join(path, "io.stat"))
+            if io is not None:
+                (result['io_read_bytes'], result['io_write_bytes']) = io
+            return result
+
+        if "cpuacct" in self.paths:
+            usage = _number(os.path.join(self.paths["cpuacct"], "cpuacct.usage"))
+            if usage is not None:
+                result['cpu_seconds'] = usage / 1e9
+                ticks = float(os.sysconf("SC_CLK_TCK"))
+                stat = _keyValues(os.path.join(self.paths["cpuacct"], "cpuacct.stat"))
+                result['cpu_user_seconds'] = stat.get("user", 0) / ticks
+                result['cpu_system_seconds'] = stat.get("system", 0) / ticks
+        if "memory" in self.paths:
+            result['memory_peak_bytes'] = _number(os.path.join(self.paths["memory"], "memory.max_usage_in_bytes"))
+        if "blkio" in self.paths:
+            io = _blkioStat(os.path.join(self.paths["blkio"], "blkio.throttle.io_service_bytes"))
+            if io is not None:
+                (result['io_read_bytes'], result['io_write_bytes']) = io
+        return result
+
+    decorate(traceLog())
+    def measure(self):
+        """start measuring what the cgroup uses from now on"""
+        return Measurement(self)
+
+    # =============
+    # 'Private' API
+    # =============
+    def _waitFor(self, condition, timeout=FREEZE_TIMEOUT):
+        deadline = time.time() + timeout
+        while True:
+            if condition():
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+
+class Measurement(object):
+    """usage of a cgroup between measure() and finish(). the peak memory is
+       reset when the kernel lets us (cgroup v1, or v2 on linux 6.12+);
+       otherwise it is the peak since the cgroup was created."""
+    decorate(traceLog())
+    def __init__(self, cgroup):
+        self.cgroup = cgroup
+        self.before = cgroup.usage()
+        self.peak = None
+        self.peakSince = "cgroup"
+        if cgroup.version == 2:
+            # the reset is seen only by reads through the same file
+            try:
+                self.peak = open(os.path.join(cgroup.paths["unified"], "memory.peak"), "r+")
+                fcntl.fcntl(self.peak.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+                self.peak.write("reset\n")
+                self.peak.flush()
+                self.peakSince = "measure"
+            except IOError:
+                if self.peak is not None:
+                    self.peak.close()
+                self.peak = None
+        elif "memory" in cgroup.paths:
+            if _writable(os.path.join(cgroup.paths["memory"], "memory.max_usage_in_bytes"), "0"):
+                self.peakSince = "measure"
+
+    decorate(traceLog())
+    def finish(self):
+        after = self.cgroup.usage()
+        result = {'cgroup': after['cgroup'], 'cgroup_version': after['cgroup_version'],
+                  'memory_peak_bytes': after['memory_peak_bytes'],
+                  'memory_peak_since': self.peakSince}
+        for key in ('cpu_seconds', 'cpu_user_seconds', 'cpu_system_seconds',
+                    'io_read_bytes', 'io_write_bytes'):
+            if after[key] is None or self.before[key] is None:
+                result[key] = None
+            else:
+                result[key] = after[key] - self.before[key]
+        if self.peak is not None:
+            try:
+                try:
+                    self.peak.seek(0)
+                    result['memory_peak_bytes'] = int(self.peak.read())
+                except (IOError, ValueError):
+                    pass
+            finally:
+                self.peak.close()
+                self.peak = None
+        return result
+
+# functions
+decorate(traceLog())
+def setEnabled(enabled):
+    global _enabled
+    _enabled = enabled
+
+decorate(traceLog())
+def current(create=True):
+    """the cgroup of this mock process, made on first use. None if cgroups
+       are disabled or can not be used here."""
+    global _current, _unavailable
+    if _current is not None and _current.pid == os.getpid():
+        return _current
+    if not create or not _enabled or _unavailable:
+        return None
+    # we may have been forked from the mock process that made _current
+    _current = None
+    try:
+        _current = _create()
+    except (IOError, OSError), e:
+        getLog().debug("not using cgroups: %s" % e)
+    if _current is None:
+        _unavailable = True
+    return _current
+
+decorate(traceLog())
+def release():
+    """kill what is left of this mock process and remove its cgroup"""
+    global _current
+    if _current is None or _current.pid != os.getpid():
+        return
+    _current.remove()
+    _current = None
+
+def _create():
+    (version, hierarchies) = _hierarchies()
+    if version is None:
+        getLog().debug("not using cgroups: no cgroup hierarchy mounted")
+        return None
+    paths = {}
+    try:
+        for (controller, own) in hierarchies.items():
+            parent = os.path.join(own, PARENT)
+            if not os.path.isdir(parent):
+                os.mkdir(parent, 0755)
+            if version == 2:
+                _enableControllers(parent)
+            _removeStale(version, controller, parent)
+            path = os.path.join(parent, str(os.getpid()))
+            if not os.path.isdir(path):
+                os.mkdir(path, 0755)
+            paths[controller] = path
+    except (IOError, OSError), e:
+        getLog().debug("not using cgroups: %s" % e)
+        for path in paths.values():
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+        return None
+
+    cgroup = BuildCgroup(version, paths)
+    if not _joinWorks(cgroup):
+        getLog().debug("not using cgroups: can not move processes to %s" % paths.values()[0])
+        cgroup.remove()
+        return None
+    getLog().debug("running commands in cgroup %s" % ", ".join(paths.values()))
+    return cgroup
+
+def _hierarchies():
+    """the directories of the cgroups we are in: (2, {"unified": dir}) if
+       cgroup v2 hands the memory controller down to our children, else
+       (1, {controller: dir}) for the v1 ones we know of, else whatever v2
+       gives us: (2, ...) without accounting, or (None, {})."""
+    own = _ownCgroups()
+    unified = None
+    v1 = {}
+    for line in open("/proc/self/mounts"):
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        if fields[2] == "cgroup2" and unified is None:
+            unified = _below(fields[1], own.get("unified"))
+        elif fields[2] == "cgroup":
+            for option in fields[3].split(","):
+                if option in V1_CONTROLLERS and option not in v1:
+                    path = _below(fields[1], own.get(option))
+                    if path is not None:
+                        v1[option] = path
+    if unified is not None and "memory" in _read(os.path.join(unified, "cgroup.subtree_control")).split():
+        return (2, {"unified": unified})
+    if "freezer" in v1 or "cpuacct" in v1:
+        return (1, v1)
+    if unified is not None:
+        return (2, {"unified": unified})
+    return (None, {})
+
+def _ownCgroups():
+    """controller (or "unified" for v2) -> the path of our cgroup in its
+       hierarchy, from /proc/self/cgroup"""
+    own = {}
+    for line in _read("/proc/self/cgroup").splitlines():
+        fields = line.split(":", 2)
+        if len(fields) != 3:
+            continue
+        if fields[0] == "0" and fields[1] == "":
+            own["unified"] = fields[2]
+        else:
+            for controller in fields[1].split(","):
+                own[controller] = fields[2]
+    return own
+
+def _below(mountpoint, path):
+    """the directory of path in the hierarchy mounted at mountpoint. None
+       if it is not there, eg. with only part of the hierarchy mounted."""
+    if path is None:
+        return None
+    path = os.path.normpath(os.path.join(mountpoint, path.lstrip("/")))
+    if not os.path.isdir(path):
+        return None
+    return path
+
+def _enableControllers(parent):
+    """hand down to the cgroups of the mock processes what our own cgroup
+       lets us have"""
+    for controller in _read(os.path.join(parent, "cgroup.controllers")).split():
+        if controller in ("cpu", "memory", "io"):
+            _writable(os.path.join(parent, "cgroup.subtree_control"), "+" + controller)
+
+def _removeStale(version, controller, parent):
+    """cgroups of mock processes that are gone; kills what they left behind"""
+    for name in os.listdir(parent):
+        if not name.isdigit():
+            continue
+        try:
+            os.kill(int(name), 0)
+            continue
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                continue
+        getLog().debug("removing stale cgroup %s" % os.path.join(parent, name))
+        BuildCgroup(version, {controller: os.path.join(parent, name)}).remove()
+
+def _joinWorks(cgroup):
+    """try it with a child, the way the commands will join"""
+    (joined, joinedw) = os.pipe()
+    (done, donew) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(joined)
+            os.close(donew)
+            cgroup.join()
+            os.write(joinedw, "j")
+            os.read(done, 1)
+        finally:
+            os._exit(0)
+    os.close(joinedw)
+    os.close(done)
+    try:
+        os.read(joined, 1)
+        return pid in cgroup.pids()
+    finally:
+        os.close(joined)
+        os.close(donew)
+        os.waitpid(pid, 0)
+
+def _read(path):
+    try:
+        return open(path).read()
+    except (IOError, OSError):
+        return ""
+
+def _write(path, value):
+    f = open(path, "w")
+    try:
+        f.write(value)
+    finally:
+        f.close()
+
+def _writable(path, value):
+    try:
+        _write(path, value)
+        return True
+    except (IOError, OSError):
+        return False
+
+def _number(path):
+    try:
+        return int(open(path).read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+def _keyValues(path):
+    values = {}
+    for line in _read(path).splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1].isdigit():
+            values[fields[0]] = int(fields[1])
+    return values
+
+def _ioStat(path):
+    """(read, written) bytes over all devices from a v2 io.stat"""
+    if not os.path.exists(path):
+        return None
+    (rbytes, wbytes) = (0, 0)
+    for line in _read(path).splitlines():
+        for field in line.split()[1:]:
+            (key, value) = field.split("=", 1)
+            if key == "rbytes":
+                rbytes += int(value)
+            elif key == "wbytes":
+                wbytes += int(value)
+    return (rbytes, wbytes)
+
+def _blkioStat(path):
+    """(read, written) bytes over all devices from a v1 io_service_bytes"""
+    if not os.path.exists(path):
+        return None
+    (rbytes, wbytes) = (0, 0)
+    for line in _read(path).splitlines():
+        fields = line.split()
+        if len(fields) != 3:
+            continue
+        if fields[1] == "Read":
+            rbytes += int(fields[2])
+        elif fields[1] == "Write":
+            wbytes += int(fields[2])
+    return (rbytes, wbytes)
@@ -0,0 +1,282 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import cPickle
+import ctypes
+import errno
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+import mockbuild.cgroup
+import mockbuild.events
+import mockbuild.exception
+import mockbuild.profiler
+import mockbuild.uid
+import mockbuild.util
+
+# the helper and mock talk in frames (see util.sendFrame). requests are
+# pickled keyword arguments, the replies are:
+#   p: pid of the started command
+#   o, e: a chunk of its stdout, stderr
+#   x: its exit status
+#   E: pickled (errno, strerror) if it could not be started
+# prctl(2)
+PR_SET_PDEATHSIG = 1
+
+# classes
+class ChrootServer(object):
+    """runs commands in a chroot through a helper process that chroots once
+       and then only has to fork and exec for each of them. a new helper is
+       started if the chroot directory is replaced (clean, tmpfs, overlay)."""
+    decorate(traceLog())
+    def __init__(self, chrootPath):
+        self.chrootPath = chrootPath
+        self.helper = None
+        self.sock = None
+        self.ident = None
+
+    # =============
+    #  'Public' API
+    # =============
+    decorate(traceLog())
+    def running(self):
+        if self.helper is None or self.helper.poll() is not None:
+            return False
+        try:
+            st = os.stat(self.chrootPath)
+        except OSError:
+            return False
+        return (st.st_dev, st.st_ino) == self.ident
+
+    decorate(traceLog())
+    def start(self):
+        self.stop()
+        st = os.stat(self.chrootPath)
+        (ours, theirs) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pythonpath = [os.path.dirname(os.path.dirname(os.path.abspath(mockbuild.__file__)))]
+        if os.environ.get("PYTHONPATH"):
+            pythonpath.append(os.environ["PYTHONPATH"])
+        # the commands are forked from the helper, so it goes where they belong
+        cgroup = mockbuild.cgroup.current(create=False)
+        preexec = None
+        if cgroup is not None:
+            preexec = cgroup.join
+        try:
+            # a fresh interpreter, so that each command forks a small process
+            self.helper = subprocess.Popen(
+                [sys.executable, "-c", "import mockbuild.chrootserver; mockbuild.chrootserver.serve(%r)" % self.chrootPath],
+                env={"PYTHONPATH": os.pathsep.join(pythonpath), "PATH": os.environ.get("PATH", "/usr/bin:/bin")},
+                stdin=theirs, stdout=open(os.devnull, "w"),
+                close_fds=True, preexec_fn=preexec,
+                )
+        finally:
+            theirs.close()
+        self.sock = ours
+        self.ident = (st.st_dev, st.st_ino)
+        getLog().debug("started chroot server %d for %s" % (self.helper.pid, self.chrootPath))
+
+    decorate(traceLog())
+    def stop(self):
+        if self.sock is not None:
+            # the helper exits once it sees EOF
+            self.sock.close()
+            self.sock = None
+        if self.helper is not None:
+            try:
+                self.helper.wait()
+            except OSError:
+                pass
+            self.helper = None
+        self.ident = None
+
+    decorate(traceLog())
+    def do(self, command, shell=False, cwd=None, timeout=0, raiseExc=True,
+           returnOutput=0, uid=None, gid=None, personality=None,
+           printOutput=False, env=None, *args, **kargs):
+        """same as mockbuild.util.do with the chroot of this server"""
+        logger = kargs.get("logger", getLog())
+        tailSize = kargs.get("tailSize", 0)
+        start = time.time()
+        clock = mockbuild.events.monotonic()
+        outputBytes = 0
+        if env is None:
+            env = mockbuild.util.clean_env()
+        if not self.running():
+            self.start()
+
+        logger.debug("Executing command: %s with env %s" % (command, env))
+        request = dict(command=command, shell=shell, cwd=cwd, uid=uid, gid=gid,
+                       personality=personality, env=env,
+                       ruid=os.getuid(), euid=os.geteuid(),
+                       rgid=os.getgid(), egid=os.getegid())
+        child = _RemoteChild()
+        killer = None
+        output = ""
+        tail = None
+        if tailSize and not returnOutput:
+            tail = mockbuild.util._OutputTail(tailSize)
+        partial = {'o': "", 'e': ""}
+        try:
+            mockbuild.util.sendFrame(self.sock, "r", cPickle.dumps(request, 2))
+            while child.returncode is None:
+                (tag, payload) = mockbuild.util.recvFrame(self.sock)
+                if tag is None:
+                    raise mockbuild.exception.Error, "chroot server for %s died" % self.chrootPath
+                elif tag == "E":
+                    (err, strerror) = cPickle.loads(payload)
+                    raise OSError(err, strerror)
+                elif tag == "p":
+                    child.pid = int(payload)
+                    if timeout != 0:
+                        killer = mockbuild.util._ChildKiller(child)
+                        killer.arm(max(start + timeout - time.time(), 0))
+                elif tag == "x":
+                    child.returncode = int(payload)
+                else:
+                    outputBytes += len(payload)
+                    lines = payload.split("\n")
+                    lines[0] = partial[tag] + lines[0]
+                    # we may not have all of the last line
+                    partial[tag] = lines.pop()
+                    for line in lines:
+                        if line:
+                            logger.debug(line)
+                    if returnOutput:
+                        output += payload
+                    elif tail is not None:
+                        tail.append(payload)
+                    if printOutput:
+                        sys.stdout.write(payload)
+        except:
+            if killer is not None:
+                killer.cancel()
+            # kill the command if it isnt done
+            if child.pid is not None and child.returncode is None:
+                try:
+                    os.killpg(child.pid, 9)
+                except OSError:
+                    pass
+            # we do not know where in the conversation the helper is
+            self.stop()
+            raise
+        if killer is not None:
+            killer.cancel()
+        mockbuild.profiler.commandDone(command, clock, child.returncode, self.chrootPath)
+        mockbuild.util.commandEvent(command, uid, gid, self.chrootPath, clock, child.returncode, outputBytes)
+
+        for line in partial.values():
+            if line:
+                logger.debug(line)
+        for h in logger.handlers:
+            h.flush()
+        if printOutput:
+            sys.stdout.flush()
+        if tail is not None:
+            output = tail.getvalue()
+
+        if killer is not None and killer.fired:
+            raise mockbuild.util.commandTimeoutExpired, ("Timeout(%s) expired for command:\n # %s\n%s" % (timeout, command, output))
+
+        logger.debug("Child return code was: %s" % str(child.returncode))
+        if raiseExc and child.returncode:
+            if returnOutput:
+                raise mockbuild.exception.Error, ("Command failed: \n # %s\n%s" % (command, output), child.returncode)
+            elif output:
+                raise mockbuild.exception.Error, ("Command failed. See logs for output.\n # %s\n...\n%s" % (command, output), child.returncode)
+            else:
+                raise mockbuild.exception.Error, ("Command failed. See logs for output.\n # %s" % (command,), child.returncode)
+
+        if not returnOutput:
+            return ""
+        return output
+
+class _RemoteChild(object):
+    """what _ChildKiller needs to know about a command run by the helper"""
+    def __init__(self):
+        self.pid = None
+        self.returncode = None
+
+class _CommandPreExec(object):
+    """ChildPreExec for a process that is already in the chroot"""
+    def __init__(self, request):
+        self.request = request
+
+    def __call__(self, *args, **kargs):
+        r = self.request
+        if not r['shell']:
+            os.setsid()
+        os.umask(002)
+        mockbuild.util.condPersonality(r['personality'])
+        # the ids mock had when it sent the request, as condChroot would leave them
+        os.setregid(r['rgid'], r['egid'])
+        mockbuild.uid.setresuid(r['ruid'], r['euid'])
+        mockbuild.util.condDropPrivs(r['uid'], r['gid'])
+        mockbuild.util.condChdir(r['cwd'])
+
+# functions
+def serve(chrootPath):
+    """main loop of the helper. mock is on the other end of stdin."""
+    # do not outlive mock
+    libc = ctypes.cdll.LoadLibrary(None)
+    libc.prctl(PR_SET_PDEATHSIG, signal.SIGKILL, 0, 0, 0)
+    sock = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+
+    mockbuild.uid.setresuid(0, 0, 0)
+    os.chdir(chrootPath)
+    os.chroot(chrootPath)
+    os.chdir("/")
+
+    while True:
+        (tag, payload) = mockbuild.util.recvFrame(sock)
+        if tag is None:
+            break
+        _serveRequest(sock, cPickle.loads(payload), devnull)
+    os._exit(0)
+
+def _serveRequest(sock, request, devnull):
+    try:
+        child = subprocess.Popen(
+            request['command'],
+            shell=request['shell'],
+            env=request['env'],
+            bufsize=0, close_fds=True,
+            stdin=devnull,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            preexec_fn=_CommandPreExec(request),
+            )
+    except OSError, e:
+        mockbuild.util.sendFrame(sock, "E", cPickle.dumps((e.errno, e.strerror), 2))
+        return
+    mockbuild.util.sendFrame(sock, "p", str(child.pid))
+
+    streams = {child.stdout.fileno(): "o", child.stderr.fileno(): "e"}
+    poller = select.poll()
+    for fd in streams.keys():
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+    while streams:
+        try:
+            events = poller.poll()
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                continue
+            raise
+        for (fd, event) in events:
+            data = os.read(fd, mockbuild.util.LOG_OUTPUT_CHUNK)
+            if data == "":
+                poller.unregister(fd)
+                del streams[fd]
+                continue
+            mockbuild.util.sendFrame(sock, streams[fd], data)
+    child.wait()
+    mockbuild.util.sendFrame(sock, "x", str(child.returncode))
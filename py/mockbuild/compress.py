@@ -0,0 +1,151 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import os
+import subprocess
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+import mockbuild.exception
+
+# classes
+class Codec(object):
+    """a compressor that tar can drive through --use-compress-program"""
+    name = None
+    program = None
+    extension = ''
+    threaded = False
+    default_level = None
+    fallback = None
+
+    decorate(traceLog())
+    def __init__(self, level=None, threads=None):
+        self.level = level
+        if self.level is None:
+            self.level = self.default_level
+        self.threads = threads
+        if not self.threads:
+            self.threads = cpuCount()
+        self.threads = int(self.threads)
+
+    decorate(traceLog())
+    def available(self):
+        return which(self.program) is not None
+
+    decorate(traceLog())
+    def command(self):
+        cmd = [self.program]
+        if self.threaded:
+            cmd.extend(self.threadArgs())
+        if self.level is not None:
+            cmd.append("-%s" % self.level)
+        return cmd
+
+    decorate(traceLog())
+    def threadArgs(self):
+        return []
+
+    decorate(traceLog())
+    def tarArgs(self):
+        """tar appends -d itself when unpacking"""
+        return ["--use-compress-program", " ".join(self.command())]
+
+class NoneCodec(Codec):
+    name = 'none'
+
+    def available(self):
+        return True
+
+    def tarArgs(self):
+        return []
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    program = 'gzip'
+    extension = '.gz'
+
+class PigzCodec(Codec):
+    name = 'pigz'
+    program = 'pigz'
+    extension = '.gz'
+    threaded = True
+    fallback = 'gzip'
+
+    def threadArgs(self):
+        return ["-p", str(self.threads)]
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    program = 'zstd'
+    extension = '.zst'
+    threaded = True
+    default_level = 3
+    fallback = 'pigz'
+
+    def threadArgs(self):
+        return ["-T%d" % self.threads]
+
+class XzCodec(Codec):
+    name = 'xz'
+    program = 'xz'
+    extension = '.xz'
+    threaded = True
+    fallback = 'gzip'
+
+    decorate(traceLog())
+    def available(self):
+        if not Codec.available(self):
+            return False
+        # xz only learned about threads in 5.2
+        if self.threaded and subprocess.call([which(self.program), "-T1", "--version"],
+                                             stdout=open(os.devnull, "w"),
+                                             stderr=subprocess.STDOUT) != 0:
+            self.threaded = False
+        return True
+
+    def threadArgs(self):
+        return ["-T%d" % self.threads]
+
+codecs = {}
+for _c in (NoneCodec, GzipCodec, PigzCodec, ZstdCodec, XzCodec):
+    codecs[_c.name] = _c
+
+# functions
+decorate(traceLog())
+def which(program):
+    for d in os.environ.get("PATH", "/usr/bin:/bin").split(os.pathsep) + ["/usr/bin", "/bin"]:
+        path = os.path.join(d, program)
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+decorate(traceLog())
+def cpuCount():
+    try:
+        return max(1, os.sysconf("SC_NPROCESSORS_ONLN"))
+    except (ValueError, OSError):
+        return 1
+
+decorate(traceLog())
+def getCodec(name, level=None, threads=None):
+    """return a usable codec for 'name', falling back to slower ones
+       when the preferred program is not installed."""
+    if not name:
+        name = 'none'
+    if not codecs.has_key(name):
+        # arbitrary program, driven the way tar always did
+        class ProgramCodec(Codec):
+            pass
+        ProgramCodec.name = name
+        ProgramCodec.program = name
+        return ProgramCodec(level, threads)
+    codec = codecs[name](level, threads)
+    while not codec.available():
+        if codec.fallback is None:
+            raise mockbuild.exception.Error, "no usable compressor for %s" % name
+        getLog().warning("specified '%s' as the compress program but not available; using %s"
+                         % (codec.name, codec.fallback))
+        # levels are not portable between programs
+        codec = codecs[codec.fallback](None, threads)
+    return codec
@@ -0,0 +1,242 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import errno
+import grp
+import json
+import os
+import pwd
+import select
+import signal
+import socket
+import stat
+import struct
+import sys
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+import mockbuild.exception
+import mockbuild.util
+
+# client and daemon talk in frames (see util.sendFrame):
+#   r: the request, json {"argv": [...], "cwd": "..."}, client to daemon
+#   o, e: a chunk of the stdout, stderr of the run
+#   x: its exit status
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+_UCRED = struct.Struct("3i")
+# a client has this long to send its request, of at most this many bytes
+REQUEST_TIMEOUT = 30
+MAX_REQUEST = 1024 * 1024
+
+# classes
+class Daemon(object):
+    """accepts mock runs from 'mock --client' on a unix socket. every
+       request runs in a process forked from the daemon, so it starts out
+       with everything the daemon imported and read already in memory."""
+    decorate(traceLog())
+    def __init__(self, socketPath, gid):
+        self.socketPath = socketPath
+        self.gid = gid
+        self.sock = None
+
+    decorate(traceLog())
+    def serve(self, handler):
+        """handler(argv, uid) runs a request in its own process and returns
+           the exit status"""
+        self._listen()
+        signal.signal(signal.SIGCHLD, self._reap)
+        while True:
+            try:
+                (conn, addr) = self.sock.accept()
+            except socket.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            try:
+                (pid, uid, gid) = _UCRED.unpack(conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, _UCRED.size))
+                if not self._allowed(uid):
+                    getLog().warning("refusing request of uid %d, not in the mock group" % uid)
+                    conn.settimeout(REQUEST_TIMEOUT)
+                    mockbuild.util.sendFrame(conn, "e", "mock: you must be a member of the mock group\n")
+                    mockbuild.util.sendFrame(conn, "x", "1")
+                    continue
+                # whatever the client does from here on, it does to a
+                # process of its own
+                if os.fork() == 0:
+                    self._relay(conn, uid, pid, handler)
+            except socket.error, e:
+                getLog().warning("could not take a request: %s" % e)
+            finally:
+                conn.close()
+
+    # =============
+    # 'Private' API
+    # =============
+    decorate(traceLog())
+    def _listen(self):
+        mockbuild.util.mkdirIfAbsent(os.path.dirname(self.socketPath))
+        try:
+            if stat.S_ISSOCK(os.lstat(self.socketPath).st_mode):
+                os.unlink(self.socketPath)
+        except OSError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socketPath)
+        # the mock group may run mock, so it may talk to us
+        os.chown(self.socketPath, 0, self.gid)
+        os.chmod(self.socketPath, 0660)
+        self.sock.listen(16)
+
+    decorate(traceLog())
+    def _allowed(self, uid):
+        if uid == 0:
+            return True
+        try:
+            pw = pwd.getpwuid(uid)
+        except KeyError:
+            return False
+        return pw.pw_gid == self.gid or pw.pw_name in grp.getgrgid(self.gid).gr_mem
+
+    def _reap(self, signum, frame):
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except OSError:
+            pass
+
+    def _request(self, conn, uid, pid):
+        """the request the client sends first, None if it sends none that
+           makes sense in time"""
+        conn.settimeout(REQUEST_TIMEOUT)
+        try:
+            (tag, payload) = mockbuild.util.recvFrame(conn, MAX_REQUEST)
+            if tag != "r":
+                return None
+            request = json.loads(payload)
+            if not isinstance(request['argv'], list):
+                raise TypeError, "argv is not a list"
+            request = {'argv': [str(a) for a in request['argv']], 'cwd': str(request['cwd'])}
+        except (socket.error, ValueError, KeyError, TypeError), e:
+            getLog().warning("bad request of uid %d (pid %d): %s" % (uid, pid, e))
+            return None
+        conn.settimeout(None)
+        getLog().info("request of uid %d (pid %d): %s" % (uid, pid, " ".join(request['argv'])))
+        return request
+
+    def _relay(self, conn, uid, peer, handler):
+        """process for one request: runs it in a child and sends its output
+           back. if the client goes away, the run is interrupted as if by ^C."""
+        status = 1
+        try:
+            try:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                self.sock.close()
+                request = self._request(conn, uid, peer)
+                if request is None:
+                    return
+                (outr, outw) = os.pipe()
+                (errr, errw) = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    os.close(outr)
+                    os.close(errr)
+                    conn.close()
+                    self._run(request, uid, handler, outw, errw)
+                os.close(outw)
+                os.close(errw)
+                streams = {outr: "o", errr: "e"}
+                poller = select.poll()
+                for fd in streams.keys():
+                    poller.register(fd, select.POLLIN | select.POLLPRI)
+                poller.register(conn.fileno(), select.POLLIN)
+                interrupted = False
+                while streams:
+                    try:
+                        events = poller.poll()
+                    except select.error, e:
+                        if e[0] == errno.EINTR:
+                            continue
+                        raise
+                    for (fd, event) in events:
+                        if fd == conn.fileno():
+                            # the client never sends anything after the request
+                            poller.unregister(fd)
+                            if not interrupted:
+                                os.kill(pid, signal.SIGINT)
+                                interrupted = True
+                            continue
+                        data = os.read(fd, mockbuild.util.LOG_OUTPUT_CHUNK)
+                        if data == "":
+                            poller.unregister(fd)
+                            del streams[fd]
+                            continue
+                        if not interrupted:
+                            try:
+                                mockbuild.util.sendFrame(conn, streams[fd], data)
+                            except socket.error:
+                                os.kill(pid, signal.SIGINT)
+                                interrupted = True
+                (pid, waitstatus) = os.waitpid(pid, 0)
+                if os.WIFSIGNALED(waitstatus):
+                    status = 128 + os.WTERMSIG(waitstatus)
+                else:
+                    status = os.WEXITSTATUS(waitstatus)
+                if not interrupted:
+                    mockbuild.util.sendFrame(conn, "x", str(status))
+                status = 0
+            except:
+                pass
+        finally:
+            os._exit(status)
+
+    def _run(self, request, uid, handler, outw, errw):
+        status = 1
+        try:
+            try:
+                devnull = os.open(os.devnull, os.O_RDWR)
+                os.dup2(devnull, 0)
+                os.dup2(outw, 1)
+                os.dup2(errw, 2)
+                os.chdir(request['cwd'])
+                status = handler(request['argv'], uid)
+            except SystemExit, e:
+                status = e.code
+            except:
+                import traceback
+                traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            except:
+                pass
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                status = 1
+            os._exit(status)
+
+# functions
+decorate(traceLog())
+def client(socketPath, argv):
+    """hand argv to mock --daemon and print what comes back. returns the
+       exit status of the run."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+    except socket.error, e:
+        raise mockbuild.exception.Error, "could not connect to mock daemon at %s: %s" % (socketPath, e)
+    mockbuild.util.sendFrame(sock, "r", json.dumps({"argv": argv, "cwd": os.getcwd()}))
+    while True:
+        (tag, payload) = mockbuild.util.recvFrame(sock)
+        if tag is None:
+            raise mockbuild.exception.Error, "mock daemon closed the connection"
+        elif tag == "o":
+            sys.stdout.write(payload)
+            sys.stdout.flush()
+        elif tag == "e":
+            sys.stderr.write(payload)
+            sys.stderr.flush()
+        elif tag == "x":
+            return int(payload)
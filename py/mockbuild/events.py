@@ -0,0 +1,129 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import ctypes
+import json
+import os
+import time
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+
+# events.jsonl has one json object per line. every one of them has
+#   event: state, hook, lock, command, cache, resources or prefetch
+#   ts: seconds on the monotonic clock, for durations and ordering
+#   time: seconds since the epoch, to line the builds up with each other
+#   pid: the mock process it comes from
+# and what is particular to the event:
+#   state: state, phase (start or finish), depth; seconds on finish
+#   hook: stage, hook, seconds, ok
+#   lock: lock, shared, contended, seconds (waited)
+#   command: command, uid, gid, chroot, seconds, returncode, output_bytes
+#   cache: cache, hit
+#   resources: package and what its build used, see cgroup.Measurement
+#   prefetch: packages, bytes, seconds
+# events from before the resultdir is known are kept until it is; this
+# many of them at most.
+EARLY_EVENTS = 1000
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+# linux/time.h
+CLOCK_MONOTONIC = 1
+
+def _findClockGettime():
+    # glibc has it in libc since 2.17, in librt before
+    for name in (None, "librt.so.1"):
+        try:
+            return ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            pass
+    return None
+
+_clock_gettime = _findClockGettime()
+if _clock_gettime is not None:
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+# where the events go, and what came before it was known
+_stream = None
+_early = []
+# start times of the open states
+_states = []
+
+# functions
+def monotonic():
+    """seconds on a clock that does not jump when the system time is set"""
+    if _clock_gettime is None:
+        return time.time()
+    ts = _timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        return time.time()
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+decorate(traceLog())
+def attach(path):
+    """write events to path from now on, starting with the ones kept so far"""
+    global _stream, _early
+    detach()
+    _stream = open(path, "a")
+    for record in _early:
+        _write(record)
+    _early = []
+
+decorate(traceLog())
+def detach():
+    global _stream
+    if _stream is not None:
+        try:
+            _stream.close()
+        except IOError:
+            pass
+        _stream = None
+
+decorate(traceLog())
+def reset():
+    """forget everything so far, for a forked child that starts over"""
+    global _early, _states
+    detach()
+    _early = []
+    _states = []
+
+def emit(event, **fields):
+    fields['event'] = event
+    fields['ts'] = round(monotonic(), 6)
+    fields['time'] = round(time.time(), 6)
+    fields['pid'] = os.getpid()
+    if _stream is None:
+        if len(_early) < EARLY_EVENTS:
+            _early.append(fields)
+        return
+    _write(fields)
+
+def _write(record):
+    global _stream
+    try:
+        _stream.write(json.dumps(record, default=repr) + "\n")
+        # one complete line at a time for whoever follows the file
+        _stream.flush()
+    except IOError, e:
+        getLog().warning("could not write build events: %s" % e)
+        _stream = None
+
+def stateStarted(state):
+    _states.append(monotonic())
+    emit("state", state=state, phase="start", depth=len(_states) - 1)
+
+def stateFinished(state):
+    seconds = None
+    if _states:
+        seconds = round(monotonic() - _states.pop(), 6)
+    emit("state", state=state, phase="finish", depth=len(_states), seconds=seconds)
+
+def hookName(hook):
+    name = getattr(hook, '__name__', repr(hook))
+    owner = getattr(hook, 'im_self', None)
+    if owner is not None:
+        name = "%s.%s.%s" % (owner.__class__.__module__, owner.__class__.__name__, name)
+    return name
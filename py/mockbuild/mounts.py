@@ -2,6 +2,7 @@
 
 import os
 import os.path
+import re
 import sys
 import grp
 import subprocess
@@ -9,7 +10,88 @@ import logging
 
 import mockbuild.util
 import mockbuild.exception
-from mockbuild.trace_decorator import traceLog, decorate
+from mockbuild.trace_decorator import traceLog, decorate, getLog
+
+# filesystems the kernel mounts without the help of a /sbin/mount.<type>
+# helper; everything else is left to /bin/mount
+SYSCALL_FSTYPES = ('proc', 'sysfs', 'tmpfs', 'devpts', 'overlay', 'ramfs', 'mqueue')
+
+# mount(8) options that are mount(2) flags rather than filesystem data:
+# option -> (flag, set or clear)
+MOUNT_FLAGS = {
+    'ro':          (mockbuild.util.MS_RDONLY, True),
+    'rw':          (mockbuild.util.MS_RDONLY, False),
+    'nosuid':      (mockbuild.util.MS_NOSUID, True),
+    'suid':        (mockbuild.util.MS_NOSUID, False),
+    'nodev':       (mockbuild.util.MS_NODEV, True),
+    'dev':         (mockbuild.util.MS_NODEV, False),
+    'noexec':      (mockbuild.util.MS_NOEXEC, True),
+    'exec':        (mockbuild.util.MS_NOEXEC, False),
+    'sync':        (mockbuild.util.MS_SYNCHRONOUS, True),
+    'async':       (mockbuild.util.MS_SYNCHRONOUS, False),
+    'remount':     (mockbuild.util.MS_REMOUNT, True),
+    'mand':        (mockbuild.util.MS_MANDLOCK, True),
+    'nomand':      (mockbuild.util.MS_MANDLOCK, False),
+    'dirsync':     (mockbuild.util.MS_DIRSYNC, True),
+    'noatime':     (mockbuild.util.MS_NOATIME, True),
+    'atime':       (mockbuild.util.MS_NOATIME, False),
+    'nodiratime':  (mockbuild.util.MS_NODIRATIME, True),
+    'diratime':    (mockbuild.util.MS_NODIRATIME, False),
+    'bind':        (mockbuild.util.MS_BIND, True),
+    'rbind':       (mockbuild.util.MS_BIND | mockbuild.util.MS_REC, True),
+    'relatime':    (mockbuild.util.MS_RELATIME, True),
+    'norelatime':  (mockbuild.util.MS_RELATIME, False),
+    'strictatime': (mockbuild.util.MS_STRICTATIME, True),
+    'defaults':    (0, True),
+    }
+
+decorate(traceLog())
+def parseOptions(options):
+    """split a mount(8) option string into mount(2) flags and data"""
+    flags = 0
+    data = []
+    if options:
+        for opt in options.split(","):
+            if not opt:
+                continue
+            if MOUNT_FLAGS.has_key(opt):
+                (flag, on) = MOUNT_FLAGS[opt]
+                if on:
+                    flags |= flag
+                else:
+                    flags &= ~flag
+            else:
+                data.append(opt)
+    return (flags, ",".join(data) or None)
+
+def _unescape(field):
+    # the kernel writes space, tab, newline and backslash as \ooo
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+class MountTable(object):
+    '''one reading of /proc/mounts, indexed by mountpoint'''
+    decorate(traceLog())
+    def __init__(self):
+        # (device, mountpoint, fstype, options) in mount order
+        self.entries = []
+        self.index = {}
+        for line in open('/proc/mounts'):
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            entry = (_unescape(fields[0]), _unescape(fields[1]), fields[2], fields[3])
+            self.entries.append(entry)
+            self.index[entry[1]] = entry
+
+    decorate(traceLog())
+    def __contains__(self, path):
+        return self.index.has_key(os.path.realpath(path))
+
+    decorate(traceLog())
+    def under(self, directory):
+        '''mountpoints below directory, in the order they were mounted'''
+        prefix = os.path.realpath(directory) + "/"
+        return [ e[1] for e in self.entries if e[1].startswith(prefix) ]
 
 class MountPoint(object):
     '''base class for mounts'''
@@ -19,10 +101,23 @@ class MountPoint(object):
         self.mountsource = mountsource
 
     decorate(traceLog())
-    def ismounted(self):
-        if self.mountpath in [ x.split()[1] for x in open('/proc/mounts') ]:
+    def ismounted(self, table=None):
+        if table is None:
+            table = MountTable()
+        return self.mountpath in table
+
+    decorate(traceLog())
+    def _umount(self, flags, cmd):
+        try:
+            mockbuild.util.umount(self.mountpath, flags)
             return True
-        return False
+        except OSError, e:
+            getLog().debug("umount2() of %s failed: %s" % (self.mountpath, e))
+        try:
+            mockbuild.util.do(cmd)
+        except mockbuild.exception.Error, e:
+            return False
+        return True
 
 class FileSystemMountPoint(MountPoint):
     '''class for managing filesystem mounts in the chroot'''
@@ -42,13 +137,23 @@ class FileSystemMountPoint(MountPoint):
         self.path = path
         self.filetype = filetype
         self.options = options
-        self.mounted = self.ismounted()
+        self.mounted = False
 
     decorate(traceLog())
-    def mount(self):
-        if self.mounted:
+    def mount(self, table=None):
+        if self.mounted or self.ismounted(table):
+            self.mounted = True
             return
 
+        if self.filetype in SYSCALL_FSTYPES:
+            (flags, data) = parseOptions(self.options)
+            try:
+                mockbuild.util.mount(self.device, self.path, self.filetype, flags, data)
+                self.mounted = True
+                return True
+            except OSError, e:
+                getLog().debug("mount() of %s failed: %s" % (self.path, e))
+
         cmd = ['/bin/mount', '-n', '-t', self.filetype ]
         if self.options:
             cmd += ['-o', self.options ]
@@ -61,13 +166,10 @@ class FileSystemMountPoint(MountPoint):
         return True
 
     decorate(traceLog())
-    def umount(self, force=False, nowarn=False):
-        if not self.mounted:
+    def umount(self, force=False, nowarn=False, table=None):
+        if not self.mounted and not self.ismounted(table):
             return
-        cmd = ['/bin/umount', '-n', '-l', self.path]
-        try:
-            mockbuild.util.do(cmd)
-        except mockbuild.exception.Error, e:
+        if not self._umount(mockbuild.util.MNT_DETACH, ['/bin/umount', '-n', '-l', self.path]):
             return False
         self.mounted = False
         return True
@@ -79,27 +181,28 @@ class BindMountPoint(MountPoint):
         MountPoint.__init__(self, mountsource=srcpath, mountpath=bindpath)
         self.srcpath = srcpath
         self.bindpath = bindpath
-        self.mounted = self.ismounted()
+        self.mounted = False
 
     decorate(traceLog())
-    def mount(self):
-        if not self.mounted:
-            cmd = ['/bin/mount', '-n',
-                   '--bind', self.srcpath, self.bindpath ]
+    def mount(self, table=None):
+        if not self.mounted and not self.ismounted(table):
             try:
-                mockbuild.util.do(cmd)
-            except mockbuild.exception.Error, e:
-                return False
+                mockbuild.util.mount(self.srcpath, self.bindpath, None, mockbuild.util.MS_BIND)
+            except OSError, e:
+                getLog().debug("mount() of %s failed: %s" % (self.bindpath, e))
+                cmd = ['/bin/mount', '-n',
+                       '--bind', self.srcpath, self.bindpath ]
+                try:
+                    mockbuild.util.do(cmd)
+                except mockbuild.exception.Error, e:
+                    return False
         self.mounted = True
         return True
 
     decorate(traceLog())
-    def umount(self):
-        if self.mounted:
-            cmd = ['/bin/umount', '-n', self.bindpath ]
-            try:
-                mockbuild.util.do(cmd)
-            except mockbuild.exception.Error, e:
+    def umount(self, table=None):
+        if self.mounted or self.ismounted(table):
+            if not self._umount(0, ['/bin/umount', '-n', self.bindpath ]):
                 return False
         self.mounted = False
         return True
@@ -109,6 +212,9 @@ class Mounts(object):
     decorate(traceLog())
     def __init__(self, rootObj):
         self.rootObj = rootObj
+        # mounts that make up the chroot itself (eg. overlayfs). These are
+        # mounted before, and outlive, all of the mounts below.
+        self.rootmounts = []
         self.mounts = [ FileSystemMountPoint(filetype='proc', device='mock_chroot_proc', path=rootObj.makeChrootPath('/proc')),
                         FileSystemMountPoint(filetype='sysfs', device='mock_chroot_sys', path=rootObj.makeChrootPath('/sys')),
                         FileSystemMountPoint(filetype='tmpfs', device='mock_chroot_shmfs', path=rootObj.makeChrootPath('/dev/shm')),
@@ -122,19 +228,44 @@ class Mounts(object):
     def add(self, mount):
         self.mounts.append(mount)
 
+    decorate(traceLog())
+    def add_root(self, mount):
+        self.rootmounts.append(mount)
+
+    decorate(traceLog())
+    def mountroot(self):
+        if not self.rootmounts:
+            return
+        table = MountTable()
+        for m in self.rootmounts:
+            m.mount(table=table)
+
+    decorate(traceLog())
+    def umountroot(self):
+        if not self.rootmounts:
+            return
+        table = MountTable()
+        for m in reversed(self.rootmounts):
+            m.umount(table=table)
+
     decorate(traceLog())
     def mountall(self):
+        self.mountroot()
+        # read after mountroot, which changes what is visible in the chroot
+        table = MountTable()
         for m  in self.mounts:
-            m.mount()
+            m.mount(table=table)
 
     decorate(traceLog())
     def umountall(self, force=False, nowarn=False):
+        table = MountTable()
         for m in reversed(self.mounts):
-            m.umount()
+            m.umount(table=table)
 
     decorate(traceLog())
     def get_mounted(self):
-        return [ m.mountpath for m in self.mounts if m.ismounted() ]
+        table = MountTable()
+        return [ m.mountpath for m in self.mounts if m.ismounted(table) ]
 
     decorate(traceLog())
     def get_mountpoints(self):
@@ -0,0 +1,156 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import hashlib
+import os
+import time
+from glob import glob
+
+import rpm
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+import mockbuild.util
+import mockbuild.compress
+
+requires_api_version = "1.0"
+
+# plugin entry point
+decorate(traceLog())
+def init(rootObj, conf):
+    BuildDepCache(rootObj, conf)
+
+# classes
+class BuildDepCache(object):
+    """caches the chroot with the build dependencies of an srpm installed"""
+    decorate(traceLog())
+    def __init__(self, rootObj, conf):
+        self.rootObj = rootObj
+        self.builddep_cache_opts = conf
+        self.builddepCachePath = self.builddep_cache_opts['dir'] % self.builddep_cache_opts
+        self.codec = mockbuild.compress.getCodec(self.builddep_cache_opts['compress_program'])
+        self.compressArgs = self.codec.tarArgs()
+        self.exclude_dirs = self.builddep_cache_opts['exclude_dirs']
+        self.cacheKey = None
+        rootObj.builddepCacheObj = self
+        rootObj.addHook("preinstalldeps", self._builddepCachePreInstallDepsHook)
+        rootObj.addHook("postinstalldeps", self._builddepCachePostInstallDepsHook)
+
+    # =============
+    # 'Private' API
+    # =============
+    decorate(traceLog())
+    def _builddepCacheKey(self):
+        """the base chroot plus everything that decides what builddep installs"""
+        h = hashlib.sha1()
+        rootCache = getattr(self.rootObj, 'rootCacheObj', None)
+        if rootCache is not None:
+            h.update(rootCache.cacheKey)
+        else:
+            h.update(self.rootObj.yum_conf_content)
+        # the chroot may have been updated since the root cache was made
+        installed = self.rootObj.doChroot(["rpm", "-qa"], shell=False, returnOutput=1)
+        h.update("\n".join(sorted(installed.split())))
+        deps = list(self.rootObj.preExistingDeps)
+        for hdr in mockbuild.util.yieldSrpmHeaders(self.rootObj.depsSrpms, plainRpmOk=1):
+            reqs = zip(*[self._tagList(hdr, tag) for tag in
+                         (rpm.RPMTAG_REQUIRENAME, rpm.RPMTAG_REQUIREFLAGS, rpm.RPMTAG_REQUIREVERSION)])
+            deps.extend(["%s %s %s" % r for r in reqs])
+            deps.extend(mockbuild.util.getAddtlReqs(hdr, self.rootObj.more_buildreqs))
+        h.update("\n".join(sorted(deps)))
+        return h.hexdigest()
+
+    decorate(traceLog())
+    def _tagList(self, hdr, tag):
+        # older rpm-python hands back single element arrays as scalars
+        value = hdr[tag]
+        if value is None:
+            return []
+        if not isinstance(value, list):
+            return [value]
+        return value
+
+    decorate(traceLog())
+    def _builddepCacheFile(self):
+        return os.path.join(self.builddepCachePath, self.cacheKey + ".tar" + self.codec.extension)
+
+    decorate(traceLog())
+    def _builddepCachePreInstallDepsHook(self):
+        mockbuild.util.mkdirIfAbsent(self.builddepCachePath)
+        self.cacheKey = self._builddepCacheKey()
+        cachefile = self._builddepCacheFile()
+        try:
+            age = (time.time() - os.stat(cachefile).st_mtime) / (60 * 60 * 24)
+        except OSError:
+            getLog().info("build dependencies not cached")
+            return
+        if age > float(self.builddep_cache_opts['max_age_days']):
+            getLog().info("cached build dependencies aged out")
+            os.unlink(cachefile)
+            return
+
+        self.rootObj.start("unpacking build dependency cache")
+        mockbuild.util.do(
+            ["tar"] + self.compressArgs + ["-xf", cachefile, "-C", self.rootObj.makeChrootPath()],
+            shell=False
+            )
+        # atime marks the last use for eviction; mtime keeps the creation time
+        os.utime(cachefile, (time.time(), os.stat(cachefile).st_mtime))
+        self.rootObj.depsWereCached = True
+        self.rootObj.finish("unpacking build dependency cache")
+
+    decorate(traceLog())
+    def _builddepCachePostInstallDepsHook(self):
+        excludes = ["--exclude=" + d for d in self.exclude_dirs]
+        # the srpm being built lives in the home dir
+        excludes.append("--exclude=." + self.rootObj.homedir)
+        for m in self.rootObj.mounts.get_mountpoints():
+            excludes.append("--exclude=." + m.replace(self.rootObj.makeChrootPath(), '', 1))
+
+        cachefile = self._builddepCacheFile()
+        tmp = "%s.tmp.%d" % (cachefile, os.getpid())
+        self.rootObj.start("creating build dependency cache")
+        try:
+            mockbuild.util.do(["sync"], shell=False)
+            mockbuild.util.do(
+                ["tar", "--one-file-system"] + self.compressArgs + ["-cf", tmp,
+                 "-C", self.rootObj.makeChrootPath()] + excludes + ["."],
+                shell=False
+                )
+            os.rename(tmp, cachefile)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.rootObj.finish("creating build dependency cache")
+        self._builddepCacheEvict()
+
+    decorate(traceLog())
+    def _builddepCacheEvict(self):
+        """drop the least recently used entries until the cache fits"""
+        entries = []
+        total = 0
+        for f in glob(os.path.join(self.builddepCachePath, "*.tar*")):
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            if ".tmp." in f:
+                # leftover of a packer that died a day ago
+                if time.time() - st.st_mtime > 60 * 60 * 24:
+                    os.unlink(f)
+                continue
+            entries.append((st.st_atime, st.st_size, f))
+            total += st.st_size
+        entries.sort()
+        limit = int(self.builddep_cache_opts['max_size_mb']) * 1024 * 1024
+        for (atime, size, f) in entries:
+            if total <= limit:
+                break
+            getLog().info("evicting build dependency cache %s" % os.path.basename(f))
+            try:
+                os.unlink(f)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,379 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import errno
+import hashlib
+import httplib
+import json
+import os
+import Queue
+import socket
+import sys
+import threading
+import traceback
+import urllib
+import urllib2
+import urlparse
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+import mockbuild.events
+
+requires_api_version = "1.0"
+
+# yum commands whose packages are worth fetching ahead of yum
+PREFETCH_COMMANDS = ("install", "groupinstall", "update", "builddep")
+
+# downloads in flight, named like those of the mock_cache yum plugin so that
+# the yum cache prune removes them if we die
+TMP_SUFFIX = ".mocktmp"
+
+CHUNK_SIZE = 256 * 1024
+
+# redirects followed for one download
+MAX_REDIRECTS = 5
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+
+# repositories with these set want TLS done in a way of their own (a CA,
+# a client certificate, no verification), which is left to yum
+REPO_TLS_OPTIONS = ("sslcacert", "sslclientcert", "sslclientkey")
+
+# plugin entry point
+decorate(traceLog())
+def init(rootObj, conf):
+    Prefetch(rootObj, conf)
+
+# classes
+class Prefetch(object):
+    """downloads the packages of a yum transaction into the yum cache with
+       several connections at once, before yum gets to download them one
+       after the other. the transaction is resolved with the yum API in a
+       child process, against the chroot's yum.conf and cache."""
+    decorate(traceLog())
+    def __init__(self, rootObj, conf):
+        self.rootObj = rootObj
+        self.prefetch_opts = conf
+        self.threads = self.prefetch_opts['threads']
+        self.timeout = self.prefetch_opts['timeout']
+        rootObj.prefetchObj = self
+        rootObj.addHook("preyum", self._prefetchPreYumHook)
+
+    # =============
+    # 'Public' API
+    # =============
+    decorate(traceLog())
+    def prefetch(self, cmd):
+        """fetch what yum cmd would download. returns (packages, bytes)
+           fetched."""
+        packages = [p for p in self._resolve(cmd)
+                    if not os.path.exists(p['path']) and not self._stored(p)]
+        if not packages:
+            return (0, 0)
+        yumCache = getattr(self.rootObj, 'yum_cacheObj', None)
+        if yumCache is not None:
+            for p in packages:
+                p['path'] = yumCache.hostPath(p['path'])
+            yumCache.lockShared()
+        try:
+            return self.download(packages)
+        finally:
+            if yumCache is not None:
+                yumCache.unlockShared()
+
+    decorate(traceLog())
+    def download(self, packages):
+        """download packages (dicts of path, urls, sumtype, checksum and
+           proxy) with a pool of threads. returns (packages, bytes)."""
+        queue = Queue.Queue()
+        for p in packages:
+            queue.put(p)
+        fetchers = [_Fetcher(queue, self.timeout) for i in range(min(self.threads, len(packages)))]
+        for fetcher in fetchers:
+            fetcher.start()
+        for fetcher in fetchers:
+            fetcher.join()
+        fetched = sum([f.fetched for f in fetchers])
+        size = sum([f.bytes for f in fetchers])
+        for fetcher in fetchers:
+            for (package, error) in fetcher.failed:
+                getLog().debug("could not prefetch %s: %s" % (package['path'], error))
+        return (fetched, size)
+
+    # =============
+    # 'Private' API
+    # =============
+    decorate(traceLog())
+    def _prefetchPreYumHook(self):
+        cmd = self.rootObj.yumCmd
+        if not self.rootObj.online or not cmd or cmd[0] not in PREFETCH_COMMANDS:
+            return
+        self.rootObj.start("prefetching packages")
+        started = mockbuild.events.monotonic()
+        try:
+            try:
+                (fetched, size) = self.prefetch(cmd)
+            except (OSError, IOError, ValueError), e:
+                # yum downloads what we could not
+                getLog().warning("prefetching packages failed: %s" % e)
+                return
+            seconds = mockbuild.events.monotonic() - started
+            if fetched:
+                getLog().info("prefetched %d packages, %.1f MB in %.1f seconds"
+                              % (fetched, size / 1048576.0, seconds))
+            mockbuild.events.emit("prefetch", packages=fetched, bytes=size,
+                                  seconds=round(seconds, 6))
+        finally:
+            self.rootObj.finish("prefetching packages")
+
+    decorate(traceLog())
+    def _resolve(self, cmd):
+        """the packages yum would download for cmd, as yum sees them"""
+        (readFd, writeFd) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # yum wants to be alone in its process; it gets a fresh one
+            status = 1
+            try:
+                try:
+                    os.close(readFd)
+                    result = json.dumps(_resolveTransaction(self.rootObj.makeChrootPath(), cmd))
+                    while result:
+                        result = result[os.write(writeFd, result):]
+                    status = 0
+                except:
+                    traceback.print_exc()
+            finally:
+                os._exit(status)
+        os.close(writeFd)
+        output = []
+        try:
+            while True:
+                data = os.read(readFd, 65536)
+                if not data:
+                    break
+                output.append(data)
+        finally:
+            os.close(readFd)
+            (pid, status) = os.waitpid(pid, 0)
+        if status != 0:
+            raise OSError, "resolving the transaction failed (status %d)" % status
+        return json.loads("".join(output))
+
+    decorate(traceLog())
+    def _stored(self, package):
+        """whether the package store of yum_cache has it, to be linked in
+           by yum"""
+        yumCache = getattr(self.rootObj, 'yum_cacheObj', None)
+        if yumCache is None or not yumCache.sharedLocking or not yumCache.packageStore \
+                or not package['checksum']:
+            return False
+        # the sums mock_cache keeps packages in the store by
+        if package['sumtype'] not in ("sha256", "sha384", "sha512"):
+            return False
+        return os.path.exists(os.path.join(yumCache.packageStore, package['sumtype'],
+                                           package['checksum'][:2], package['checksum'] + ".rpm"))
+
+class _Fetcher(threading.Thread):
+    """takes packages off the queue until there are no more, reusing its
+       connection to each server"""
+    def __init__(self, queue, timeout):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.timeout = timeout
+        self.connections = {}
+        self.fetched = 0
+        self.bytes = 0
+        self.failed = []
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    package = self.queue.get_nowait()
+                except Queue.Empty:
+                    return
+                error = None
+                for url in package['urls']:
+                    try:
+                        self.bytes += self.fetch(url, package)
+                        self.fetched += 1
+                        error = None
+                        break
+                    except (IOError, OSError, httplib.HTTPException, socket.error, ValueError), e:
+                        error = "%s: %s" % (url, e)
+                if error is not None:
+                    self.failed.append((package, error))
+        finally:
+            for connection in self.connections.values():
+                connection.close()
+
+    def fetch(self, url, package):
+        """download url to package['path'] through a file of its own,
+           checking it against the checksum from the repository metadata"""
+        path = package['path']
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        tmp = "%s.%d%s" % (path, os.getpid(), TMP_SUFFIX)
+        digest = None
+        if package['sumtype']:
+            sumtype = package['sumtype']
+            if sumtype == "sha":
+                sumtype = "sha1"
+            digest = hashlib.new(sumtype)
+        out = open(tmp, "wb")
+        try:
+            try:
+                size = self._copy(url, package.get('proxy'), out, digest)
+            finally:
+                out.close()
+            if digest is not None and digest.hexdigest() != package['checksum']:
+                raise IOError, "checksum mismatch"
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return size
+
+    def _copy(self, url, proxy, out, digest, redirects=MAX_REDIRECTS):
+        (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(url)
+        if scheme == "file":
+            source = open(urllib.unquote(path), "rb")
+        elif scheme in ("http", "https") and not proxy and not os.environ.get("%s_proxy" % scheme):
+            (size, location) = self._copyHttp(scheme, netloc, urlparse.urlunparse(("", "", path, params, query, "")),
+                                              out, digest)
+            if location is None:
+                return size
+            location = urlparse.urljoin(url, location)
+            # mirrors send us on to another server, never off the web
+            if redirects == 0 or urlparse.urlparse(location)[0] not in ("http", "https"):
+                raise IOError, "not following the redirect to %s" % location
+            return self._copy(location, proxy, out, digest, redirects - 1)
+        else:
+            # urllib2 follows redirects itself
+            handlers = []
+            if proxy:
+                handlers.append(urllib2.ProxyHandler({scheme: proxy}))
+            source = urllib2.build_opener(*handlers).open(url, timeout=self.timeout)
+        try:
+            return self._stream(source, out, digest)
+        finally:
+            source.close()
+
+    def _copyHttp(self, scheme, netloc, path, out, digest):
+        """GET path over a kept connection to netloc. returns (bytes, None),
+           or (0, location) to follow a redirect."""
+        key = (scheme, netloc)
+        for attempt in (1, 2):
+            connection = self.connections.get(key)
+            reused = connection is not None
+            if connection is None:
+                if scheme == "https":
+                    connection = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+                else:
+                    connection = httplib.HTTPConnection(netloc, timeout=self.timeout)
+                self.connections[key] = connection
+            try:
+                connection.request("GET", path, headers={"User-Agent": "mock-prefetch"})
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                del self.connections[key]
+                # the server may have closed a connection we kept around
+                if reused and attempt == 1:
+                    continue
+                raise
+            try:
+                if response.status in REDIRECT_STATUS and response.getheader("location"):
+                    response.read()
+                    return (0, response.getheader("location"))
+                if response.status != 200:
+                    response.read()
+                    raise IOError, "HTTP %d %s" % (response.status, response.reason)
+                out.seek(0)
+                out.truncate()
+                return (self._stream(response, out, digest), None)
+            finally:
+                if response.will_close or not response.isclosed():
+                    connection.close()
+                    del self.connections[key]
+
+    def _stream(self, source, out, digest):
+        size = 0
+        while True:
+            data = source.read(CHUNK_SIZE)
+            if not data:
+                break
+            out.write(data)
+            if digest is not None:
+                digest.update(data)
+            size += len(data)
+        return size
+
+# functions
+def _resolveTransaction(installroot, cmd):
+    """resolve yum cmd in installroot, in a process of its own. returns
+       the packages the transaction would download, as dicts of path,
+       urls, sumtype, checksum and proxy."""
+    import yum
+    import yum.Errors
+    import yum.misc
+    import yum.packages
+
+    base = yum.YumBase()
+    base.preconf.fn = os.path.join(installroot, "etc", "yum", "yum.conf")
+    base.preconf.root = installroot
+    base.preconf.init_plugins = True
+    base.preconf.debuglevel = 0
+    base.preconf.errorlevel = 0
+    base.conf
+
+    command = cmd[0]
+    args = [a for a in cmd[1:] if not a.startswith("-")]
+    if command == "update":
+        base.update()
+    for arg in args:
+        try:
+            if command == "groupinstall" or arg.startswith("@"):
+                base.selectGroup(arg.lstrip("@"))
+            elif command == "builddep":
+                srpm = yum.packages.YumLocalPackage(base.ts, arg)
+                for req in srpm.requires:
+                    if req[0].startswith("rpmlib("):
+                        continue
+                    base.install(po=base.returnPackageByDep(yum.misc.prco_tuple_to_string(req)))
+            elif command == "install" and arg.endswith(".rpm") and os.path.exists(arg):
+                base.installLocal(arg)
+            elif command == "install":
+                base.install(pattern=arg)
+        except yum.Errors.YumBaseError, e:
+            # yum will tell, if it matters
+            print >>sys.stderr, "prefetch: %s: %s" % (arg, e)
+    (result, messages) = base.buildTransaction()
+
+    packages = []
+    for txmbr in base.tsInfo.getMembers():
+        po = txmbr.po
+        if txmbr.ts_state not in ("i", "u") or getattr(po, "pkgtype", None) == "local":
+            continue
+        if not hasattr(po, "repo") or not hasattr(po.repo, "urls"):
+            continue
+        if [o for o in REPO_TLS_OPTIONS if getattr(po.repo, o, None)] \
+                or not getattr(po.repo, "sslverify", True):
+            continue
+        (sumtype, checksum) = po.returnIdSum()
+        packages.append({
+            'path': po.localPkg(),
+            'urls': [u.rstrip("/") + "/" + po.relativepath for u in po.repo.urls],
+            'sumtype': sumtype,
+            'checksum': checksum,
+            'proxy': getattr(po.repo, "proxy", None),
+            })
+    base.close()
+    return packages
@@ -5,13 +5,25 @@
 
 # python library imports
 import fcntl
+import hashlib
+import json
+import logging
 import os
+import resource
+import shutil
+import subprocess
+import sys
 import time
+import traceback
 from glob import glob
 
 # our imports
 from mockbuild.trace_decorator import decorate, traceLog, getLog
 import mockbuild.util
+import mockbuild.compress
+import mockbuild.events
+import mockbuild.exception
+from mockbuild.mounts import FileSystemMountPoint
 
 requires_api_version = "1.0"
 
@@ -29,37 +41,232 @@ class RootCache(object):
     def __init__(self, rootObj, conf):
         self.rootObj = rootObj
         self.root_cache_opts = conf
-        self.rootSharedCachePath = self.root_cache_opts['dir'] % self.root_cache_opts
-        self.rootCacheFile = os.path.join(self.rootSharedCachePath, "cache.tar")
+        # each distinct chroot configuration gets its own cache dir so that
+        # several variants can be kept side by side.
+        self.rootCacheTopPath = self.root_cache_opts['dir'] % self.root_cache_opts
+        self.cacheKeyInputs = self._rootCacheKeyInputs()
+        self.cacheKey = hashlib.sha1(self._rootCacheSerialize(self.cacheKeyInputs)).hexdigest()
+        self.rootSharedCachePath = os.path.join(self.rootCacheTopPath, self.cacheKey)
         self.rootCacheLock = None
-        self.compressProgram = self.root_cache_opts['compress_program']
-        if self.compressProgram == 'pigz' and not os.path.exists('/usr/bin/pigz'):
-            getLog().warning("specified 'pigz' as the root cache compress program but not available; using gzip")
-            self.compressProgram = 'gzip'
-        if self.compressProgram:
-             self.compressArgs = ['--use-compress-program', self.compressProgram]
-             self.rootCacheFile = self.rootCacheFile + self.root_cache_opts['extension']
-        else:
-             self.compressArgs = []
+        self.codec = mockbuild.compress.getCodec(self.root_cache_opts['compress_program'],
+                                                 level=self.root_cache_opts.get('compress_level'),
+                                                 threads=self.root_cache_opts.get('compress_threads'))
+        self.compressArgs = self.codec.tarArgs()
+        extension = self.root_cache_opts.get('extension')
+        if extension is None:
+            extension = self.codec.extension
+        self.rootCacheFile = os.path.join(self.rootSharedCachePath, "cache.tar" + extension)
         rootObj.rootCacheObj = self
         rootObj.addHook("preinit", self._rootCachePreInitHook)
         rootObj.addHook("postinit", self._rootCachePostInitHook)
+        rootObj.addHook("preyum", self._rootCachePreYumHook)
+        self.refreshing = False
+        self.refreshPackages = None
+        self.cacheLogContent = ""
         self.exclude_dirs = self.root_cache_opts['exclude_dirs']
         self.exclude_tar_cmds = [ "--exclude=" + dir for dir in self.exclude_dirs]
 
+        # overlayfs backend: the cache is unpacked once into a shared lower
+        # dir and each chroot is an overlay with its own upper dir.
+        self.backend = self.root_cache_opts['backend']
+        self.overlayPath = os.path.join(self.rootSharedCachePath, "overlay")
+        self.overlayStatePath = os.path.join(self.rootObj.basedir, "overlay")
+        self.overlayMount = None
+        if self.backend == 'overlayfs' and not self._overlayfsUsable():
+            self.backend = 'tar'
+        # clone backends: the cache is unpacked once into a golden tree and
+        # each chroot is a reflinked copy or btrfs snapshot of it. whether
+        # the filesystem can do that is only known once the dirs exist.
+        self.clonePath = os.path.join(self.rootSharedCachePath, "clone")
+        self.backendResolved = self.backend not in ('auto', 'reflink', 'btrfs')
+        rootObj.addHook("clean", self._rootCacheCleanHook)
+        if self.backend == 'overlayfs':
+            rootObj.addHook("preshell", self._rootCacheMountRoot)
+            rootObj.addHook("prechroot", self._rootCacheMountRoot)
+            # reattach to an overlay chroot set up by a previous run
+            statefile = os.path.join(self.overlayStatePath, "lowerdir")
+            if os.path.exists(statefile):
+                lower = open(statefile).read().strip()
+                if os.path.isdir(lower):
+                    self._rootCacheAddOverlay(lower)
+                else:
+                    getLog().warning("root cache overlay lower dir %s is gone" % lower)
+
+    # =============
+    #  'Public' API
+    # =============
+    decorate(traceLog())
+    def benchmark(self, names=None):
+        """pack and unpack the current chroot with each codec. returns a
+           list of (codec, size, pack wall, pack cpu, unpack wall, unpack cpu)"""
+        if names is None:
+            names = sorted(mockbuild.compress.codecs.keys())
+        self._root_cache_handle_mounts()
+        benchdir = os.path.join(self.rootSharedCachePath, "bench")
+        unpackdir = os.path.join(benchdir, "root")
+        results = []
+        mockbuild.util.mkdirIfAbsent(benchdir)
+        try:
+            mockbuild.util.do(["sync"], shell=False)
+            for name in names:
+                # the configured level only makes sense for the configured codec
+                level = None
+                if name == self.codec.name:
+                    level = self.codec.level
+                codec = mockbuild.compress.codecs[name](level, self.root_cache_opts.get('compress_threads'))
+                if not codec.available():
+                    getLog().warning("%s not available, skipping" % name)
+                    continue
+                tarball = os.path.join(benchdir, "cache.tar" + codec.extension)
+                self.rootObj.start("benchmarking %s" % name)
+                (packWall, packCpu) = self._timed(
+                    self._rootCachePackCmd(codec.tarArgs(), tarball, self.rootObj.makeChrootPath()))
+                size = os.path.getsize(tarball)
+                mockbuild.util.mkdirIfAbsent(unpackdir)
+                (unpackWall, unpackCpu) = self._timed(
+                    ["tar"] + codec.tarArgs() + ["-xf", tarball, "-C", unpackdir])
+                mockbuild.util.rmtree(unpackdir, selinux=self.rootObj.selinux)
+                os.unlink(tarball)
+                self.rootObj.finish("benchmarking %s" % name)
+                results.append((name, size, packWall, packCpu, unpackWall, unpackCpu))
+        finally:
+            mockbuild.util.rmtree(benchdir, selinux=self.rootObj.selinux)
+        return results
+
+    decorate(traceLog())
+    def benchmarkBackends(self):
+        """materialise and remove a copy of the current chroot with each
+           backend the filesystem supports. returns a list of
+           (backend, create wall, remove wall)"""
+        self._root_cache_handle_mounts()
+        benchdir = os.path.join(self.rootSharedCachePath, "bench")
+        tarball = os.path.join(benchdir, "cache.tar" + self.codec.extension)
+        golden = os.path.join(benchdir, "golden")
+        clone = os.path.join(benchdir, "clone")
+        results = []
+        mockbuild.util.mkdirIfAbsent(benchdir)
+        try:
+            mockbuild.util.do(["sync"], shell=False)
+            self._timed(self._rootCachePackCmd(self.compressArgs, tarball, self.rootObj.makeChrootPath()))
+
+            self.rootObj.start("benchmarking tar backend")
+            mockbuild.util.mkdirIfAbsent(clone)
+            (create, cpu) = self._timed(["tar"] + self.compressArgs + ["-xf", tarball, "-C", clone])
+            start = time.time()
+            mockbuild.util.rmtree(clone, selinux=self.rootObj.selinux)
+            results.append(('tar', create, time.time() - start))
+            self.rootObj.finish("benchmarking tar backend")
+
+            for backend in ('reflink', 'btrfs', 'overlayfs'):
+                if backend == 'overlayfs':
+                    if not self._overlayfsListed():
+                        continue
+                elif not self._cloneUsable(backend, benchdir):
+                    continue
+                self.rootObj.start("benchmarking %s backend" % backend)
+                if backend == 'btrfs':
+                    mockbuild.util.do(["btrfs", "subvolume", "create", golden], shell=False)
+                else:
+                    mockbuild.util.mkdirIfAbsent(golden)
+                mockbuild.util.do(["tar"] + self.compressArgs + ["-xf", tarball, "-C", golden], shell=False)
+                mockbuild.util.do(["sync"], shell=False)
+                start = time.time()
+                if backend == 'overlayfs':
+                    upper = os.path.join(benchdir, "upper")
+                    work = os.path.join(benchdir, "work")
+                    mockbuild.util.mkdirIfAbsent(clone, upper, work)
+                    mount = FileSystemMountPoint(filetype='overlay', device='mock_bench_overlay', path=clone,
+                                                 options="lowerdir=%s,upperdir=%s,workdir=%s" % (golden, upper, work))
+                    if not mount.mount():
+                        getLog().warning("could not mount an overlay, skipping overlayfs")
+                        for d in (clone, upper, work, golden):
+                            mockbuild.util.rmtree(d, selinux=self.rootObj.selinux)
+                        self.rootObj.finish("benchmarking %s backend" % backend)
+                        continue
+                    create = time.time() - start
+                    start = time.time()
+                    mount.umount()
+                    for d in (clone, upper, work):
+                        mockbuild.util.rmtree(d, selinux=self.rootObj.selinux)
+                else:
+                    self._rootCacheClone(golden, clone, backend)
+                    create = time.time() - start
+                    start = time.time()
+                    self._rootCacheRemoveTree(clone)
+                results.append((backend, create, time.time() - start))
+                self._rootCacheRemoveTree(golden)
+                self.rootObj.finish("benchmarking %s backend" % backend)
+        finally:
+            for tree in (clone, golden):
+                if os.path.exists(tree):
+                    self._rootCacheRemoveTree(tree)
+            mockbuild.util.rmtree(benchdir, selinux=self.rootObj.selinux)
+        return results
+
     # =============
     # 'Private' API
     # =============
+    decorate(traceLog())
+    def _timed(self, cmd):
+        """run cmd, return (wall, cpu) seconds spent in it and its children"""
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        mockbuild.util.do(cmd, shell=False)
+        wall = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+        return (wall, cpu)
+
+    decorate(traceLog())
+    def _rootCachePackCmd(self, compressArgs, tarball, srcdir):
+        return ["tar", "--one-file-system"] + compressArgs + ["-cf", tarball, "-C", srcdir] + \
+               self.exclude_tar_cmds + ["."]
+
+    decorate(traceLog())
+    def _rootCacheKeyInputs(self):
+        """everything that shapes the contents of a freshly initialized chroot"""
+        inputs = self.rootObj.chrootConfigInputs()
+        del inputs['plugin_conf']['root_cache_opts']
+        return inputs
+
+    decorate(traceLog())
+    def _rootCacheSerialize(self, inputs):
+        return json.dumps(inputs, sort_keys=True, indent=1, default=repr)
+
+    decorate(traceLog())
+    def _overlayfsUsable(self):
+        if self.rootObj.pluginConf.get('tmpfs_enable'):
+            getLog().warning("root cache overlayfs backend cannot be combined with the tmpfs plugin; using tar")
+            return False
+        if not self._overlayfsListed():
+            mockbuild.util.do(["/sbin/modprobe", "overlay"], shell=False, raiseExc=False)
+        if not self._overlayfsListed():
+            getLog().warning("overlayfs not supported by the running kernel; using tar for the root cache")
+            return False
+        return True
+
+    decorate(traceLog())
+    def _overlayfsListed(self):
+        for line in open("/proc/filesystems"):
+            if line.split()[-1] == "overlay":
+                return True
+        return False
+
     decorate(traceLog())
     def _rootCacheLock(self, shared=1):
         lockType = fcntl.LOCK_EX
         if shared: lockType = fcntl.LOCK_SH
+        started = mockbuild.events.monotonic()
+        contended = False
         try:
             fcntl.lockf(self.rootCacheLock.fileno(), lockType | fcntl.LOCK_NB)
         except IOError, e:
+            contended = True
             self.rootObj.start("Waiting for rootcache lock")
             fcntl.lockf(self.rootCacheLock.fileno(), lockType)
             self.rootObj.finish("Waiting for rootcache lock")
+        mockbuild.events.emit("lock", lock="rootcache", shared=bool(shared), contended=contended,
+                              seconds=round(mockbuild.events.monotonic() - started, 6))
 
     decorate(traceLog())
     def _rootCacheUnlock(self):
@@ -73,26 +280,31 @@ class RootCache(object):
         if self.rootCacheLock is None:
             self.rootCacheLock = open(os.path.join(self.rootSharedCachePath, "rootcache.lock"), "a+")
 
-        # check cache status
+        # check cache status. config changes select a different cache dir,
+        # so only the age of the cache matters here.
+        self.refreshing = False
         try:
-            # see if it aged out
-            statinfo = os.stat(self.rootCacheFile)
-            file_age_days = (time.time() - statinfo.st_ctime) / (60 * 60 * 24)
-            if file_age_days > self.root_cache_opts['max_age_days']:
-                getLog().info("root cache aged out! cache will be rebuilt")
-                os.unlink(self.rootCacheFile)
-            else:
-                # make sure no config file is newer than the cache file
-                for cfg in self.rootObj.configs:
-                    if os.stat(cfg).st_mtime > statinfo.st_mtime:
-                        getLog().info("%s newer than root cache; cache will be rebuilt" % cfg)
-                        os.unlink(self.rootCacheFile)
-                        break
+            if self._rootCacheAge(self.rootCacheFile) > self.root_cache_opts['max_age_days']:
+                if not self.root_cache_opts['refresh']:
+                    getLog().info("root cache aged out! cache will be rebuilt")
+                    os.unlink(self.rootCacheFile)
+                elif self.rootObj.chrootWasCleaned:
+                    # the cached chroot gets a yum update in init anyway;
+                    # repack it afterwards unless too much changed.
+                    getLog().info("root cache aged out! cache will be refreshed")
+                    self.refreshing = True
         except OSError:
             pass
+        self._rootCachePruneVariants()
+        self._rootCacheCleanStalePacks()
 
+        self._rootCacheResolveBackend()
+        if self.backend == 'overlayfs':
+            self._rootCacheOverlayPreInit()
+        elif self.backend in ('reflink', 'btrfs'):
+            self._rootCacheClonePreInit()
         # optimization: don't unpack root cache if chroot was not cleaned
-        if os.path.exists(self.rootCacheFile) and self.rootObj.chrootWasCleaned:
+        elif os.path.exists(self.rootCacheFile) and self.rootObj.chrootWasCleaned:
             self.rootObj.start("unpacking root cache")
             self._rootCacheLock()
             mockbuild.util.do(
@@ -106,48 +318,542 @@ class RootCache(object):
             self.rootObj.chrootWasCached = True
             self.rootObj.finish("unpacking root cache")
 
+    decorate(traceLog())
+    def _rootCacheResolveBackend(self):
+        if self.backendResolved:
+            return
+        self.backendResolved = True
+        wanted = self.backend
+        if self.rootObj.pluginConf.get('tmpfs_enable'):
+            if wanted != 'auto':
+                getLog().warning("root cache %s backend cannot be combined with the tmpfs plugin; using tar" % wanted)
+            self.backend = 'tar'
+            return
+        if wanted == 'auto':
+            candidates = ['btrfs', 'reflink']
+        else:
+            candidates = [wanted]
+        for backend in candidates:
+            if self._cloneUsable(backend):
+                self.backend = backend
+                return
+        if wanted != 'auto':
+            getLog().warning("filesystem does not support the %s root cache backend; using tar" % wanted)
+        self.backend = 'tar'
+
+    decorate(traceLog())
+    def _cloneUsable(self, backend, target=None):
+        """can we clone from the cache dir into target (default: next to the chroot)"""
+        if target is None:
+            target = os.path.dirname(self.rootObj.basedir)
+        mockbuild.util.mkdirIfAbsent(self.rootSharedCachePath, target)
+        if backend == 'btrfs':
+            if mockbuild.compress.which("btrfs") is None:
+                return False
+            for path in (self.rootSharedCachePath, target):
+                fstype = mockbuild.util.do(["stat", "-f", "-c", "%T", path], shell=False,
+                                           returnOutput=1, raiseExc=False)
+                if fstype.strip() != "btrfs":
+                    return False
+            return True
+        # reflink: try it
+        src = os.path.join(self.rootSharedCachePath, ".reflink-test.%d" % os.getpid())
+        dst = os.path.join(target, ".reflink-test.%d" % os.getpid())
+        try:
+            open(src, "w").write("reflink test\n")
+            return subprocess.call(["cp", "--reflink=always", src, dst],
+                                   stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT) == 0
+        finally:
+            for f in (src, dst):
+                if os.path.exists(f):
+                    os.unlink(f)
+
+    decorate(traceLog())
+    def _isSubvolume(self, path):
+        # btrfs subvolume roots always have inode number 256
+        try:
+            if os.lstat(path).st_ino != 256 or mockbuild.compress.which("btrfs") is None:
+                return False
+        except OSError:
+            return False
+        return subprocess.call(["btrfs", "subvolume", "show", path],
+                               stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT) == 0
+
+    decorate(traceLog())
+    def _rootCacheRemoveTree(self, path):
+        if self._isSubvolume(path):
+            mockbuild.util.do(["btrfs", "subvolume", "delete", path], shell=False)
+        else:
+            mockbuild.util.rmtree(path, selinux=self.rootObj.selinux)
+
+    decorate(traceLog())
+    def _rootCacheCleanHook(self):
+        # a snapshotted chroot goes away in one go instead of file by file
+        root = self.rootObj.makeChrootPath()
+        if not self._isSubvolume(root):
+            return
+        mockbuild.util.orphansKill(root)
+        self.rootObj._umountall(nowarn=True, force=True)
+        getLog().info("deleting chroot subvolume %s" % root)
+        mockbuild.util.do(["btrfs", "subvolume", "delete", root], shell=False)
+
+    decorate(traceLog())
+    def _rootCacheClonePreInit(self):
+        if not (self.rootObj.chrootWasCleaned and os.path.exists(self.rootCacheFile)):
+            return
+        self.rootObj.start("cloning root cache")
+        self._rootCacheLock(shared=0)
+        try:
+            golden = self._rootCacheUnpackTree(self.clonePath, "golden",
+                                               subvolume=(self.backend == 'btrfs'))
+            self._rootCachePruneGolden(keep=golden)
+            self._rootCacheClone(golden, self.rootObj.makeChrootPath(), self.backend)
+        finally:
+            self._rootCacheUnlock()
+        self.rootObj.chrootWasCleaned = False
+        self.rootObj.chrootWasCached = True
+        self.rootObj.finish("cloning root cache")
+
+    decorate(traceLog())
+    def _rootCacheClone(self, golden, root, backend):
+        if backend == 'btrfs':
+            # the snapshot takes the place of the (empty) chroot dir
+            if os.path.isdir(root):
+                os.rmdir(root)
+            mockbuild.util.do(["btrfs", "subvolume", "snapshot", golden, root], shell=False)
+        else:
+            mockbuild.util.mkdirIfAbsent(root)
+            mockbuild.util.do(["cp", "-a", "--reflink=always", golden + "/.", root], shell=False)
+
+    decorate(traceLog())
+    def _rootCachePruneGolden(self, keep):
+        # clones do not depend on the tree they were made from
+        for golden in glob(os.path.join(self.clonePath, "golden-*")):
+            if golden != keep:
+                getLog().info("removing old root cache tree %s" % golden)
+                self._rootCacheRemoveTree(golden)
+
+    decorate(traceLog())
+    def _rootCacheAge(self, cachefile):
+        return (time.time() - os.stat(cachefile).st_ctime) / (60 * 60 * 24)
+
+    decorate(traceLog())
+    def _rootCachePruneVariants(self):
+        """remove cache dirs of other configs whose cache aged out"""
+        inuse = self._rootCacheLowersInUse()
+        for variant in glob(os.path.join(self.rootCacheTopPath, "*", "rootcache.lock")):
+            variant = os.path.dirname(variant)
+            if variant == self.rootSharedCachePath.rstrip('/'):
+                continue
+            # variants still being populated have no cache yet
+            caches = glob(os.path.join(variant, "cache.tar*")) or [os.path.join(variant, "rootcache.lock")]
+            try:
+                if min([self._rootCacheAge(c) for c in caches]) <= self.root_cache_opts['max_age_days']:
+                    continue
+            except OSError:
+                continue
+            if [l for l in inuse if l.startswith(variant + '/')]:
+                continue
+            # skip variants someone else is working with right now
+            lock = open(os.path.join(variant, "rootcache.lock"), "a+")
+            try:
+                try:
+                    fcntl.lockf(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue
+                getLog().info("removing aged out root cache %s" % variant)
+                mockbuild.util.rmtree(variant, selinux=self.rootObj.selinux)
+            finally:
+                lock.close()
+
+    decorate(traceLog())
+    def _rootCacheLowersInUse(self):
+        inuse = set()
+        for ref in glob(os.path.join(os.path.dirname(self.rootObj.basedir), "*", "overlay", "lowerdir")):
+            try:
+                inuse.add(open(ref).read().strip())
+            except IOError:
+                pass
+        return inuse
+
+    decorate(traceLog())
+    def _rootCacheOverlayPreInit(self):
+        if self.rootObj.chrootWasCleaned:
+            # forget the overlay of the chroot that was just cleaned
+            if self.overlayMount is not None:
+                self.rootObj.mounts.rootmounts.remove(self.overlayMount)
+                self.overlayMount = None
+            # cold chroots are populated normally; the cache they produce
+            # is used as the lower dir from the next clean build on.
+            if not os.path.exists(self.rootCacheFile):
+                return
+            self.rootObj.start("mounting root cache overlay")
+            self._rootCacheLock(shared=0)
+            try:
+                lower = self._rootCacheUnpackLower()
+                mockbuild.util.mkdirIfAbsent(os.path.join(self.overlayStatePath, "upper"),
+                                             os.path.join(self.overlayStatePath, "work"))
+                # record which lower dir this chroot sits on; this also
+                # keeps the lower dir from being pruned while in use.
+                f = open(os.path.join(self.overlayStatePath, "lowerdir"), "w")
+                f.write(lower + "\n")
+                f.close()
+            finally:
+                self._rootCacheUnlock()
+            self._rootCacheAddOverlay(lower)
+            self.rootObj.chrootWasCleaned = False
+            self.rootObj.chrootWasCached = True
+            self.rootObj.finish("mounting root cache overlay")
+        elif self.overlayMount is None and os.path.exists(os.path.join(self.overlayStatePath, "lowerdir")):
+            # the chroot appeared after we were set up (eg. from the pool)
+            lower = open(os.path.join(self.overlayStatePath, "lowerdir")).read().strip()
+            if not os.path.isdir(lower):
+                raise mockbuild.exception.RootError(
+                    "root cache overlay of %s is no longer usable. Clean the chroot." % self.rootObj.makeChrootPath())
+            self._rootCacheAddOverlay(lower)
+        self._rootCacheMountRoot()
+
+    decorate(traceLog())
+    def _rootCacheAddOverlay(self, lower):
+        opts = "lowerdir=%s,upperdir=%s,workdir=%s" % (lower,
+                os.path.join(self.overlayStatePath, "upper"),
+                os.path.join(self.overlayStatePath, "work"))
+        if self.overlayMount is None:
+            self.overlayMount = FileSystemMountPoint(filetype='overlay', device='mock_chroot_overlay',
+                                                     path=self.rootObj.makeChrootPath(), options=opts)
+            self.rootObj.mounts.add_root(self.overlayMount)
+        else:
+            self.overlayMount.options = opts
+
+    decorate(traceLog())
+    def _rootCacheMountRoot(self):
+        self.rootObj.mounts.mountroot()
+
+    decorate(traceLog())
+    def _rootCacheUnpackLower(self):
+        """unpack the root cache into a lower dir, once per cache file.
+           caller must hold the exclusive rootcache lock."""
+        lower = self._rootCacheUnpackTree(self.overlayPath, "lower")
+        self._rootCachePruneLowers(keep=lower)
+        return lower
+
+    decorate(traceLog())
+    def _rootCacheUnpackTree(self, topdir, prefix, subvolume=False):
+        """unpack the root cache into topdir/prefix-<cache mtime> unless
+           that is already there. caller must hold the exclusive rootcache lock."""
+        tree = os.path.join(topdir, "%s-%d" % (prefix, os.stat(self.rootCacheFile).st_mtime))
+        if os.path.isdir(tree):
+            return tree
+        self.rootObj.start("unpacking root cache")
+        tmp = tree + ".tmp"
+        if os.path.exists(tmp):
+            self._rootCacheRemoveTree(tmp)
+        mockbuild.util.mkdirIfAbsent(topdir)
+        if subvolume:
+            mockbuild.util.do(["btrfs", "subvolume", "create", tmp], shell=False)
+        else:
+            mockbuild.util.mkdirIfAbsent(tmp)
+        mockbuild.util.do(
+            ["tar"] + self.compressArgs + ["-xf", self.rootCacheFile, "-C", tmp],
+            shell=False
+            )
+        for dir in self.exclude_dirs:
+            mockbuild.util.mkdirIfAbsent(os.path.join(tmp, dir))
+        os.rename(tmp, tree)
+        self.rootObj.finish("unpacking root cache")
+        return tree
+
+    decorate(traceLog())
+    def _rootCachePruneLowers(self, keep):
+        inuse = self._rootCacheLowersInUse()
+        inuse.add(keep)
+        for lower in glob(os.path.join(self.overlayPath, "lower-*")):
+            if lower not in inuse:
+                getLog().info("removing unused root cache overlay %s" % lower)
+                mockbuild.util.rmtree(lower, selinux=self.rootObj.selinux)
+
     decorate(traceLog())
     def _root_cache_handle_mounts(self):
         for m in self.rootObj.mounts.get_mountpoints():
             if m.startswith('/'):
-                self.exclude_tar_cmds.append('--exclude=.%s' % m)
+                exclude = '--exclude=.%s' % m
             else:
-                self.exclude_tar_cmds.append('--exclude=./%s' % m)
+                exclude = '--exclude=./%s' % m
+            if exclude not in self.exclude_tar_cmds:
+                self.exclude_tar_cmds.append(exclude)
 
     decorate(traceLog())
     def _rootCachePostInitHook(self):
+        # nuke any rpmdb tmp files
+        for tmp in glob(self.rootObj.makeChrootPath('var/lib/rpm/__db*')):
+            os.unlink(tmp)
+
+        # truncate the sparse files in /var/log
+        for logfile in ('/var/log/lastlog', '/var/log/faillog'):
+            f = open(self.rootObj.makeChrootPath(logfile), "w")
+            f.truncate(0)
+            f.close()
+
+        # never rebuild cache unless it was a clean build or a refresh.
+        if self.refreshing:
+            self.refreshing = False
+            if not self._rootCacheRefreshable():
+                return
+            self.cacheLogContent = self._rootCacheReadLog() + \
+                "\n# refreshed %s\n" % time.ctime() + self.rootObj.yum_update_output
+        elif self.rootObj.chrootWasCleaned:
+            self.cacheLogContent = self.rootObj.yum_init_install_output
+        else:
+            return
+        self._root_cache_handle_mounts()
+        method = self._rootCacheSnapshotMethod()
+        if method is None or not self._rootCachePackAsync(method):
+            self.rootObj.start("creating cache")
+            packlock = open(os.path.join(self.rootSharedCachePath, "pack.lock"), "a+")
+            try:
+                fcntl.flock(packlock.fileno(), fcntl.LOCK_EX)
+                self._rootCachePack(self.rootObj.makeChrootPath())
+            finally:
+                packlock.close()
+            self.rootObj.finish("creating cache")
+
+    decorate(traceLog())
+    def _rootCacheReadLog(self):
         try:
+            return open(os.path.join(self.rootSharedCachePath, "cache.log")).read()
+        except IOError:
+            return ""
+
+    decorate(traceLog())
+    def _rootCachePreYumHook(self):
+        # remember what the aged cache contained before it gets updated
+        if self.refreshing and self.refreshPackages is None:
+            self.refreshPackages = self._rootCachePackages()
+
+    decorate(traceLog())
+    def _rootCachePackages(self):
+        output = self.rootObj.doChroot(
+            ["rpm", "-qa", "--qf", "%{NAME}.%{ARCH} %{EPOCH}:%{VERSION}-%{RELEASE}\\n"],
+            shell=False, returnOutput=1)
+        packages = {}
+        for line in output.split("\n"):
+            if line.strip():
+                (name, evr) = line.split(None, 1)
+                packages.setdefault(name, []).append(evr.strip())
+        return packages
+
+    decorate(traceLog())
+    def _rootCacheRefreshable(self):
+        """decide whether the updated chroot may replace the aged cache.
+           when the update touched too large a share of the packages the
+           cache is dropped and the next clean build installs from scratch."""
+        before = self.refreshPackages
+        self.refreshPackages = None
+        if before is None:
+            # the update never ran
+            return False
+        after = self._rootCachePackages()
+        changed = 0
+        for name in set(before.keys() + after.keys()):
+            if sorted(before.get(name, [])) != sorted(after.get(name, [])):
+                changed += 1
+        delta = float(changed) / max(len(before), 1)
+        getLog().info("root cache refresh changed %d of %d packages" % (changed, len(before)))
+        if delta > float(self.root_cache_opts['refresh_max_delta']):
+            getLog().info("too many changes; root cache will be rebuilt")
             self._rootCacheLock(shared=0)
-            # nuke any rpmdb tmp files
-            for tmp in glob(self.rootObj.makeChrootPath('var/lib/rpm/__db*')):
-                os.unlink(tmp)
-
-            # truncate the sparse files in /var/log
-            for logfile in ('/var/log/lastlog', '/var/log/faillog'):
-                f = open(self.rootObj.makeChrootPath(logfile), "w")
-                f.truncate(0)
-                f.close()
-            
-            # never rebuild cache unless it was a clean build.
-            if self.rootObj.chrootWasCleaned:
-                mockbuild.util.do(["sync"], shell=False)
-                self._root_cache_handle_mounts()
-                self.rootObj.start("creating cache")
-                try:
-                    mockbuild.util.do(
-                        ["tar", "--one-file-system"] + self.compressArgs + ["-cf", self.rootCacheFile,
-                                                       "-C", self.rootObj.makeChrootPath()] +
-                        self.exclude_tar_cmds + ["."],
-                        shell=False
-                        )
-                except:
-                    if os.path.exists(self.rootCacheFile):
-                        os.remove(self.rootCacheFile)
-                    raise
-                # now create the cache log file
-                l = open(os.path.join(self.rootSharedCachePath, "cache.log"), "w")
-                l.write(self.rootObj.yum_init_install_output)
-                l.close()
-                self.rootObj.finish("creating cache")
+            try:
+                if os.path.exists(self.rootCacheFile):
+                    os.unlink(self.rootCacheFile)
+            finally:
+                self._rootCacheUnlock()
+            return False
+        return True
+
+    decorate(traceLog())
+    def _rootCachePack(self, srcdir, logger=None):
+        """pack srcdir into the cache file. the tarball is written under a
+           temporary name and renamed into place, so readers only ever see
+           a complete cache."""
+        if logger is None:
+            logger = getLog()
+        tmp = "%s.tmp.%d" % (self.rootCacheFile, os.getpid())
+        try:
+            mockbuild.util.do(["sync"], shell=False, logger=logger)
+            mockbuild.util.do(
+                self._rootCachePackCmd(self.compressArgs, tmp, srcdir),
+                shell=False, logger=logger
+                )
+            os.rename(tmp, self.rootCacheFile)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        # now create the cache log file
+        l = open(os.path.join(self.rootSharedCachePath, "cache.log"), "w")
+        l.write(self.cacheLogContent)
+        l.close()
+        # record what went into the cache key, for humans
+        k = open(os.path.join(self.rootSharedCachePath, "cache.key"), "w")
+        k.write(self._rootCacheSerialize(self.cacheKeyInputs) + "\n")
+        k.close()
+
+    decorate(traceLog())
+    def _rootCacheSnapshotMethod(self):
+        """how to put the chroot aside to pack it in the background: 'btrfs'
+           or 'reflink'. None to pack it in the foreground; a full copy would
+           be a second chroot on the disk, made in the time of the build."""
+        if not self.root_cache_opts['async']:
+            return None
+        root = self.rootObj.makeChrootPath()
+        if self._isSubvolume(root) and self._cloneUsable('btrfs', target=root):
+            return 'btrfs'
+        if self._cloneUsable('reflink', target=root):
+            return 'reflink'
+        getLog().info("filesystem can not snapshot or reflink the chroot; packing root cache in the foreground")
+        return None
+
+    decorate(traceLog())
+    def _rootCacheSnapshotExcludes(self):
+        """what the tarball leaves out, as paths relative to the chroot"""
+        root = self.rootObj.makeChrootPath()
+        excludes = set()
+        for path in list(self.exclude_dirs) + self.rootObj.mounts.get_mountpoints():
+            if path.startswith(root + '/'):
+                path = path[len(root):]
+            if path.startswith('./'):
+                path = path[2:]
+            path = os.path.normpath(path.lstrip('/'))
+            if path and path != '.':
+                excludes.add(path)
+        return excludes
+
+    decorate(traceLog())
+    def _rootCacheSnapshot(self, srcdir, dstdir, excludes, relpath=""):
+        """reflink srcdir to dstdir, leaving out the excluded paths. bind mounts into the chroot (the
+           yum cache, ccache) are on the same filesystem, so cp -x alone
+           would copy them along."""
+        src = os.path.join(srcdir, relpath)
+        dst = os.path.join(dstdir, relpath)
+        os.mkdir(dst)
+        shutil.copystat(src, dst)
+        st = os.lstat(src)
+        os.lchown(dst, st.st_uid, st.st_gid)
+        entries = []
+        for name in sorted(os.listdir(src)):
+            path = os.path.join(relpath, name)
+            if path in excludes:
+                continue
+            if os.path.isdir(os.path.join(src, name)) and not os.path.islink(os.path.join(src, name)) \
+                    and [e for e in excludes if e.startswith(path + '/')]:
+                self._rootCacheSnapshot(srcdir, dstdir, excludes, path)
+            else:
+                entries.append(os.path.join(src, name))
+        if entries:
+            mockbuild.util.do(["cp", "-ax", "--reflink=always"] + entries + [dst], shell=False)
+
+    decorate(traceLog())
+    def _rootCachePackAsync(self, method):
+        """snapshot or reflink the chroot aside and pack the copy from a
+           detached process while the build goes on. returns False if that
+           did not work out and the chroot is to be packed as it is."""
+        # flock rather than lockf: the lock must survive the fork and stay
+        # with the packer once we close our copy of the descriptor.
+        packlock = open(os.path.join(self.rootSharedCachePath, "pack.lock"), "a+")
+        try:
+            fcntl.flock(packlock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            getLog().info("root cache is already being created by another mock process")
+            packlock.close()
+            return True
+
+        snapshot = os.path.join(self.rootSharedCachePath, "snapshot.%d" % os.getpid())
+        self.rootObj.start("snapshotting chroot for root cache")
+        try:
+            try:
+                if method == 'btrfs':
+                    # what is mounted into the chroot is not part of it
+                    mockbuild.util.do(["btrfs", "subvolume", "snapshot",
+                                       self.rootObj.makeChrootPath(), snapshot], shell=False)
+                else:
+                    self._rootCacheSnapshot(self.rootObj.makeChrootPath(), snapshot,
+                                            self._rootCacheSnapshotExcludes())
+            except (mockbuild.exception.Error, OSError, IOError), e:
+                getLog().warning("could not snapshot the chroot, packing root cache in the foreground: %s" % e)
+                packlock.close()
+                if os.path.exists(snapshot):
+                    self._rootCacheRemoveTree(snapshot)
+                return False
         finally:
-            self._rootCacheUnlock()
+            self.rootObj.finish("snapshotting chroot for root cache")
+
+        pid = os.fork()
+        if pid:
+            packlock.close()
+            os.waitpid(pid, 0)
+            getLog().info("root cache is being created in the background")
+            return True
+
+        # double fork so the packer is reaped by init, not by us
+        status = 1
+        try:
+            try:
+                if os.fork() == 0:
+                    self._rootCachePackDetached(snapshot)
+                status = 0
+            except:
+                pass
+        finally:
+            os._exit(status)
+
+    decorate(traceLog())
+    def _rootCachePackDetached(self, snapshot):
+        status = 1
+        try:
+            try:
+                os.setsid()
+                # keep the caller's pipes free; whoever waits for mock to
+                # finish must not also wait for us.
+                devnull = os.open(os.devnull, os.O_RDWR)
+                packlog = os.open(os.path.join(self.rootSharedCachePath, "pack.log"),
+                                  os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+                os.dup2(devnull, 0)
+                os.dup2(packlog, 1)
+                os.dup2(packlog, 2)
+                os.nice(10)
+                logger = logging.getLogger("mockbuild.root_cache.pack")
+                logger.propagate = 0
+                logger.setLevel(logging.DEBUG)
+                logger.addHandler(logging.StreamHandler(sys.stderr))
+                logger.info("packing %s into %s" % (snapshot, self.rootCacheFile))
+                self._rootCachePack(snapshot, logger=logger)
+                logger.info("done")
+                status = 0
+            except:
+                traceback.print_exc()
+        finally:
+            try:
+                self._rootCacheRemoveTree(snapshot)
+            except:
+                pass
+            os._exit(status)
+
+    decorate(traceLog())
+    def _rootCacheCleanStalePacks(self):
+        """remove leftovers of packers that died"""
+        packlock = open(os.path.join(self.rootSharedCachePath, "pack.lock"), "a+")
+        try:
+            try:
+                fcntl.flock(packlock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # a packer is running
+                return
+            for stale in glob(os.path.join(self.rootSharedCachePath, "snapshot.*")) + \
+                         glob(os.path.join(self.rootSharedCachePath, "cache.tar*.tmp.*")):
+                getLog().info("removing stale %s" % stale)
+                if os.path.isdir(stale):
+                    self._rootCacheRemoveTree(stale)
+                else:
+                    os.unlink(stale)
+        finally:
+            packlock.close()
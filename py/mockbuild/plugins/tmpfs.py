@@ -58,6 +58,7 @@ class Tmpfs(object):
     def _tmpfsUmount(self):
         force = False
         getLog().info("unmounting tmpfs.")
+        self.rootObj.stopChrootServer()
         umountCmd = ["umount", "-n", self.rootObj.makeChrootPath()]
         # since we're in a separate namespace, the mount will be cleaned up
         # on exit, so just warn if it fails here
@@ -5,18 +5,29 @@
 
 # python library imports
 import fcntl
-import time
 import os
 import glob
+import re
+import sqlite3
 
 # our imports
 from mockbuild.trace_decorator import decorate, traceLog, getLog
+import mockbuild.cacheindex
+import mockbuild.events
 import mockbuild.util
 from mockbuild.mounts import BindMountPoint
 
 # set up logging, module options
 requires_api_version = "1.0"
 
+# where yum looks for its plugins unless told otherwise
+YUM_PLUGIN_PATH = ["/usr/share/yum-plugins", "/usr/lib/yum-plugins"]
+
+PLUGINS_ON = re.compile(r"^[ \t]*plugins[ \t]*=[ \t]*1[ \t]*$", re.M)
+PLUGINS_OFF = re.compile(r"^[ \t]*plugins[ \t]*=[ \t]*0[ \t]*$", re.M)
+PLUGINPATH = re.compile(r"^[ \t]*pluginpath[ \t]*=", re.M)
+MAIN_SECTION = re.compile(r"^[ \t]*\[main\][ \t]*$", re.M)
+
 # plugin entry point
 decorate(traceLog())
 def init(rootObj, conf):
@@ -30,14 +41,99 @@ class YumCache(object):
         self.rootObj = rootObj
         self.yum_cache_opts = conf
         self.yumSharedCachePath = self.yum_cache_opts['dir'] % self.yum_cache_opts
+        # packages of all configs, by checksum, hardlinked into their caches
+        self.packageStore = None
+        if self.yum_cache_opts['package_store']:
+            self.packageStore = self.yum_cache_opts['package_store'] % self.yum_cache_opts
         self.online = rootObj.online
         rootObj.yum_cacheObj = self
-        rootObj.addHook("preyum", self._yumCachePreYumHook)
-        rootObj.addHook("postyum", self._yumCachePostYumHook)
+        # yum locks the cache itself through our yum plugin (see
+        # yumplugins/mock_cache.py): shared while it only reads, exclusive
+        # while it refreshes metadata. yum.conf gets plugins turned on for
+        # it, with only our plugin on the pluginpath unless plugins were on
+        # already; pluginconfpath (see Root._init) keeps the plugins to
+        # those configured in the chroot. a yum.conf that turns plugins off or
+        # has a pluginpath of its own keeps the old way: we hold the lock
+        # exclusively for as long as yum runs.
+        self.sharedLocking = self.yum_cache_opts['shared_locking'] and \
+            not PLUGINS_OFF.search(rootObj.yum_conf_content) and \
+            not PLUGINPATH.search(rootObj.yum_conf_content)
+        if self.sharedLocking:
+            # a config that had plugins on keeps those of the host
+            pluginPath = [rootObj.yumPluginDir]
+            if PLUGINS_ON.search(rootObj.yum_conf_content):
+                pluginPath = YUM_PLUGIN_PATH + pluginPath
+            rootObj.yum_conf_content = _enablePlugins(rootObj.yum_conf_content, " ".join(pluginPath))
+        else:
+            if self.yum_cache_opts['shared_locking']:
+                getLog().info("yum.conf turns plugins off or sets pluginpath: one yum at a time in the"
+                              " yum cache, no package store and no record of package use")
+            elif self.packageStore:
+                getLog().info("package_store needs shared_locking; not using it")
+            rootObj.addHook("preyum", self._yumCachePreYumHook)
+            rootObj.addHook("postyum", self._yumCachePostYumHook)
+        # note what yum added to the cache, so that pruning it needs no walk
+        rootObj.addHook("postyum", self._yumCacheIndexHook)
         rootObj.addHook("preinit", self._yumCachePreInitHook)
         rootObj.mounts.add(BindMountPoint(srcpath=self.yumSharedCachePath, bindpath=rootObj.makeChrootPath('/var/cache/yum')))
         mockbuild.util.mkdirIfAbsent(self.yumSharedCachePath)
-        self.yumCacheLock = open(os.path.join(self.yumSharedCachePath, "yumcache.lock"), "a+")
+        if self.packageStore:
+            mockbuild.util.mkdirIfAbsent(self.packageStore)
+        self.yumCacheLockPath = os.path.join(self.yumSharedCachePath, "yumcache.lock")
+        self.yumCacheLock = open(self.yumCacheLockPath, "a+")
+        self.index = mockbuild.cacheindex.CacheIndex(self.yumSharedCachePath)
+
+    # =============
+    # 'Public' API
+    # =============
+    decorate(traceLog())
+    def gc(self):
+        """prune the cache now, as preinit would, and drop what no cache
+           uses from the package store. returns (files, bytes) removed."""
+        self._yumCachePreYumHook()
+        try:
+            (removed, freed) = self._prune()
+        finally:
+            self._yumCachePostYumHook()
+        # packages no config has in its cache any more
+        if self.packageStore:
+            (storeRemoved, storeFreed) = mockbuild.cacheindex.removeUnlinked(self.packageStore)
+            removed += storeRemoved
+            freed += storeFreed
+        return (removed, freed)
+
+    decorate(traceLog())
+    def lockShared(self):
+        """for downloading packages into the cache from outside yum: hold
+           the cache lock shared, as yum does while it adds packages. does
+           nothing when we hold it exclusively around yum anyway."""
+        if not self.sharedLocking:
+            return
+        started = mockbuild.events.monotonic()
+        contended = False
+        try:
+            fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError, e:
+            contended = True
+            self.rootObj.start("Waiting for yumcache lock")
+            fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_SH)
+            self.rootObj.finish("Waiting for yumcache lock")
+        mockbuild.events.emit("lock", lock="yumcache", shared=True, contended=contended,
+                              seconds=round(mockbuild.events.monotonic() - started, 6))
+
+    decorate(traceLog())
+    def unlockShared(self):
+        if self.sharedLocking:
+            fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_UN)
+
+    decorate(traceLog())
+    def hostPath(self, path):
+        """path of a file yum sees in the cache inside the chroot, in the
+           cache outside of it"""
+        mountpoint = self.rootObj.makeChrootPath('var', 'cache', 'yum')
+        if path.startswith(mountpoint + "/"):
+            return os.path.join(self.yumSharedCachePath, path[len(mountpoint) + 1:])
+        return path
 
     # =============
     # 'Private' API
@@ -48,17 +144,61 @@ class YumCache(object):
     # mock instances with --uniqueext=
     decorate(traceLog())
     def _yumCachePreYumHook(self):
+        started = mockbuild.events.monotonic()
+        contended = False
         try:
             fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
         except IOError, e:
+            contended = True
             self.rootObj.start("Waiting for yumcache lock")
             fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_EX)
             self.rootObj.finish("Waiting for yumcache lock")
+        mockbuild.events.emit("lock", lock="yumcache", shared=False, contended=contended,
+                              seconds=round(mockbuild.events.monotonic() - started, 6))
 
     decorate(traceLog())
     def _yumCachePostYumHook(self):
         fcntl.lockf(self.yumCacheLock.fileno(), fcntl.LOCK_UN)
 
+    decorate(traceLog())
+    def _yumCacheIndexHook(self):
+        # the next prune catches up with whatever we miss here
+        try:
+            self.index.update()
+        except (sqlite3.Error, OSError), e:
+            getLog().warning("could not update the yum cache index: %s" % e)
+
+    decorate(traceLog())
+    def _prune(self):
+        """remove what is too old from the cache, the cache lock held.
+           returns (files, bytes) removed."""
+        self.rootObj.start("cleaning yum metadata")
+        try:
+            self.index.update()
+            # downloads of yums that did not live to rename them
+            expired = self.index.older(0, [".mocktmp"])
+            if self.online:
+                day = 60 * 60 * 24
+                # prune repodata so yum redownloads.
+                # prevents certain errors where yum gets stuck due to bad metadata
+                expired += self.index.older(self.yum_cache_opts['max_metadata_age_days'] * day,
+                                            [".sqlite", ".xml", ".bz2", ".gz"])
+                expired += self.index.older(self.yum_cache_opts['max_age_days'] * day)
+            paths = sorted(set([path for (path, size) in expired]))
+            freed = self.index.remove(paths)
+            removed = len(paths)
+            if self.yum_cache_opts['prune_superseded']:
+                paths = self.index.superseded()
+                freed += self.index.remove(paths)
+                removed += len(paths)
+            if self.yum_cache_opts['max_size']:
+                paths = self.index.leastRecentlyUsed(mockbuild.cacheindex.parseSize(self.yum_cache_opts['max_size']), ".rpm")
+                freed += self.index.remove(paths)
+                removed += len(paths)
+        finally:
+            self.rootObj.finish("cleaning yum metadata")
+        return (removed, freed)
+
     decorate(traceLog())
     def _yumCachePreInitHook(self):
         getLog().info("enabled yum cache")
@@ -67,26 +207,8 @@ class YumCache(object):
         # lock so others dont accidentally use yum cache while we operate on it.
         self._yumCachePreYumHook()
 
-        if self.online:
-            self.rootObj.start("cleaning yum metadata")
-            for (dirpath, dirnames, filenames) in os.walk(self.yumSharedCachePath):
-                for filename in filenames:
-                    fullPath = os.path.join(dirpath, filename)
-                    statinfo = os.stat(fullPath)
-                    file_age_days = (time.time() - statinfo.st_ctime) / (60 * 60 * 24)
-                    # prune repodata so yum redownloads.
-                    # prevents certain errors where yum gets stuck due to bad metadata
-                    for ext in (".sqlite", ".xml", ".bz2", ".gz"):
-                        if filename.endswith(ext) and file_age_days > self.yum_cache_opts['max_metadata_age_days']:
-                            os.unlink(fullPath)
-                            fullPath = None
-                            break
-
-                    if fullPath is None: continue
-                    if file_age_days > self.yum_cache_opts['max_age_days']:
-                        os.unlink(fullPath)
-                        continue
-            self.rootObj.finish("cleaning yum metadata")
+        if self.yum_cache_opts['prune_on_init']:
+            self._prune()
 
         # yum made an rpmdb cache dir in $cachedir/installed for a while;
         # things can go wrong in a specific mock case if this happened.
@@ -98,3 +220,24 @@ class YumCache(object):
 
         self._yumCachePostYumHook()
 
+        if self.sharedLocking:
+            pluginconfdir = self.rootObj.makeChrootPath('etc', 'yum', 'pluginconf.d')
+            mockbuild.util.mkdirIfAbsent(pluginconfdir)
+            conf = open(os.path.join(pluginconfdir, "mock_cache.conf"), "w+")
+            conf.write("[main]\nenabled=1\nlockfile=%s\nindex=%s\ncachedir=%s\nmountpoint=%s\n"
+                       % (self.yumCacheLockPath, self.index.path, self.index.topdir,
+                          self.rootObj.makeChrootPath('var', 'cache', 'yum')))
+            if self.packageStore:
+                conf.write("store=%s\n" % self.packageStore)
+            conf.close()
+
+# functions
+decorate(traceLog())
+def _enablePlugins(yumConf, pluginPath):
+    """yumConf with plugins=1 and pluginPath in its [main] section"""
+    lines = "plugins=1\npluginpath=%s" % pluginPath
+    if PLUGINS_ON.search(yumConf):
+        return PLUGINS_ON.sub(lines, yumConf, 1)
+    if MAIN_SECTION.search(yumConf):
+        return MAIN_SECTION.sub("[main]\n" + lines, yumConf, 1)
+    return "[main]\n" + lines + "\n" + yumConf
@@ -0,0 +1,262 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import copy
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+import traceback
+from glob import glob
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+import mockbuild.cgroup
+import mockbuild.events
+import mockbuild.util
+import mockbuild.exception
+
+# classes
+class ChrootPool(object):
+    """a pool of initialized chroots for one config, kept next to the
+       regular chroots as <basedir>/<root>-pool-<id>. entries are built
+       under a -pooltmp- name and renamed into place once ready, so a
+       complete entry can be claimed by renaming it onto a build's basedir."""
+    decorate(traceLog())
+    def __init__(self, config, uidManager):
+        # keep our own copy; Root mangles the config it is given
+        self.config = copy.deepcopy(config)
+        self.uidManager = uidManager
+        self.name = config['root']
+        self.basedir = config['basedir']
+        self.prefix = os.path.join(self.basedir, self.name + "-pool-")
+        self.tmpprefix = os.path.join(self.basedir, self.name + "-pooltmp-")
+        self.sizeFile = os.path.join(self.basedir, self.name + "-pool.size")
+        self.lockFile = os.path.join(self.basedir, self.name + "-pool.lock")
+        self.logFile = os.path.join(self.basedir, self.name + "-pool.log")
+        self.max_age_hours = config['pool_max_age_hours']
+        self.usable = not config['plugin_conf'].get('tmpfs_enable')
+
+    # =============
+    #  'Public' API
+    # =============
+    decorate(traceLog())
+    def claim(self, chroot):
+        """replace the (cleaned) chroot with a pool entry. returns True if
+           an entry was claimed."""
+        if not self.usable or os.path.exists(chroot.basedir):
+            return False
+        key = self._key(chroot)
+        for entry in self._entries():
+            if not self._valid(entry, key):
+                self._discard(entry)
+                continue
+            lock = self._lockEntry(entry)
+            if lock is None:
+                continue
+            try:
+                try:
+                    os.rename(entry, chroot.basedir)
+                except OSError:
+                    # somebody else got it first
+                    continue
+            finally:
+                lock.close()
+            getLog().info("claimed pooled chroot %s" % os.path.basename(entry))
+            mockbuild.events.emit("cache", cache="pool", hit=True)
+            chroot.chrootWasCleaned = False
+            chroot.chrootWasCached = False
+            # init redoes the build user only if the entry was filled for
+            # another one
+            chroot.chrootWasPooled = self._buildUser(chroot.basedir) == self._userKey(chroot)
+            self.refillAsync()
+            return True
+        if self.size():
+            mockbuild.events.emit("cache", cache="pool", hit=False)
+        self.refillAsync()
+        return False
+
+    decorate(traceLog())
+    def fill(self, count=None):
+        """build entries until the pool holds count of them. count is
+           remembered for the background refills after each claim."""
+        if not self.usable:
+            raise mockbuild.exception.Error, "chroot pool can not be used together with the tmpfs plugin"
+        mockbuild.util.mkdirIfAbsent(self.basedir)
+        if count is None:
+            count = self.size()
+        else:
+            f = open(self.sizeFile, "w")
+            f.write("%d\n" % count)
+            f.close()
+        lock = open(self.lockFile, "a+")
+        try:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                getLog().info("chroot pool for %s is being filled by another process" % self.name)
+                return
+            self._cleanStale()
+            while True:
+                entryid = "%d%d" % (int(time.time()), os.getpid())
+                chroot = self._newRoot("pooltmp-%s" % entryid)
+                key = self._key(chroot)
+                ready = 0
+                for entry in self._entries():
+                    if self._valid(entry, key):
+                        ready += 1
+                    else:
+                        self._discard(entry)
+                if ready >= count:
+                    break
+                self._build(chroot, entryid)
+        finally:
+            lock.close()
+
+    decorate(traceLog())
+    def size(self):
+        try:
+            return int(open(self.sizeFile).read().strip())
+        except (IOError, ValueError):
+            return 0
+
+    decorate(traceLog())
+    def refillAsync(self):
+        """top the pool up again from a detached process"""
+        if self.size() == 0:
+            return
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return
+        # double fork so the filler is reaped by init, not by us
+        status = 1
+        try:
+            try:
+                if os.fork() == 0:
+                    self._refillDetached()
+                status = 0
+            except:
+                pass
+        finally:
+            os._exit(status)
+
+    # =============
+    # 'Private' API
+    # =============
+    decorate(traceLog())
+    def _refillDetached(self):
+        status = 1
+        try:
+            try:
+                os.setsid()
+                devnull = os.open(os.devnull, os.O_RDWR)
+                log = os.open(self.logFile, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+                os.dup2(devnull, 0)
+                os.dup2(log, 1)
+                os.dup2(log, 2)
+                os.nice(10)
+                # detach from the log files of the build that forked us
+                loggers = [logging.getLogger()] + [l for l in logging.Logger.manager.loggerDict.values()
+                                                   if isinstance(l, logging.Logger)]
+                for logger in loggers:
+                    for handler in logger.handlers[:]:
+                        logger.removeHandler(handler)
+                logging.getLogger().addHandler(logging.StreamHandler(sys.stderr))
+                self.fill()
+                status = 0
+            except:
+                traceback.print_exc()
+        finally:
+            mockbuild.cgroup.release()
+            os._exit(status)
+
+    decorate(traceLog())
+    def _entries(self):
+        pattern = re.compile("^" + re.escape(self.prefix) + "[0-9]+$")
+        return sorted([e for e in glob(self.prefix + "*") if pattern.match(e)])
+
+    decorate(traceLog())
+    def _key(self, chroot):
+        return hashlib.sha1(json.dumps(chroot.chrootConfigInputs(), sort_keys=True, default=repr)).hexdigest()
+
+    decorate(traceLog())
+    def _userKey(self, chroot):
+        return json.dumps(chroot.buildUserInputs(), sort_keys=True)
+
+    decorate(traceLog())
+    def _buildUser(self, entry):
+        try:
+            return open(os.path.join(entry, "pool.user")).read().strip()
+        except IOError:
+            return None
+
+    decorate(traceLog())
+    def _valid(self, entry, key):
+        try:
+            if open(os.path.join(entry, "pool.key")).read().strip() != key:
+                return False
+            age = (time.time() - os.stat(os.path.join(entry, "pool.key")).st_mtime) / (60 * 60)
+        except (IOError, OSError):
+            return False
+        return age <= self.max_age_hours
+
+    decorate(traceLog())
+    def _lockEntry(self, entry):
+        try:
+            lock = open(os.path.join(entry, "buildroot.lock"), "a+")
+        except IOError:
+            return None
+        try:
+            fcntl.lockf(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            return None
+        return lock
+
+    decorate(traceLog())
+    def _discard(self, entry):
+        # rename first so that nobody can claim it while it is removed
+        stale = entry.replace(self.prefix, self.tmpprefix + "stale-", 1)
+        try:
+            os.rename(entry, stale)
+        except OSError:
+            return
+        getLog().info("discarding outdated pooled chroot %s" % os.path.basename(entry))
+        mockbuild.util.rmtree(stale)
+
+    decorate(traceLog())
+    def _cleanStale(self):
+        """remove half built entries of fills that died. caller holds the pool lock."""
+        for stale in glob(self.tmpprefix + "*"):
+            getLog().info("removing stale %s" % stale)
+            mockbuild.util.rmtree(stale)
+
+    decorate(traceLog())
+    def _newRoot(self, uniqueext):
+        import mockbuild.backend
+        config = copy.deepcopy(self.config)
+        config['unique-ext'] = uniqueext
+        # entries are renamed into place, so nothing may stay mounted in them
+        config['persistent_mounts'] = False
+        # logs of the last fill stay next to the pool
+        config['resultdir'] = os.path.join(self.basedir, self.name + "-pool-result")
+        return mockbuild.backend.Root(config, self.uidManager)
+
+    decorate(traceLog())
+    def _build(self, chroot, entryid):
+        getLog().info("adding chroot to the pool for %s" % self.name)
+        chroot.clean()
+        chroot.init()
+        f = open(os.path.join(chroot.basedir, "pool.user"), "w")
+        f.write(self._userKey(chroot) + "\n")
+        f.close()
+        f = open(os.path.join(chroot.basedir, "pool.key"), "w")
+        f.write(self._key(chroot) + "\n")
+        f.close()
+        os.rename(chroot.basedir, self.prefix + entryid)
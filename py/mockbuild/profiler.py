@@ -0,0 +1,174 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+import mockbuild.events
+
+# the profile of this process, while mock --profile is on. the functions
+# below do nothing without one, so callers need not check.
+_current = None
+
+# functions that used the most time of their own, in the summary
+TOP_FUNCTIONS = 30
+
+# classes
+class Profile(object):
+    """what mock --profile collects for one mock process: a cProfile of
+       mock itself and the wall clock time of its states, hooks and commands.
+       times in the summary are seconds since the profile was started, on
+       the clock of mockbuild.events.monotonic()."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.started = mockbuild.events.monotonic()
+        self.rusage = resource.getrusage(resource.RUSAGE_SELF)
+        self.childRusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.states = []
+        self.stateStack = []
+        self.hooks = []
+        self.commands = []
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def offset(self, when):
+        return round(when - self.started, 6)
+
+    def summary(self, statsPath):
+        now = mockbuild.events.monotonic()
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        childRusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        stateTotals = {}
+        for state in self.states:
+            stateTotals[state['state']] = stateTotals.get(state['state'], 0) + state['seconds']
+        stageTotals = {}
+        for hook in self.hooks:
+            stageTotals[hook['stage']] = stageTotals.get(hook['stage'], 0) + hook['seconds']
+        return {
+            'argv': sys.argv,
+            'pid': os.getpid(),
+            'wall_seconds': round(now - self.started, 6),
+            # cpu time of mock itself, and of everything it ran and waited for
+            'mock_cpu_seconds': round(rusage.ru_utime + rusage.ru_stime
+                                      - self.rusage.ru_utime - self.rusage.ru_stime, 6),
+            'children_cpu_seconds': round(childRusage.ru_utime + childRusage.ru_stime
+                                          - self.childRusage.ru_utime - self.childRusage.ru_stime, 6),
+            'command_seconds': round(sum([c['seconds'] for c in self.commands]), 6),
+            'lock_wait_seconds': round(sum([s['seconds'] for s in self.states
+                                            if s['state'].startswith("Waiting for")]), 6),
+            'states': self.states,
+            'state_totals': stateTotals,
+            'hooks': self.hooks,
+            'stage_totals': stageTotals,
+            'commands': self.commands,
+            'pstats': statsPath,
+            'top_functions': self.topFunctions(),
+            }
+
+    def topFunctions(self):
+        stats = pstats.Stats(self.profile)
+        functions = []
+        for ((filename, lineno, name), (cc, nc, tt, ct, callers)) in stats.stats.items():
+            functions.append({
+                'function': "%s:%d(%s)" % (filename, lineno, name),
+                'calls': nc,
+                'tottime': round(tt, 6),
+                'cumtime': round(ct, 6),
+                })
+        functions.sort(key=lambda f: f['tottime'], reverse=True)
+        return functions[:TOP_FUNCTIONS]
+
+# functions
+decorate(traceLog())
+def start(directory):
+    """profile this process from now on; the pstats dump goes to directory"""
+    global _current
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    _current = Profile(directory)
+
+decorate(traceLog())
+def restart():
+    """start over in a forked child, which only wants its own share"""
+    if _current is not None:
+        _current.profile.disable()
+        start(_current.directory)
+
+def active():
+    return _current is not None
+
+def stateStarted(state):
+    if _current is None:
+        return
+    now = mockbuild.events.monotonic()
+    entry = {'state': state, 'start': _current.offset(now),
+             'depth': len(_current.stateStack)}
+    _current.stateStack.append((entry, now))
+
+def stateFinished(state):
+    if _current is None or not _current.stateStack:
+        return
+    (entry, started) = _current.stateStack.pop()
+    entry['seconds'] = round(mockbuild.events.monotonic() - started, 6)
+    _current.states.append(entry)
+
+def hookDone(stage, hook, started):
+    if _current is None:
+        return
+    _current.hooks.append({'stage': stage, 'hook': mockbuild.events.hookName(hook),
+                           'start': _current.offset(started),
+                           'seconds': round(mockbuild.events.monotonic() - started, 6)})
+
+def commandDone(command, started, returncode, chrootPath=None):
+    if _current is None:
+        return
+    if isinstance(command, basestring):
+        argv = command
+    else:
+        argv = list(command)
+    _current.commands.append({'command': argv, 'chroot': chrootPath,
+                              'start': _current.offset(started),
+                              'seconds': round(mockbuild.events.monotonic() - started, 6),
+                              'returncode': returncode})
+
+decorate(traceLog())
+def stop(resultdir=None):
+    """write out the profile: the pstats dump to the profile directory and
+       the summary to resultdir/profile.json, or next to the dump if there
+       is no resultdir. returns the path of the summary."""
+    global _current
+    if _current is None:
+        return None
+    profile = _current
+    profile.profile.disable()
+    _current = None
+
+    statsPath = os.path.join(profile.directory, "mock-%d.pstats" % os.getpid())
+    profile.profile.dump_stats(statsPath)
+    # states still open (the build failed) end here
+    while profile.stateStack:
+        (entry, started) = profile.stateStack.pop()
+        entry['seconds'] = round(mockbuild.events.monotonic() - started, 6)
+        entry['unfinished'] = True
+        profile.states.append(entry)
+    profile.states.sort(key=lambda s: s['start'])
+
+    if resultdir is not None:
+        summaryPath = os.path.join(resultdir, "profile.json")
+    else:
+        summaryPath = os.path.join(profile.directory, "mock-%d.json" % os.getpid())
+    f = open(summaryPath, "w")
+    try:
+        json.dump(profile.summary(statsPath), f, indent=1, sort_keys=True)
+        f.write("\n")
+    finally:
+        f.close()
+    getLog().info("profile written to %s, %s" % (summaryPath, statsPath))
+    return summaryPath
@@ -0,0 +1,152 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# python library imports
+import fcntl
+import logging
+import os
+import subprocess
+import sys
+import traceback
+from glob import glob
+
+# our imports
+from mockbuild.trace_decorator import decorate, traceLog, getLog
+import mockbuild.mounts
+import mockbuild.util
+
+# a chroot is removed by renaming it to <basedir>.tmp (or .tmp.N if that is
+# taken) and leaving the rest to a detached reaper process. the reaper holds
+# a flock on each tree it removes; a tree nobody holds a lock on was left
+# behind by a reaper that died, and the next reaper takes it. when more than
+# MAX_PENDING trees are waiting, the reapers fall behind (or keep dying) and
+# mock removes them itself before it goes on.
+MAX_PENDING = 4
+
+# functions
+decorate(traceLog())
+def trash(basedir):
+    """move basedir out of the way. returns the name it has now."""
+    target = basedir + ".tmp"
+    n = 0
+    while True:
+        try:
+            if not os.path.lexists(target):
+                os.rename(basedir, target)
+                return target
+        except OSError:
+            # somebody else took the name just now
+            if not os.path.lexists(target):
+                raise
+        n += 1
+        target = "%s.tmp.%d" % (basedir, n)
+
+decorate(traceLog())
+def trashed(basedir):
+    return glob(basedir + ".tmp") + glob(basedir + ".tmp.[0-9]*")
+
+decorate(traceLog())
+def logPath(basedir):
+    """where the reapers of basedir log to"""
+    return os.path.join(os.path.dirname(basedir), "reaper.log")
+
+decorate(traceLog())
+def reapAsync(basedir, selinux=False):
+    """remove the trashed trees of basedir from a detached low priority
+       process. returns at once."""
+    if not trashed(basedir):
+        return
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    # double fork so the reaper is reaped by init, not by us
+    status = 1
+    try:
+        try:
+            if os.fork() == 0:
+                _reapDetached(basedir, selinux)
+            status = 0
+        except:
+            pass
+    finally:
+        os._exit(status)
+
+decorate(traceLog())
+def reap(basedir, selinux=False):
+    """remove the trashed trees of basedir that no other reaper works on"""
+    for tree in trashed(basedir):
+        try:
+            fd = os.open(tree, os.O_RDONLY)
+        except OSError:
+            # gone already
+            continue
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                continue
+            if not _unmounted(tree):
+                getLog().error("not removing %s, there are still filesystems mounted in it" % tree)
+                continue
+            getLog().info("removing %s" % tree)
+            try:
+                mockbuild.util.rmtree(tree, selinux=selinux)
+            except OSError, e:
+                getLog().error("could not remove %s: %s" % (tree, e))
+                getLog().error("contents of /proc/mounts:\n%s" % open('/proc/mounts').read())
+                getLog().error("looking for users of %s" % tree)
+                _showPathUser(tree)
+        finally:
+            os.close(fd)
+
+def _unmounted(tree):
+    """True if nothing is mounted in tree (anymore); rmtree would go right
+       through a bind mount"""
+    table = mockbuild.mounts.MountTable()
+    mounted = table.under(tree)
+    mounted.reverse()
+    for mountpoint in mounted:
+        try:
+            mockbuild.util.umount(mountpoint, mockbuild.util.MNT_DETACH)
+        except OSError, e:
+            getLog().warning("could not umount %s: %s" % (mountpoint, e))
+    return not mockbuild.mounts.MountTable().under(tree)
+
+def _showPathUser(path):
+    try:
+        out = mockbuild.util.do(['/sbin/fuser', '-a', '-v', path], returnOutput=1, raiseExc=False)
+    except OSError, e:
+        out = "could not run fuser: %s" % e
+    getLog().error(out)
+
+def _reapDetached(basedir, selinux):
+    status = 1
+    try:
+        try:
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            log = os.open(logPath(basedir), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+            os.dup2(devnull, 0)
+            os.dup2(log, 1)
+            os.dup2(log, 2)
+            # nor keep the locks of the build alive, flock()s are shared
+            # with us as long as we hold on to their files
+            os.closerange(3, subprocess.MAXFD)
+            os.nice(19)
+            # idle I/O class: only touch the disk when nobody else wants it
+            subprocess.call(["ionice", "-c", "3", "-p", str(os.getpid())],
+                            stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT, close_fds=True)
+            # detach from the log files of the build that forked us
+            loggers = [logging.getLogger()] + [l for l in logging.Logger.manager.loggerDict.values()
+                                               if isinstance(l, logging.Logger)]
+            for logger in loggers:
+                for handler in logger.handlers[:]:
+                    logger.removeHandler(handler)
+            logging.getLogger().addHandler(logging.StreamHandler(sys.stderr))
+            reap(basedir, selinux)
+            status = 0
+        except:
+            traceback.print_exc()
+    finally:
+        os._exit(status)
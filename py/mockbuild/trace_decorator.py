@@ -37,33 +37,58 @@ def doLog(logger, level, *args, **kargs):
             del(kargs["func"])
             logger.handle(logger.makeRecord(logger.name, level, *args, **kargs))
 
+# tracing is on unless the program says otherwise. while it is off,
+# traceLog() hands back the function it is given, so code decorated from
+# then on pays nothing for it. functions decorated while it was on check
+# the flag on every call and skip the logging when it has been turned off.
+_tracing = True
+
+def setTracing(enabled):
+    global _tracing
+    _tracing = enabled
+
+# the ENTER message, only put together if a handler actually emits it
+class _EnterMessage(object):
+    def __init__(self, func_name, args, kw):
+        self.func_name = func_name
+        self.args = args
+        self.kw = kw
+
+    def __str__(self):
+        message = "ENTER %s(" % self.func_name
+        for arg in self.args:
+            message = message + repr(arg) + ", "
+        for k,v in self.kw.items():
+            message = message + "%s=%s" % (k,repr(v))
+        return message + ")"
+
 def traceLog(log = None):
     def decorator(func):
+        if not _tracing:
+            return func
+
+        filename = os.path.normcase(func.func_code.co_filename)
+        func_name = func.func_code.co_name
+        lineno = func.func_code.co_firstlineno
+
         def trace(*args, **kw):
+            if not _tracing:
+                return func(*args, **kw)
+
             # default to logger that was passed by module, but
             # can override by passing logger=foo as function parameter.
             # make sure this doesn't conflict with one of the parameters
             # you are expecting
-
-            filename = os.path.normcase(func.func_code.co_filename)
-            func_name = func.func_code.co_name
-            lineno = func.func_code.co_firstlineno
-
             l2 = kw.get('logger', log)
             if l2 is None:
                 l2 = logging.getLogger("trace.%s" % func.__module__)
             if isinstance(l2, basestring):
                 l2 = logging.getLogger(l2)
-
-            message = "ENTER %s(" % func_name
-            for arg in args:
-                message = message + repr(arg) + ", "
-            for k,v in kw.items():
-                message = message + "%s=%s" % (k,repr(v))
-            message = message + ")"
+            if l2.manager.disable >= logging.INFO or not l2.isEnabledFor(logging.INFO):
+                return func(*args, **kw)
 
             frame = sys._getframe(2)
-            doLog(l2, logging.INFO, os.path.normcase(frame.f_code.co_filename), frame.f_lineno, message, args=[], exc_info=None, func=frame.f_code.co_name)
+            doLog(l2, logging.INFO, os.path.normcase(frame.f_code.co_filename), frame.f_lineno, _EnterMessage(func_name, args, kw), args=[], exc_info=None, func=frame.f_code.co_name)
             try:
                 result = "Bad exception raised: Exception was not a derived class of 'Exception'"
                 try:
@@ -6,6 +6,7 @@
 # Copyright (C) 2007 Michael E Brown <mebrown@michaels-house.net>
 
 # python library imports
+import collections
 import ctypes
 import fcntl
 import os
@@ -15,12 +16,20 @@ import rpmUtils
 import rpmUtils.transaction
 import select
 import shutil
+import socket
+import struct
 import subprocess
+import sys
+import threading
 import time
 import errno
+import logging
 
 # our imports
+import mockbuild.cgroup
+import mockbuild.events
 import mockbuild.exception
+import mockbuild.profiler
 from mockbuild.trace_decorator import traceLog, decorate, getLog
 import mockbuild.uid as uid
 
@@ -30,9 +39,32 @@ _libc.personality.argtypes = [ctypes.c_ulong]
 _libc.personality.restype = ctypes.c_int
 _libc.unshare.argtypes = [ctypes.c_int,]
 _libc.unshare.restype = ctypes.c_int
+_libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+_libc.mount.restype = ctypes.c_int
+_libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+_libc.umount2.restype = ctypes.c_int
 CLONE_NEWNS = 0x00020000
 CLONE_NEWUTS = 0x04000000
 
+# taken from sys/mount.h
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_SYNCHRONOUS = 16
+MS_REMOUNT = 32
+MS_MANDLOCK = 64
+MS_DIRSYNC = 128
+MS_NOATIME = 1024
+MS_NODIRATIME = 2048
+MS_BIND = 4096
+MS_MOVE = 8192
+MS_REC = 16384
+MS_RELATIME = 1 << 21
+MS_STRICTATIME = 1 << 24
+MNT_FORCE = 1
+MNT_DETACH = 2
+
 # taken from sys/personality.h
 PER_LINUX32=0x0008
 PER_LINUX=0x0000
@@ -106,20 +138,75 @@ def rmtree(path, *args, **kargs):
                 raise
 
 from signal import SIGTERM
+# how long orphansKill waits for what it killed
+ORPHANS_WAIT = 10
+
 decorate(traceLog())
 def orphansKill(rootToKill, killsig=SIGTERM):
     """kill off anything that is still chrooted."""
     getLog().debug("kill orphans")
-    for fn in [ d for d in os.listdir("/proc") if d.isdigit() ]:
-        try:
-            root = os.readlink("/proc/%s/root" % fn)
-            if os.path.realpath(root) == os.path.realpath(rootToKill):
-                getLog().warning("Process ID %s still running in chroot. Killing..." % fn)
-                pid = int(fn, 10)
+    root = os.path.realpath(rootToKill)
+    cgroup = mockbuild.cgroup.current(create=False)
+    frozen = False
+    if cgroup is not None:
+        # everything we ran is in there; frozen, none of it can fork away
+        frozen = cgroup.freeze()
+        candidates = cgroup.pids()
+    else:
+        candidates = [ int(d) for d in os.listdir("/proc") if d.isdigit() ]
+    killed = []
+    try:
+        for pid in candidates:
+            if _processRoot(pid) != root:
+                continue
+            getLog().warning("Process ID %d still running in chroot. Killing..." % pid)
+            try:
                 os.kill(pid, killsig)
-                os.waitpid(pid, 0)
-        except OSError, e:
-            pass
+                killed.append(pid)
+            except OSError:
+                pass
+    finally:
+        if frozen:
+            cgroup.thaw()
+    _waitForExit(killed, ORPHANS_WAIT)
+
+def _processRoot(pid):
+    try:
+        link = os.readlink("/proc/%d/root" % pid)
+    except OSError:
+        return None
+    # most processes are not chrooted, no need to resolve that
+    if link == "/":
+        return link
+    return os.path.realpath(link)
+
+def _processAlive(pid):
+    try:
+        stat = open("/proc/%d/stat" % pid).read()
+    except (IOError, OSError):
+        return False
+    # a zombie is only waiting for its parent
+    return stat[stat.rindex(")") + 2:].split()[0] != "Z"
+
+def _waitForExit(pids, timeout):
+    deadline = time.time() + timeout
+    pids = list(pids)
+    while pids:
+        for pid in pids[:]:
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    pids.remove(pid)
+                continue
+            except OSError:
+                # not our child
+                pass
+            if not _processAlive(pid):
+                pids.remove(pid)
+        if not pids or time.time() >= deadline:
+            break
+        time.sleep(0.05)
+    if pids:
+        getLog().debug("processes %s are still there" % pids)
 
 
 decorate(traceLog())
@@ -153,6 +240,11 @@ def cmpKernelEVR(str1, str2):
     evr2 = str2.split('.', 2)
     return rpmUtils.miscutils.compareEVR(evr1, evr2)
 
+decorate(traceLog())
+def compareEVR(evr1, evr2):
+    'compare two (epoch, version, release) tuples and return -1, 0, 1 for less, equal, greater'
+    return rpmUtils.miscutils.compareEVR(evr1, evr2)
+
 decorate(traceLog())
 def getAddtlReqs(hdr, conf):
     # Add the 'more_buildreqs' for this SRPM (if defined in config file)
@@ -180,13 +272,31 @@ def chomp(line):
 
 decorate(traceLog())
 def unshare(flags):
+    """returns False if the C library has no unshare()"""
     getLog().debug("Unsharing. Flags: %s" % flags)
     try:
         res = _libc.unshare(flags)
         if res:
             raise mockbuild.exception.UnshareFailed(os.strerror(_errno.value))
     except AttributeError, e:
-        pass
+        return False
+    return True
+
+decorate(traceLog())
+def mount(source, target, fstype=None, flags=0, data=None):
+    """mount(2). raises OSError."""
+    getLog().debug("mount %s on %s type %s flags 0x%x (%s)" % (source, target, fstype, flags, data))
+    res = _libc.mount(source, target, fstype, flags, data)
+    if res:
+        raise OSError(_errno.value, os.strerror(_errno.value))
+
+decorate(traceLog())
+def umount(target, flags=0):
+    """umount2(2). raises OSError."""
+    getLog().debug("umount %s flags 0x%x" % (target, flags))
+    res = _libc.umount2(target, flags)
+    if res:
+        raise OSError(_errno.value, os.strerror(_errno.value))
 
 # these are called in child process, so no logging
 def condChroot(chrootPath):
@@ -224,52 +334,155 @@ def condEnvironment(env=None):
     for k in env.keys():
         os.putenv(k, env[k])
 
-def logOutput(fds, logger, returnOutput=1, start=0, timeout=0, printOutput=False):
-    output=""
-    done = 0
-
-    # set all fds to nonblocking
-    for fd in fds:
-        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
-        if not fd.closed:
-            fcntl.fcntl(fd, fcntl.F_SETFL, flags| os.O_NONBLOCK)
-
-    tail = ""
-    while not done:
-        if (time.time() - start)>timeout and timeout!=0:
-            done = 1
-            break
-
-        i_rdy,o_rdy,e_rdy = select.select(fds,[],[],1)
-        for s in i_rdy:
+# how much to read per system call, and how often to flush log handlers
+LOG_OUTPUT_CHUNK = 65536
+LOG_OUTPUT_FLUSH_INTERVAL = 0.5
+
+class _OutputTail(object):
+    """keeps the last 'size' bytes written to it"""
+    def __init__(self, size):
+        self.size = size
+        self.chunks = collections.deque()
+        self.length = 0
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def getvalue(self):
+        return "".join(self.chunks)[-self.size:]
+
+def logOutput(fds, logger, returnOutput=1, start=0, timeout=0, printOutput=False, tailSize=0, stats=None):
+    """copy everything the child writes to fds to logger, line by line.
+       returns the complete output if returnOutput is set, else the last
+       tailSize bytes of it (or nothing). the number of bytes read is added
+       to stats['bytes'] if stats is given."""
+    output = ""
+    tail = None
+    if tailSize and not returnOutput:
+        tail = _OutputTail(tailSize)
+
+    poller = select.poll()
+    open_fds = {}
+    for f in fds:
+        if not f.closed:
+            open_fds[f.fileno()] = ""
+            poller.register(f.fileno(), select.POLLIN | select.POLLPRI)
+
+    handlers = []
+    debug = None
+    if logger is not None:
+        handlers = logger.handlers
+        if logger.isEnabledFor(logging.DEBUG):
+            debug = logger.debug
+    lastFlush = time.time()
+    while open_fds:
+        wait = -1
+        if timeout != 0:
+            remaining = start + timeout - time.time()
+            if remaining <= 0:
+                break
+            wait = int(remaining * 1000) + 1
+        try:
+            events = poller.poll(wait)
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                continue
+            raise
+        for (fd, event) in events:
             # slurp as much input as is ready
-            input = s.read()
+            input = os.read(fd, LOG_OUTPUT_CHUNK)
             if input == "":
-                done = 1
-                break
-            if logger is not None:
+                poller.unregister(fd)
+                partial = open_fds.pop(fd)
+                if partial and debug is not None:
+                    debug(partial)
+                continue
+            if debug is not None:
                 lines = input.split("\n")
-                if tail:
-                    lines[0] = tail + lines[0]
+                lines[0] = open_fds[fd] + lines[0]
                 # we may not have all of the last line
-                tail = lines.pop()
+                open_fds[fd] = lines.pop()
                 for line in lines:
-                    if line == '': continue
-                    logger.debug(line)
-                for h in logger.handlers:
-                    h.flush()
+                    if line:
+                        debug(line)
             if returnOutput:
+                # appending to an unshared str is done in place by CPython;
+                # joining a list of chunks at the end would need twice the
+                # memory of the whole output at once.
                 output += input
+            elif tail is not None:
+                tail.append(input)
             if printOutput:
-                print input,
-
-    if tail and logger is not None:
-        logger.debug(tail)
+                sys.stdout.write(input)
+            if stats is not None:
+                stats['bytes'] += len(input)
+        if handlers and time.time() - lastFlush >= LOG_OUTPUT_FLUSH_INTERVAL:
+            for h in handlers:
+                h.flush()
+            lastFlush = time.time()
+
+    if debug is not None:
+        # whatever is left of unterminated lines when the timeout hit
+        for partial in open_fds.values():
+            if partial:
+                debug(partial)
+    for h in handlers:
+        h.flush()
+    if printOutput:
+        sys.stdout.flush()
+    if tail is not None:
+        return tail.getvalue()
     return output
 
+# a frame is a one byte tag, a length and that many bytes of payload
+_FRAME_HEADER = struct.Struct("!cI")
+
+def sendFrame(sock, tag, payload):
+    sock.sendall(_FRAME_HEADER.pack(tag, len(payload)) + payload)
+
+def _recvAll(sock, size):
+    data = ""
+    while len(data) < size:
+        try:
+            chunk = sock.recv(size - len(data))
+        except socket.error, e:
+            if e[0] == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def recvFrame(sock, maxSize=None):
+    """returns (tag, payload), or (None, None) at EOF. raises ValueError
+       for a payload larger than maxSize."""
+    header = _recvAll(sock, _FRAME_HEADER.size)
+    if header is None:
+        return (None, None)
+    (tag, size) = _FRAME_HEADER.unpack(header)
+    if maxSize is not None and size > maxSize:
+        raise ValueError, "frame of %d bytes, at most %d expected" % (size, maxSize)
+    payload = _recvAll(sock, size)
+    if payload is None:
+        return (None, None)
+    return (tag, payload)
+
+# the answer of selinuxEnabled, it does not change while we run
+_selinuxEnabled = None
+
 decorate(traceLog())
 def selinuxEnabled():
     """Check if SELinux is enabled (enforcing or permissive)."""
+    global _selinuxEnabled
+    if _selinuxEnabled is None:
+        _selinuxEnabled = _selinuxProbe()
+    return _selinuxEnabled
+
+def _selinuxProbe():
     for mount in open("/proc/mounts").readlines():
         (fstype, mountpoint, garbage) = mount.split(None, 2)
         if fstype == "selinuxfs":
@@ -286,6 +499,16 @@ def selinuxEnabled():
         pass
     return False
 
+# a command run by do() or the chroot server, for events.jsonl
+def commandEvent(command, uid, gid, chrootPath, started, returncode, outputBytes):
+    if uid is None:
+        uid = os.geteuid()
+    if gid is None:
+        gid = os.getegid()
+    mockbuild.events.emit("command", command=command, uid=uid, gid=gid, chroot=chrootPath,
+                          seconds=round(mockbuild.events.monotonic() - started, 6),
+                          returncode=returncode, output_bytes=outputBytes)
+
 # logger =
 # output = [1|0]
 # chrootPath
@@ -298,8 +521,12 @@ def do(command, shell=False, chrootPath=None, cwd=None, timeout=0, raiseExc=True
        printOutput=False, env=None, *args, **kargs):
 
     logger = kargs.get("logger", getLog())
+    # keep the last tailSize bytes of output for the error message
+    tailSize = kargs.get("tailSize", 0)
     output = ""
     start = time.time()
+    clock = mockbuild.events.monotonic()
+    stats = {'bytes': 0}
     preexec = ChildPreExec(personality, chrootPath, cwd, uid, gid)
     if env is None:
         env = clean_env()
@@ -317,9 +544,10 @@ def do(command, shell=False, chrootPath=None, cwd=None, timeout=0, raiseExc=True
             preexec_fn = preexec,
             )
 
-        # use select() to poll for output so we dont block
+        # use poll() to wait for output so we dont block
         output = logOutput([child.stdout, child.stderr],
-                           logger, returnOutput, start, timeout, printOutput=printOutput)
+                           logger, returnOutput, start, timeout, printOutput=printOutput,
+                           tailSize=tailSize, stats=stats)
 
     except:
         # kill children if they arent done
@@ -333,27 +561,77 @@ def do(command, shell=False, chrootPath=None, cwd=None, timeout=0, raiseExc=True
         raise
 
     # wait until child is done, kill it if it passes timeout
-    niceExit=1
-    while child.poll() is None:
-        if (time.time() - start)>timeout and timeout!=0:
-            niceExit=0
-            os.killpg(child.pid, 15)
-        if (time.time() - start)>(timeout+1) and timeout!=0:
-            niceExit=0
-            os.killpg(child.pid, 9)
-
-    if not niceExit:
+    killer = None
+    if timeout != 0:
+        killer = _ChildKiller(child)
+        killer.arm(max(start + timeout - time.time(), 0))
+    try:
+        child.wait()
+    finally:
+        if killer is not None:
+            killer.cancel()
+    mockbuild.profiler.commandDone(command, clock, child.returncode, chrootPath)
+    commandEvent(command, uid, gid, chrootPath, clock, child.returncode, stats['bytes'])
+
+    if killer is not None and killer.fired:
         raise commandTimeoutExpired, ("Timeout(%s) expired for command:\n # %s\n%s" % (timeout, command, output))
 
     logger.debug("Child return code was: %s" % str(child.returncode))
     if raiseExc and child.returncode:
         if returnOutput:
             raise mockbuild.exception.Error, ("Command failed: \n # %s\n%s" % (command, output), child.returncode)
+        elif output:
+            raise mockbuild.exception.Error, ("Command failed. See logs for output.\n # %s\n...\n%s" % (command, output), child.returncode)
         else:
             raise mockbuild.exception.Error, ("Command failed. See logs for output.\n # %s" % (command,), child.returncode)
 
+    if not returnOutput:
+        return ""
     return output
 
+class _ChildKiller(object):
+    """TERM the process group of a child once its time is up, KILL it a
+       second later if that did not help"""
+    def __init__(self, child):
+        self.child = child
+        self.fired = False
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def arm(self, delay, sig=15):
+        self.lock.acquire()
+        try:
+            self.timer = threading.Timer(delay, self._fire, [sig])
+            self.timer.setDaemon(True)
+            self.timer.start()
+        finally:
+            self.lock.release()
+
+    def cancel(self):
+        self.lock.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        finally:
+            self.lock.release()
+
+    def _fire(self, sig):
+        self.lock.acquire()
+        try:
+            # never signal a pid that may have been reused
+            if self.timer is None or self.child.returncode is not None:
+                return
+            self.fired = True
+            try:
+                os.killpg(self.child.pid, sig)
+            except OSError:
+                return
+        finally:
+            self.lock.release()
+        if sig != 9:
+            self.arm(1, 9)
+
 class ChildPreExec(object):
     def __init__(self, personality, chrootPath, cwd, uid, gid, env=None, shell=False):
         self.personality = personality
@@ -363,8 +641,11 @@ class ChildPreExec(object):
         self.gid = gid
         self.env = env
         self.shell = shell
+        self.cgroup = mockbuild.cgroup.current(create=False)
 
     def __call__(self, *args, **kargs):
+        if self.cgroup is not None:
+            self.cgroup.join()
         if not self.shell:
             os.setsid()
         os.umask(002)
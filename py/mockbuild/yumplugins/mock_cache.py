@@ -0,0 +1,201 @@
+# vim:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:textwidth=0:
+# License: GPL2 or later see COPYING
+
+# yum plugin for the yum cache that all chroots of a mock config share
+# (mock's yum_cache plugin). mock takes no lock of its own around yum when
+# this plugin is in use; it is taken in here, where yum tells what it is
+# about to do:
+#   - from repository setup until the package sack is loaded yum may
+#     refresh repository metadata, so it holds yumcache.lock exclusively
+#   - after that it only reads metadata and adds packages, and holds the
+#     lock shared with the other yum processes, until it exits
+#   - packages are downloaded to a file of their own and renamed into
+#     place, so that nobody sees one half written
+# with a package store configured, packages are hardlinked between it and
+# the cache, so that what one config downloaded, the others find there.
+# it also records in mock's index of the cache (mockbuild/cacheindex.py)
+# that the packages of the transaction were used, for yum_cache's max_size.
+# metadata yum loads lazily later on (filelists for a file requirement)
+# is fetched under the shared lock. yum verifies what it reads against
+# repomd.xml, so the worst that happens is one of them fetching it again.
+
+# python library imports
+import fcntl
+import os
+import sqlite3
+import time
+
+from yum.plugins import TYPE_CORE
+
+requires_api_version = "2.1"
+plugin_type = (TYPE_CORE,)
+
+# downloads in flight are called <package>.<pid>.mocktmp; mock removes
+# leftovers of dead yum processes while it has the cache to itself
+TMP_SUFFIX = ".mocktmp"
+
+# the store trusts a file with the checksum as its name to be that package;
+# only for checksums nobody can make a second package for
+STORE_SUMTYPES = ("sha256", "sha384", "sha512")
+
+_lock = None
+_exclusive = False
+
+def _take(conduit, exclusive):
+    global _lock, _exclusive
+    if _lock is None:
+        lockfile = conduit.confString("main", "lockfile")
+        if not lockfile:
+            return
+        _lock = open(lockfile, "a+")
+    if exclusive:
+        mode = fcntl.LOCK_EX
+    else:
+        mode = fcntl.LOCK_SH
+    try:
+        fcntl.lockf(_lock.fileno(), mode | fcntl.LOCK_NB)
+    except IOError:
+        started = time.time()
+        conduit.info(2, "Waiting for the yum cache lock")
+        fcntl.lockf(_lock.fileno(), mode)
+        conduit.info(2, "Waited %.1f seconds for the yum cache lock" % (time.time() - started))
+    _exclusive = exclusive
+
+def prereposetup_hook(conduit):
+    _take(conduit, True)
+
+def exclude_hook(conduit):
+    # metadata is in place; going from exclusive to shared is atomic, nobody
+    # can get an exclusive lock in between
+    _take(conduit, False)
+
+def predownload_hook(conduit):
+    for po in conduit.getDownloadPackages():
+        if getattr(po, "pkgtype", None) == "local":
+            continue
+        final = po.localPkg()
+        if os.path.exists(final):
+            if po.verifyLocalPkg():
+                continue
+        elif _fromStore(conduit, po, final):
+            # yum looks for the file once more before it downloads
+            continue
+        # downloading into the cache while it is locked exclusively (yum
+        # did not load a sack) is fine as it is
+        if _lock is None or _exclusive:
+            continue
+        po.mockFinalPath = final
+        po.localpath = "%s.%d%s" % (final, os.getpid(), TMP_SUFFIX)
+
+def postdownload_hook(conduit):
+    errors = conduit.getErrors()
+    for po in conduit.getDownloadPackages():
+        if getattr(po, "pkgtype", None) == "local" or po in errors:
+            continue
+        final = getattr(po, "mockFinalPath", None)
+        if final is not None:
+            tmp = po.localpath
+            del po.mockFinalPath
+            po.localpath = final
+            if not os.path.exists(tmp):
+                continue
+            os.rename(tmp, final)
+        _toStore(conduit, po, po.localPkg())
+    # what did not make it
+    for po in errors:
+        final = getattr(po, "mockFinalPath", None)
+        if final is None:
+            continue
+        if os.path.exists(po.localpath):
+            os.unlink(po.localpath)
+        del po.mockFinalPath
+        po.localpath = final
+
+def _storePath(conduit, po):
+    """where the package store of all configs has po, by its checksum in
+       the repository metadata"""
+    store = conduit.confString("main", "store")
+    if not store:
+        return None
+    try:
+        (sumtype, checksum) = po.returnIdSum()
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if sumtype not in STORE_SUMTYPES or not checksum:
+        return None
+    return os.path.join(store, sumtype, checksum[:2], checksum + ".rpm")
+
+def _fromStore(conduit, po, final):
+    """hardlink po from the package store to final, if another config has
+       downloaded it already"""
+    stored = _storePath(conduit, po)
+    if stored is None or not os.path.exists(stored):
+        return False
+    try:
+        os.link(stored, final)
+    except OSError:
+        return False
+    # yum would write a download over the one in the store
+    if not po.verifyLocalPkg():
+        for path in (final, stored):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        return False
+    conduit.info(3, "%s linked from the package store" % po)
+    return True
+
+def _toStore(conduit, po, final):
+    stored = _storePath(conduit, po)
+    if stored is None or os.path.exists(stored) or not os.path.exists(final):
+        return
+    tmp = "%s.%d%s" % (stored, os.getpid(), TMP_SUFFIX)
+    try:
+        if not os.path.isdir(os.path.dirname(stored)):
+            os.makedirs(os.path.dirname(stored))
+        os.link(final, tmp)
+        os.rename(tmp, stored)
+    except OSError, e:
+        # another filesystem than the cache, most likely
+        conduit.info(3, "could not add %s to the package store: %s" % (po, e))
+
+def pretrans_hook(conduit):
+    # every package the transaction installs, downloaded now or long ago
+    paths = []
+    for txmbr in conduit.getTsInfo().getMembers():
+        if txmbr.ts_state not in ("i", "u") or getattr(txmbr.po, "pkgtype", None) == "local":
+            continue
+        if hasattr(txmbr.po, "localPkg"):
+            paths.append(txmbr.po.localPkg())
+    _used(conduit, paths)
+
+def _used(conduit, paths):
+    """set the time of last use of paths in the index, where mock has them
+       under the cache directory outside the chroot"""
+    index = conduit.confString("main", "index")
+    cachedir = conduit.confString("main", "cachedir")
+    mountpoint = conduit.confString("main", "mountpoint")
+    if not (index and cachedir and mountpoint) or not os.path.exists(index):
+        return
+    rows = []
+    now = time.time()
+    for path in paths:
+        if path.startswith(mountpoint + "/"):
+            rows.append((now, os.path.join(cachedir, path[len(mountpoint) + 1:])))
+    try:
+        db = sqlite3.connect(index, timeout=60)
+        try:
+            db.executemany("update files set atime = ? where path = ?", rows)
+            db.commit()
+        finally:
+            db.close()
+    except sqlite3.Error, e:
+        conduit.info(2, "could not record the use of cached packages: %s" % e)
+
+def close_hook(conduit):
+    global _lock
+    if _lock is not None:
+        fcntl.lockf(_lock.fileno(), fcntl.LOCK_UN)
+        _lock.close()
+        _lock = None
@@ -0,0 +1,103 @@
+#!/usr/bin/python -tt
+#
+# Micro-benchmark for mockbuild.util.logOutput: pipes a synthetic build log
+# through it and reports throughput and peak RSS, next to the select()/
+# string-concatenation implementation it replaced.
+#
+# usage: bench-logoutput.py [MB]
+#
+
+import fcntl
+import logging
+import os
+import os.path
+import resource
+import select
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), "..", "py"))
+import mockbuild.util
+
+LINE = "gcc -O2 -g -pipe -Wall -fexceptions -fstack-protector -c foo.c -o foo.o  # %08d\n"
+
+def legacyLogOutput(fds, logger, returnOutput=1, start=0, timeout=0, printOutput=False):
+    output=""
+    done = 0
+
+    for fd in fds:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        if not fd.closed:
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags| os.O_NONBLOCK)
+
+    tail = ""
+    while not done:
+        i_rdy,o_rdy,e_rdy = select.select(fds,[],[],1)
+        for s in i_rdy:
+            input = s.read()
+            if input == "":
+                done = 1
+                break
+            if logger is not None:
+                lines = input.split("\n")
+                if tail:
+                    lines[0] = tail + lines[0]
+                tail = lines.pop()
+                for line in lines:
+                    if line == '': continue
+                    logger.debug(line)
+                for h in logger.handlers:
+                    h.flush()
+            if returnOutput:
+                output += input
+
+    if tail and logger is not None:
+        logger.debug(tail)
+    return output
+
+def generator(megabytes):
+    count = megabytes * 1024 * 1024 / len(LINE % 0)
+    return [sys.executable, "-c",
+            "import sys\n"
+            "line = %r\n"
+            "for i in xrange(%d):\n"
+            "    sys.stdout.write(line %% i)\n" % (LINE, count)]
+
+def run(impl, megabytes, returnOutput):
+    logger = logging.getLogger("bench")
+    logger.propagate = 0
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.FileHandler(os.devnull))
+    child = subprocess.Popen(generator(megabytes), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             bufsize=0, close_fds=True)
+    start = time.time()
+    output = impl([child.stdout, child.stderr], logger, returnOutput)
+    elapsed = time.time() - start
+    child.wait()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return (elapsed, len(output), rss)
+
+def main():
+    megabytes = 500
+    if len(sys.argv) > 1:
+        megabytes = int(sys.argv[1])
+    print "%-8s %-12s %10s %10s %12s" % ("impl", "returnOutput", "seconds", "MB/s", "peak RSS MB")
+    for (name, impl) in (("legacy", legacyLogOutput), ("current", mockbuild.util.logOutput)):
+        for returnOutput in (0, 1):
+            # fresh process per run so peak RSS is not shared between them
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(r)
+                os.write(w, repr(run(impl, megabytes, returnOutput)))
+                os._exit(0)
+            os.close(w)
+            result = os.read(r, 4096)
+            os.waitpid(pid, 0)
+            (elapsed, size, rss) = eval(result)
+            print "%-8s %-12d %10.2f %10.1f %12.1f" % (name, returnOutput, elapsed,
+                                                      megabytes / elapsed, rss)
+
+if __name__ == '__main__':
+    main()
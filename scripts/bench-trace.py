@@ -0,0 +1,98 @@
+#!/usr/bin/python -tt
+#
+# Micro-benchmark for mockbuild.trace_decorator.traceLog: times calls of a
+# decorated no-op with tracing off, with tracing on but nothing listening on
+# the trace logger (mock without --trace used to run like that), and with
+# tracing written out, next to the decorator as it was before.
+#
+# usage: bench-trace.py [CALLS]
+#
+
+import logging
+import os
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), "..", "py"))
+import mockbuild.trace_decorator
+from mockbuild.trace_decorator import doLog
+from peak.util.decorators import rewrap
+
+def legacyTraceLog(log = None):
+    def decorator(func):
+        def trace(*args, **kw):
+            filename = os.path.normcase(func.func_code.co_filename)
+            func_name = func.func_code.co_name
+            lineno = func.func_code.co_firstlineno
+
+            l2 = kw.get('logger', log)
+            if l2 is None:
+                l2 = logging.getLogger("trace.%s" % func.__module__)
+            if isinstance(l2, basestring):
+                l2 = logging.getLogger(l2)
+
+            message = "ENTER %s(" % func_name
+            for arg in args:
+                message = message + repr(arg) + ", "
+            for k,v in kw.items():
+                message = message + "%s=%s" % (k,repr(v))
+            message = message + ")"
+
+            frame = sys._getframe(2)
+            doLog(l2, logging.INFO, os.path.normcase(frame.f_code.co_filename), frame.f_lineno, message, args=[], exc_info=None, func=frame.f_code.co_name)
+            try:
+                result = "Bad exception raised: Exception was not a derived class of 'Exception'"
+                try:
+                    result = func(*args, **kw)
+                except (KeyboardInterrupt, Exception), e:
+                    result = "EXCEPTION RAISED"
+                    doLog(l2, logging.INFO, filename, lineno, "EXCEPTION: %s\n" % e, args=[], exc_info=sys.exc_info(), func=func_name)
+                    raise
+            finally:
+                doLog(l2, logging.INFO, filename, lineno, "LEAVE %s --> %s\n" % (func_name, result), args=[], exc_info=None, func=func_name)
+
+            return result
+        return rewrap(func, trace)
+    return decorator
+
+def noop(path, *args):
+    return path
+
+def run(func, calls):
+    start = time.time()
+    for i in xrange(calls):
+        func("/var/lib/mock/fedora-rawhide-x86_64/root", "builddir")
+    return (time.time() - start) / calls * 1e9
+
+def main():
+    calls = 200000
+    if len(sys.argv) > 1:
+        calls = int(sys.argv[1])
+
+    # mock without --trace: the trace loggers are enabled but have no handlers
+    trace = logging.getLogger("trace")
+    trace.propagate = 0
+    trace.setLevel(logging.INFO)
+    logging.getLogger().addHandler(logging.FileHandler(os.devnull))
+
+    print "%-28s %12s" % ("decorator", "ns/call")
+    print "%-28s %12.0f" % ("undecorated", run(noop, calls))
+    print "%-28s %12.0f" % ("legacy, not emitted", run(legacyTraceLog()(noop), calls))
+
+    mockbuild.trace_decorator.setTracing(False)
+    print "%-28s %12.0f" % ("tracing off", run(mockbuild.trace_decorator.traceLog()(noop), calls))
+
+    mockbuild.trace_decorator.setTracing(True)
+    decorated = mockbuild.trace_decorator.traceLog()(noop)
+    print "%-28s %12.0f" % ("tracing on, not emitted", run(decorated, calls))
+    mockbuild.trace_decorator.setTracing(False)
+    print "%-28s %12.0f" % ("tracing on, turned off", run(decorated, calls))
+
+    mockbuild.trace_decorator.setTracing(True)
+    trace.propagate = 1
+    print "%-28s %12.0f" % ("legacy, emitted", run(legacyTraceLog()(noop), calls))
+    print "%-28s %12.0f" % ("tracing on, emitted", run(decorated, calls))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+#!/bin/sh
+
+source ${TESTDIR}/functions
+
+#
+# test chroot pool
+#
+header "test chroot pool"
+runcmd "$MOCKCMD --offline --pool-fill 1"
+if ! ls -d /var/lib/mock/${testConfig}-pool-[0-9]* >/dev/null 2>&1; then
+    echo "pool test FAILED. no pooled chroot found."
+    exit 1
+fi
+
+mkdir -p $outdir
+runcmd "$MOCKCMD --offline --init 2>&1 | tee $outdir/pool-init.log"
+if [ ! -e $CHROOT/usr/bin/rpmbuild ]; then
+    echo "pool test FAILED. claimed chroot not initialized."
+    exit 1
+fi
+if ! grep -q "set up by the chroot pool" $outdir/pool-init.log; then
+    echo "pool test FAILED. build user set up again in the claimed chroot."
+    exit 1
+fi
+rm -f $outdir/pool-init.log
+
+# stop refilling the pool and drop what is left
+sudo rm -rf /var/lib/mock/${testConfig}-pool.size /var/lib/mock/${testConfig}-pool-[0-9]*
@@ -0,0 +1,24 @@
+#!/bin/sh
+
+source ${TESTDIR}/functions
+
+#
+# test parallel rebuild of several srpms
+#
+header "test --jobs"
+srpm=$(ls $MOCKSRPM)
+copy=$outdir/jobs-copy.src.rpm
+mkdir -p $outdir
+cp $srpm $copy
+runcmd "$MOCKCMD --offline --jobs 2 --rebuild $srpm $copy"
+for name in $(basename $srpm .src.rpm) jobs-copy; do
+    if ! grep -q "Finish: chroot init" $outdir/$name/state.log 2>/dev/null; then
+        echo "jobs test FAILED. chroot of the $name job not initialized."
+        exit 1
+    fi
+    if ! ls $outdir/$name/*.noarch.rpm >/dev/null 2>&1; then
+        echo "jobs test FAILED. no binary rpm in $outdir/$name."
+        exit 1
+    fi
+done
+rm -f $copy
@@ -0,0 +1,53 @@
+#!/bin/sh
+
+source ${TESTDIR}/functions
+
+#
+# test prefetch against a local (file://) repository made of the packages
+# the earlier tests left in the yum cache
+#
+header "test prefetch"
+if ! which createrepo >/dev/null 2>&1; then
+    echo "prefetch test skipped. createrepo is not installed."
+    exit 0
+fi
+repo=$outdir/prefetch-repo
+cfg=$outdir/prefetch-cfg
+rm -rf $repo $cfg
+mkdir -p $repo $cfg
+find /var/cache/mock/${testConfig}/yum_cache -name '*.rpm' -exec cp {} $repo \;
+createrepo -q $repo
+cp $cfgdir/site-defaults.cfg $cfgdir/logging.ini $cfg
+cp $cfgdir/${testConfig}.cfg $cfg/prefetch-test.cfg
+cat >>$cfg/prefetch-test.cfg <<EOF
+config_opts['root'] = 'prefetch-test'
+config_opts['chroot_setup_cmd'] = 'install rpm-build'
+config_opts['plugin_conf']['root_cache_enable'] = False
+config_opts['plugin_conf']['prefetch_enable'] = True
+config_opts['yum.conf'] = """
+[main]
+cachedir=/var/cache/yum
+reposdir=/dev/null
+gpgcheck=0
+assumeyes=1
+
+[local]
+name=local
+baseurl=file://$repo
+# have yum take the packages from its cache, where prefetch puts them
+copy_local=1
+"""
+EOF
+rm -f $outdir/events.jsonl
+runcmd "$MOCKCMD --configdir=$cfg -r prefetch-test --init"
+if ! grep '"event": "prefetch"' $outdir/events.jsonl | grep -q '"packages": [1-9]'; then
+    echo "prefetch test FAILED. no packages prefetched."
+    exit 1
+fi
+if ! ls /var/cache/mock/prefetch-test/yum_cache/local/packages/*.rpm >/dev/null 2>&1; then
+    echo "prefetch test FAILED. no packages in the yum cache."
+    exit 1
+fi
+runcmd "$MOCKCMD --configdir=$cfg -r prefetch-test --clean"
+sudo rm -rf /var/cache/mock/prefetch-test
+rm -rf $repo $cfg